@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the compressed output of the log file. Writes the same stream of
+formatted log lines (repetitive, like the ones produced by log_usart() of the
+client example) through the plain text file and through CompressedStream with
+commits (flush + fsync) every N lines, and reports bytes written to the file and
+CPU time per message. Run it on the target Pi against the USB drive:
+
+    python3 benchmarks/bench_compression.py --dir /mnt/LOGS
+
+Results are printed as JSON lines, one per method.
+"""
+
+import os, sys, json, time, random, logging, argparse, tempfile
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'raspberrypi-uart-logger'))
+from compression import CompressedStream, compression_suffixes
+
+
+
+log_formatter_string = '%(levelname)-8s [%(asctime)s] %(message)s'
+
+templates = [
+    (logging.DEBUG, 'ADC channel {} value: {}'),
+    (logging.DEBUG, 'Timer tick {}'),
+    (logging.INFO, 'Button {} pressed'),
+    (logging.INFO, "It's OK!"),
+    (logging.WARNING, 'Voltage is low: {} mV'),
+    (logging.ERROR, 'Sensor {} does not respond'),
+]
+
+
+
+def generate_lines(count, seed=0):
+    rnd = random.Random(seed)
+    formatter = logging.Formatter(log_formatter_string)
+    lines = []
+    created = time.time()
+    for i in range(count):
+        levelno,template = rnd.choice(templates)
+        record = logging.LogRecord('', levelno, '', 0,
+            template.format(rnd.randint(0, 15), rnd.randint(0, 4095)), None,
+            None)
+        record.created = created + i * 0.001
+        record.msecs = (record.created - int(record.created)) * 1000
+        lines.append(formatter.format(record) + '\n')
+    return lines
+
+
+
+def run(method, lines, directory, commit_every, level):
+    filename = os.path.join(directory,
+                            'bench.txt' + compression_suffixes[method])
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    if method is None:
+        stream = open(filename, 'a', encoding='utf-8')
+    else:
+        stream = CompressedStream(filename, method, level)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i,line in enumerate(lines, 1):
+        stream.write(line)
+        if i % commit_every == 0:
+            stream.flush()
+            os.fsync(stream.fileno())
+    stream.close()
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    bytes_in = sum(len(line.encode('utf-8')) for line in lines)
+    bytes_written = os.path.getsize(filename)
+    os.remove(filename)
+    return {
+        'method': method or 'plain',
+        'messages': len(lines),
+        'commit_every': commit_every,
+        'bytes_in': bytes_in,
+        'bytes_written': bytes_written,
+        'ratio': round(bytes_in / bytes_written, 2),
+        'bytes_written_per_message': round(bytes_written / len(lines), 2),
+        'cpu_us_per_message': round(cpu / len(lines) * 1e6, 2),
+        'wall_us_per_message': round(wall / len(lines) * 1e6, 2)
+    }
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--dir', default=None,
+                        help="directory to write to (default: temporary one)")
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--commit-every', type=int, default=50,
+                        help="lines between commits (fsync_every_records)")
+    parser.add_argument('--level', type=int, default=6,
+                        help="compression level")
+    args = parser.parse_args()
+
+    lines = generate_lines(args.messages)
+    methods = [None, 'gzip']
+    try:
+        import zstandard
+        methods.append('zstd')
+    except ImportError:
+        print("zstandard package is not installed, skip zstd", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for method in methods:
+            print(json.dumps(run(method, lines, directory, args.commit_every,
+                                 args.level)))
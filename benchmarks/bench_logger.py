@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of the logger. Runs the real logger.main() in a child
+process on the simulated hardware (hardware_backend = 'simulated'): a pty pair
+instead of the UART and a directory on tmpfs as the drive. It replays
+synthetic log_usart() frames (see client-usage-example/logging.c) at the given
+baud rate, message size and level mix, and reports sustained frames/s, dropped
+frames, end-to-end latency percentiles (from the write into the pty to the
+appearance of the line in the log file) and CPU time per message. Works on any
+Linux machine:
+
+    python3 benchmarks/bench_logger.py --baud 921600 --messages 50000 \\
+        --size 20-120 --levels D=50,I=30,W=15,E=4,C=1 \\
+        --set fsync_every_records=1
+
+Settings of miscs.py can be overridden with --set name=value (value is a
+Python literal). The result is printed as one JSON line.
+
+With --framing crc frames are sent as CRC-checked ones (uart_framing = 'crc'
+is set for the logger) and --noise adds bursts of random bytes between frames
+to check the resynchronisation.
+"""
+
+import os, re, sys, json, time, glob, tty, pty, fcntl, random, shutil,\
+       struct, binascii, argparse, tempfile, threading, subprocess
+
+here = os.path.abspath(os.path.dirname(__file__))
+app_dir = os.path.join(here, '..', 'raspberrypi-uart-logger')
+
+# Prefix letters of log_usart()
+level_letters = 'DIWEC'
+
+payload_pattern = re.compile(r'seq=(\d+) t=(\d+\.\d+)')
+
+
+
+def parse_levels(value):
+    """
+    'D=50,I=30' -> [('D', 50), ('I', 30)]
+    """
+    levels = []
+    for item in value.split(','):
+        letter,weight = item.split('=')
+        if letter not in level_letters:
+            raise argparse.ArgumentTypeError("unknown level '{}'".format(letter))
+        levels.append((letter, float(weight)))
+    return levels
+
+
+
+def parse_size(value):
+    """
+    '48' or '20-120' -> (min,max)
+    """
+    low,sep,high = value.partition('-')
+    return int(low),int(high or low)
+
+
+
+def parse_setting(value):
+    import ast
+    name,sep,literal = value.partition('=')
+    try:
+        return name,ast.literal_eval(literal)
+    except (ValueError, SyntaxError):
+        return name,literal
+
+
+
+def child_main(config):
+    """
+    Runs in the child process: set up the settings, then start the logger as
+    usual
+    """
+    sys.path.insert(0, app_dir)
+
+    import miscs
+    miscs.hardware_backend = 'simulated'
+    miscs.simulation_dir = os.path.join(config['workdir'], 'simulation')
+    miscs.uart_port = config['port']
+    miscs.uart_baudrate = config['baud'] or 115200
+    miscs.drive_mountpoint = config['mountpoint']
+    miscs.drive_name = 'LOGS'
+    # The simulated drive is plugged but not mounted yet, don't wait for
+    # the mount
+    miscs.check_drive_retry_time = 0
+    miscs.workdir = config['workdir']
+    miscs.reboots_cnt_filename = os.path.join(config['workdir'], 'reboots_cnt.txt')
+    miscs.spool_dir = os.path.join(config['workdir'], 'spool')
+    miscs.metrics_address = None
+    miscs.publisher_address = os.path.join(config['workdir'], 'frames.sock')
+    miscs.raw_capture_dir = os.path.join(config['workdir'], 'capture')
+    miscs.metrics_log_interval = None
+    for name,value in config['settings']:
+        setattr(miscs, name, value)
+    # Settings are copied by 'from miscs import *' so modules are imported
+    # after the patching
+    import logger
+
+    logger.main()
+
+
+
+class LogTail(threading.Thread):
+    """
+    Follows log files in the directory, counts lines and records the time
+    every sent frame appears there
+    """
+
+    def __init__(self, directory, poll_time=0.001):
+        super(LogTail, self).__init__(daemon=True)
+        self.directory = directory
+        self.poll_time = poll_time
+        self.offsets = {}
+        self.partial = {}
+        self.lines = 0
+        # seq -> latency
+        self.latencies = {}
+        self.last_seen = None
+        self.stopped = threading.Event()
+
+    def poll(self):
+        for filename in sorted(glob.glob(os.path.join(self.directory, '*'))):
+            offset = self.offsets.get(filename, 0)
+            try:
+                with open(filename, 'rb') as log_file:
+                    log_file.seek(offset)
+                    data = log_file.read()
+            except OSError:
+                continue
+            # The preallocated tail (log_preallocate) isn't the data yet
+            data = data.rstrip(b'\0')
+            if not data:
+                continue
+            now = time.time()
+            self.offsets[filename] = offset + len(data)
+            data = self.partial.pop(filename, b'') + data
+            lines = data.split(b'\n')
+            if lines[-1]:
+                self.partial[filename] = lines[-1]
+            self.lines += len(lines) - 1
+            for line in lines[:-1]:
+                match = payload_pattern.search(line.decode('utf-8', 'replace'))
+                if match:
+                    self.latencies[int(match.group(1))] = now -\
+                                                          float(match.group(2))
+                    self.last_seen = now
+
+    def run(self):
+        while not self.stopped.wait(self.poll_time):
+            self.poll()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.poll()
+
+
+
+def make_frames(args):
+    rnd = random.Random(args.seed)
+    letters = [letter for letter,weight in args.levels]
+    weights = [weight for letter,weight in args.levels]
+    for seq in range(args.messages):
+        letter = rnd.choices(letters, weights)[0]
+        size = rnd.randint(*args.size)
+        yield seq,letter,size
+
+
+
+def encode_frame(letter, payload, framing):
+    message = '{} {}'.format(letter, payload).encode()
+    if framing == 'text':
+        return message + b'\r'
+    body = struct.pack('>H', len(message)) + message
+    return b'\x02' + body + struct.pack('>H', binascii.crc_hqx(body, 0xFFFF))
+
+
+
+def send_frames(master, args):
+    """
+    Write frames into the pty paced to the baud rate (8N1, 10 bits per byte).
+    A frame that doesn't fit into the pty buffer is lost like a real UART
+    overrun
+
+    returns:
+        sent,overrun,duration
+    """
+    rate = args.baud / 10
+    sent = overrun = sent_bytes = 0
+    noise = random.Random(args.seed + 1)
+    start = time.perf_counter()
+    for seq,letter,size in make_frames(args):
+        if rate:
+            delay = start + sent_bytes / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        payload = 'seq={} t={:.6f} '.format(seq, time.time())
+        frame = encode_frame(letter, payload + 'x' * max(0, size - len(payload)),
+                             args.framing)
+        if noise.random() < args.noise:
+            frame = bytes(noise.randrange(256) for i in
+                          range(noise.randint(1, 64))) + frame
+        try:
+            written = os.write(master, frame)
+        except BlockingIOError:
+            overrun += 1
+            continue
+        # Don't break the frame in the middle
+        while written < len(frame):
+            try:
+                written += os.write(master, frame[written:])
+            except BlockingIOError:
+                time.sleep(0.0001)
+        sent += 1
+        sent_bytes += len(frame)
+    return sent,overrun,time.perf_counter() - start
+
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[index]
+
+
+
+def run_logger(args, send):
+    """
+    Start the logger against a pty, pass the traffic written by send(master,
+    args) (returns sent,overrun,duration like send_frames()) and stop the
+    logger with 'end'
+
+    returns:
+        (sent,overrun,send_duration,send_end),LogTail,exit_code,rusage
+        (exit_code is 'reboot' if the logger has requested a reboot)
+    """
+    root = tempfile.mkdtemp(prefix='uartlog-bench-', dir=args.dir)
+    try:
+        mountpoint = os.path.join(root, 'mnt')
+        drive_dir = os.path.join(mountpoint, 'LOGS')
+        workdir = os.path.join(root, 'work')
+        os.makedirs(mountpoint)
+        os.makedirs(workdir)
+
+        master,slave = pty.openpty()
+        tty.setraw(slave)
+        fcntl.fcntl(master, fcntl.F_SETFL,
+                    fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        config = {
+            'port': os.ttyname(slave),
+            'baud': args.baud,
+            'mountpoint': mountpoint,
+            'workdir': workdir,
+            'settings': args.settings
+        }
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--child', json.dumps(config)],
+                                 stdout=None if args.verbose else
+                                        subprocess.DEVNULL,
+                                 stderr=None if args.verbose else
+                                        subprocess.DEVNULL)
+
+        tail = LogTail(drive_dir)
+        tail.start()
+        # Wait for the port to be opened by the logger (the startup itself is
+        # not a part of the measurement)
+        deadline = time.monotonic() + args.startup_timeout
+        while not tail.offsets and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        sent,overrun,send_duration = send(master, args)
+        send_end = time.time()
+        fcntl.fcntl(master, fcntl.F_SETFL,
+                    fcntl.fcntl(master, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        os.write(master, b'end\r')
+
+        try:
+            pid,status,rusage = os.wait4(child.pid, 0) if args.timeout is None\
+                                else wait_with_timeout(child, args.timeout)
+            exit_code = os.waitstatus_to_exitcode(status)
+            child.returncode = exit_code
+        except TimeoutError:
+            child.kill()
+            pid,status,rusage = os.wait4(child.pid, 0)
+            exit_code = 'timeout'
+        if os.path.exists(os.path.join(workdir, 'simulation', 'reboots.txt')):
+            exit_code = 'reboot'
+        tail.stop()
+        os.close(master)
+        os.close(slave)
+        return (sent, overrun, send_duration, send_end),tail,exit_code,rusage
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+
+def run(args):
+    (sent,overrun,send_duration,send_end),tail,exit_code,rusage =\
+        run_logger(args, send_frames)
+    latencies = sorted(tail.latencies.values())
+    logged = len(latencies)
+    first_log = send_end - send_duration
+    duration = (tail.last_seen - first_log) if tail.last_seen else None
+    cpu = rusage.ru_utime + rusage.ru_stime
+    return {
+        'baud': args.baud,
+        'messages': args.messages,
+        'size': '{}-{}'.format(*args.size),
+        'levels': ','.join('{}={:g}'.format(*level) for level in args.levels),
+        'settings': dict(args.settings),
+        'framing': args.framing,
+        'noise': args.noise,
+        'sent_frames': sent,
+        'overrun_frames': overrun,
+        'logged_frames': logged,
+        'dropped_frames': sent - logged,
+        'offered_frames_per_s': round(sent / send_duration, 1),
+        'frames_per_s': round(logged / duration, 1) if duration else None,
+        'latency_ms': {
+            name: None if percentile(latencies, q) is None else
+                  round(percentile(latencies, q) * 1000, 3)
+            for name,q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                           ('max', 1.0))
+        },
+        'cpu_s': round(cpu, 3),
+        'cpu_us_per_message': round(cpu / max(logged, 1) * 1e6, 2),
+        'max_rss_kb': rusage.ru_maxrss,
+        'exit_code': exit_code
+    }
+
+
+
+def wait_with_timeout(child, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pid,status,rusage = os.wait4(child.pid, os.WNOHANG)
+        if pid:
+            return pid,status,rusage
+        time.sleep(0.01)
+    raise TimeoutError
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        child_main(json.loads(sys.argv[2]))
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--baud', type=int, default=115200,
+                        help="pace of the traffic (0 - as fast as possible)")
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--size', type=parse_size, default=(16, 120),
+                        help="message length or min-max range (default: 16-120)")
+    parser.add_argument('--levels', type=parse_levels,
+                        default=parse_levels('D=50,I=30,W=15,E=4,C=1'),
+                        help="level mix (default: D=50,I=30,W=15,E=4,C=1)")
+    parser.add_argument('--framing', choices=('text', 'crc'), default='text')
+    parser.add_argument('--noise', type=float, default=0,
+                        help="probability of a burst of random bytes before a "
+                             "frame")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', dest='settings', type=parse_setting,
+                        action='append', default=[], metavar='NAME=VALUE',
+                        help="override a setting of miscs.py")
+    parser.add_argument('--dir', default='/dev/shm' if os.path.isdir('/dev/shm')
+                                 else None,
+                        help="tmpfs directory for the drive (default: /dev/shm)")
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--timeout', type=float, default=120,
+                        help="time to wait for the logger to finish")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the output of the logger")
+    args = parser.parse_args()
+    if args.framing == 'crc':
+        args.settings.append(('uart_framing', 'crc'))
+
+    print(json.dumps(run(args)))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the preallocated log file. Writes the same stream of formatted log
+lines through the plain file of CustomFileHandler (LineStream) and through
+PreallocatedStream with commits (flush + fsync) every N lines, and reports the
+sustained write rate and the commit (fsync) latency percentiles. 'prealloc' is
+the stream as the logger opens it (FALLOC_FL_KEEP_SIZE extents on vfat),
+'fallocate' always allocates extents by posix_fallocate(): on vfat it shows the
+cost of zero-filling them. Run it on the target Pi against the USB drive, the
+difference is in the metadata updates of the file system so tmpfs shows
+nothing:
+
+    python3 benchmarks/bench_prealloc.py --dir /mnt/LOGS --commit-every 1 10 50
+
+Results are printed as JSON lines, one per method and commit interval.
+"""
+
+import os, sys, json, time, argparse
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'raspberrypi-uart-logger'))
+from fastformat import LineStream
+from prealloc import PreallocatedStream
+from bench_compression import generate_lines
+
+
+
+def percentile(values, q):
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[index]
+
+
+
+def run(method, lines, args, commit_every):
+    filename = os.path.join(args.dir, 'bench-{}.txt'.format(method))
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    if method == 'plain':
+        stream = LineStream(filename)
+    else:
+        stream = PreallocatedStream(filename, args.extent, args.erase_block,
+                                    args.page,
+                                    keep_size=False if method == 'fallocate'
+                                              else None)
+
+    commits = []
+    wall_start = time.perf_counter()
+    for i,line in enumerate(lines, 1):
+        stream.write(line)
+        if i % commit_every == 0 or i == len(lines):
+            started = time.perf_counter()
+            stream.flush()
+            os.fsync(stream.fileno())
+            commits.append(time.perf_counter() - started)
+    wall = time.perf_counter() - wall_start
+    stream.close()
+
+    bytes_in = sum(len(line.encode('utf-8')) for line in lines)
+    size = os.path.getsize(filename)
+    os.remove(filename)
+    commits.sort()
+    return {
+        'method': method,
+        'messages': len(lines),
+        'commit_every': commit_every,
+        'bytes': bytes_in,
+        'file_size': size,
+        'lines_per_s': round(len(lines) / wall, 1),
+        'mb_per_s': round(bytes_in / wall / 1e6, 3),
+        'commit_ms': {name: round(percentile(commits, q) * 1000, 3)
+                      for name,q in (('p50', 0.5), ('p99', 0.99),
+                                     ('max', 1.0))}
+    }
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--dir', default='.',
+                        help="directory on the drive under test")
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--commit-every', type=int, nargs='+', default=[1, 50],
+                        help="lines per commit")
+    parser.add_argument('--extent', type=int, default=4*1024*1024,
+                        help="preallocation extent (bytes)")
+    parser.add_argument('--erase-block', type=int, default=128*1024,
+                        help="erase block of the flash (bytes)")
+    parser.add_argument('--page', type=int, default=4096,
+                        help="write page (bytes)")
+    args = parser.parse_args()
+
+    lines = generate_lines(args.messages)
+    for commit_every in args.commit_every:
+        for method in ('plain', 'prealloc', 'fallocate'):
+            print(json.dumps(run(method, lines, args, commit_every)))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Replay of a raw UART capture (raw_capture = True, see rawcapture.py) through
+the framing and parsing code, to debug and benchmark the parser on the
+real-world traffic. Works on any Linux machine:
+
+    python3 benchmarks/replay_capture.py uartraw.raw --speed 0
+    python3 benchmarks/replay_capture.py uartraw.raw --print > uartlog.txt
+    python3 benchmarks/replay_capture.py uartraw.raw --target pty --speed 1
+
+--target process (default) feeds chunks straight into the Framer in this
+process, counts frames of every kind and reports the parsing throughput. With
+--print the log lines are printed as the logger would write them, with the
+original arrival times. --target pty runs the whole logger against a pty the
+same way as bench_logger.py does and reports lines written to the log and CPU
+time.
+
+--speed 1 keeps the original pauses between chunks, 2 is twice as fast and so
+on, 0 is as fast as possible. Settings of miscs.py can be overridden with --set
+name=value (e.g. --set uart_framing="'crc'"). The result is printed as one JSON
+line (to stderr with --print).
+"""
+
+import os, sys, json, time, logging, argparse, collections
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'raspberrypi-uart-logger'))
+
+from bench_logger import parse_setting, run_logger
+from rawcapture import read_capture
+
+
+
+def paced(chunks, speed):
+    """
+    Yield (created,data) chunks at their original pace divided by speed (0 -
+    without pauses)
+    """
+    start = None
+    for created,data in chunks:
+        if speed:
+            if start is None:
+                start = (time.perf_counter(), created)
+            delay = start[0] + (created - start[1]) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield created,data
+
+
+
+def replay_in_process(chunks, args):
+    import miscs
+    for name,value in args.settings:
+        setattr(miscs, name, value)
+    # Settings are copied by 'from miscs import *' so modules are imported
+    # after the patching
+    import framing
+    from fastformat import FastFormatter
+
+    framer = framing.Framer()
+    formatter = FastFormatter(miscs.log_formatter_string,
+                              resolution=miscs.log_time_resolution)
+    output = sys.stdout.buffer
+    kinds = {framing.FRAME: 'frames', framing.EMPTY_FRAME: 'empty_frames',
+             framing.TOO_LONG_FRAME: 'too_long_frames',
+             framing.CORRUPT_FRAME: 'corrupt_frames'}
+    counts = collections.Counter()
+    levels = collections.Counter()
+    received = 0
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for created,data in paced(chunks, args.speed):
+        received += len(data)
+        # The original arrival time of the chunk, so frames get the stamps
+        # they had in the logger
+        for kind,frame,arrival in framer.feed(data, (created, created)):
+            counts[kinds[kind]] += 1
+            if kind != framing.FRAME:
+                continue
+            levelno = framing.frame_level(frame)
+            if levelno is None:
+                if frame not in framing.service_frames:
+                    counts['undefined_frames'] += 1
+                continue
+            payload,decode_error = framing.frame_payload(frame)
+            if decode_error is not None:
+                counts['decode_errors'] += 1
+            levels[logging.getLevelName(levelno)] += 1
+            if args.print:
+                output.write(formatter.format_bytes(levelno, arrival[0],
+                                                    payload))
+    duration = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    if args.print:
+        output.flush()
+
+    return dict({
+        'bytes': received,
+        'frames': 0,
+        'empty_frames': 0,
+        'too_long_frames': 0,
+        'corrupt_frames': 0,
+        'undefined_frames': 0,
+        'decode_errors': 0
+    }, **counts, levels=dict(levels), unfinished_bytes=len(framer.reset()),
+       duration_s=round(duration, 3),
+       mb_per_s=round(received / duration / 1e6, 3) if duration else None,
+       cpu_us_per_frame=round(cpu / max(counts['frames'], 1) * 1e6, 3))
+
+
+
+def send_capture(chunks, speed, stall_timeout=5):
+    """
+    send() of run_logger() writing the capture into the pty. Nothing is
+    dropped: writes wait while the pty is full (but not longer than
+    stall_timeout, e.g. if the capture has 'end' in it and the logger is gone)
+    """
+    def send(master, args):
+        sent = 0
+        start = time.perf_counter()
+        for created,data in paced(chunks, speed):
+            written = 0
+            stalled = time.monotonic()
+            while written < len(data):
+                try:
+                    written += os.write(master, data[written:])
+                    stalled = time.monotonic()
+                except BlockingIOError:
+                    if time.monotonic() - stalled > stall_timeout:
+                        return sent,0,time.perf_counter() - start
+                    time.sleep(0.0001)
+            sent += 1
+        return sent,0,time.perf_counter() - start
+    return send
+
+
+
+def replay_pty(chunks, args):
+    (sent,overrun,send_duration,send_end),tail,exit_code,rusage =\
+        run_logger(args, send_capture(chunks, args.speed))
+    cpu = rusage.ru_utime + rusage.ru_stime
+    return {
+        'settings': dict(args.settings),
+        'bytes': sum(len(data) for created,data in chunks[:sent]),
+        'sent_chunks': sent,
+        'logged_lines': tail.lines,
+        'send_duration_s': round(send_duration, 3),
+        'cpu_s': round(cpu, 3),
+        'cpu_us_per_line': round(cpu / max(tail.lines, 1) * 1e6, 2),
+        'max_rss_kb': rusage.ru_maxrss,
+        'exit_code': exit_code
+    }
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('capture', help="raw capture file")
+    parser.add_argument('--target', choices=('process', 'pty'),
+                        default='process')
+    parser.add_argument('--speed', type=float, default=0,
+                        help="1 - the original pace, 0 - as fast as possible")
+    parser.add_argument('--print', action='store_true',
+                        help="print log lines (process target)")
+    parser.add_argument('--set', dest='settings', type=parse_setting,
+                        action='append', default=[], metavar='NAME=VALUE',
+                        help="override a setting of miscs.py")
+    parser.add_argument('--dir', default='/dev/shm' if os.path.isdir('/dev/shm')
+                                 else None,
+                        help="tmpfs directory for the drive (pty target)")
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--timeout', type=float, default=120,
+                        help="time to wait for the logger to finish")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the output of the logger")
+    args = parser.parse_args()
+    # The pty doesn't care, the logger only needs some baud rate
+    args.baud = 0
+
+    # Loaded up front so the file reading isn't measured
+    try:
+        chunks = list(read_capture(args.capture))
+    except (OSError, ValueError) as e:
+        sys.exit(e)
+    if args.target == 'pty':
+        result = replay_pty(chunks, args)
+    else:
+        result = replay_in_process(chunks, args)
+    result = dict({'capture': args.capture, 'target': args.target,
+                   'speed': args.speed, 'chunks': len(chunks)}, **result)
+    print(json.dumps(result), file=sys.stderr if args.print else sys.stdout)
@@ -1,6 +1,42 @@
 #include "logging.h"
 
 
+#if LOG_FRAMED
+/*
+ *  CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF)
+ */
+static uint16_t log_crc16(const uint8_t *data, int size, uint16_t crc) {
+	for (int i=0; i<size; i++) {
+		crc ^= (uint16_t)data[i] << 8;
+		for (int bit=0; bit<8; bit++) {
+			crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+		}
+	}
+	return crc;
+}
+#endif
+
+
+/*
+ *  Send a message as a frame of the chosen type
+ */
+static void log_transmit(char *msg, int size) {
+#if LOG_FRAMED
+	uint8_t header[3] = { LOG_FRAME_START, (uint8_t)(size >> 8), (uint8_t)size };
+	uint16_t crc = log_crc16(&header[1], 2, 0xFFFF);
+	crc = log_crc16((uint8_t *)msg, size, crc);
+	uint8_t trailer[2] = { (uint8_t)(crc >> 8), (uint8_t)crc };
+
+	HAL_UART_Transmit(&huart1, header, 3, LOG_USART_TIMEOUT);
+	HAL_UART_Transmit(&huart1, (uint8_t *)msg, size, LOG_USART_TIMEOUT);
+	HAL_UART_Transmit(&huart1, trailer, 2, LOG_USART_TIMEOUT);
+#else
+	HAL_UART_Transmit(&huart1, (uint8_t *)msg, size, LOG_USART_TIMEOUT);
+	HAL_UART_Transmit(&huart1, (uint8_t *)"\r", 1, LOG_USART_TIMEOUT);
+#endif
+}
+
+
 int log_usart(char *log_msg, int msg_type) {
 	char msg_type_char = 'u';
 
@@ -22,12 +58,12 @@ int log_usart(char *log_msg, int msg_type) {
 		break;
 	}
 
-	int log_msg_size = snprintf(log_buf, LOG_BUF_SIZE, "%c %s\r", msg_type_char, log_msg);
-	if ((log_msg_size<0) || (log_msg_size>LOG_BUF_SIZE)) {
+	int log_msg_size = snprintf(log_buf, LOG_BUF_SIZE, "%c %s", msg_type_char, log_msg);
+	if ((log_msg_size<0) || (log_msg_size>=LOG_BUF_SIZE)) {
 		return -1;
 	}
 
-	HAL_UART_Transmit(&huart1, log_buf, log_msg_size, LOG_USART_TIMEOUT);
+	log_transmit(log_buf, log_msg_size);
 
 	return 0;
 }
@@ -37,7 +73,7 @@ int log_usart(char *log_msg, int msg_type) {
  *  Call this function with timer
  */
 void log_usart_is_present(void) {
-	HAL_UART_Transmit(&huart1, "is_present\r", 11, LOG_USART_TIMEOUT);
+	log_transmit("is_present", 10);
 }
 
 
@@ -45,5 +81,5 @@ void log_usart_is_present(void) {
  *  Shutdown remote logging program
  */
 void log_logging_shutdown(void) {
-	HAL_UART_Transmit(&huart1, "end\r", 4, LOG_USART_TIMEOUT);
+	log_transmit("end", 3);
 }
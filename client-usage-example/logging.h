@@ -4,6 +4,7 @@
 
 
 #include <stdio.h>
+#include <stdint.h>
 #include "usart.h"
 
 
@@ -13,6 +14,9 @@
 #define LOG_BUF_SIZE 100  // in bytes
 extern UART_HandleTypeDef huart1;
 #define LOG_USART_TIMEOUT 0xFFFF
+// 1 - send CRC-checked frames (set uart_framing = 'crc' in the logger),
+// 0 - plain text ones ("X message\r")
+#define LOG_FRAMED 0
 /*
  *  END edit these parameters to match your app
  */
@@ -21,6 +25,11 @@ extern UART_HandleTypeDef huart1;
 char log_buf[LOG_BUF_SIZE];
 
 
+// CRC-checked frame: start marker, length (2 bytes, big-endian), message,
+// CRC-16/CCITT-FALSE of the length and the message (2 bytes, big-endian)
+#define LOG_FRAME_START 0x02
+
+
 enum log_msg_type {
 	LOG_DEBUG,
 	LOG_INFO,
@@ -7,10 +7,29 @@ here = os.path.abspath(os.path.dirname(__file__))
 package_name = 'raspberrypi-uart-logger'
 service_name = 'logger.service'
 mountpoint = '/mnt/LOGS'
-installation_files = [ 'logger.py',
+installation_files = [ 'aiocore.py',
+                       'backends.py',
+                       'blockdevices.py',
+                       'binlog.py',
+                       'commitpolicy.py',
+                       'compression.py',
+                       'drivemonitor.py',
+                       'fastformat.py',
+                       'framefilter.py',
+                       'framing.py',
+                       'logger.py',
+                       'metrics.py',
                        'miscs.py',
+                       'prealloc.py',
+                       'publisher.py',
+                       'rawcapture.py',
+                       'spool.py',
                        'startup_script.sh',
-                       'usbdriveroutine.py' ]
+                       'uartlogcat.py',
+                       'uarttail.py',
+                       'usbdriveroutine.py',
+                       'workers.py',
+                       'writer.py' ]
 dependencies = [ 'python3-termcolor',
                  'python3-serial',
                  'python3-rpi.gpio' ]
@@ -0,0 +1,229 @@
+"""
+Module with the asyncio core that serves several serial ports at once (e.g. 3-4
+boards connected through USB-UART converters). Every port configured in
+serial_ports gets its own reader coroutine with its own framing state, presence
+(no-ping) tracking and output file, while all of them share one event loop and
+one LogWriter thread.
+
+Failures are handled per port: a silent target, a broken port or a garbage
+burst lead to the reconnection of this port only instead of the reboot of the
+whole system.
+"""
+
+import asyncio, logging
+from miscs import *
+from framing import *
+from framefilter import FrameFilter
+from rawcapture import RawCapture, capture_suffix
+import metrics
+
+
+
+class PortReader:
+    """
+    Reader of a single serial port. Frames and diagnostic messages go to the
+    output channel with the index source.
+    """
+
+    def __init__(self, source, config, log_writer):
+        self.source = source
+        self.name = config['name']
+        self.log_writer = log_writer
+
+        # Non-blocking reads, the readiness is reported by the event loop
+        self.ser = hardware().serial_port(config['port'],
+                                          config.get('baudrate', uart_baudrate),
+                                          0)
+        self.ping_timeout = config.get('timeout', uart_timeout)
+
+        self.framer = Framer()
+        self.filter = FrameFilter(self.log)
+        self.capture = None
+        if raw_capture:
+            self.capture = RawCapture(os.path.join(raw_capture_dir,
+                'uartraw-{}{}'.format(self.name, capture_suffix)),
+                raw_capture_max_size)
+        self.no_ping_counter = 0
+        self.finished = False
+
+    def log(self, levelno, msg, created=None, received=None):
+        self.log_writer.log(levelno, msg, self.source, created, received)
+
+    async def run(self):
+        """
+        Serve the port until the target sends 'end'. Every failure leads to the
+        reconnection of this port only
+        """
+        while not self.finished:
+            try:
+                await self.connect()
+                await self.read_loop()
+            # serial.SerialException is an OSError as well
+            except OSError as e:
+                metrics.uart_read_errors.inc()
+                last_words = self.framer.reset().decode('utf-8', 'replace')
+                self.log(logging.ERROR, "{}. His last words were (raw): {}. "
+                         "Reconnect after {} seconds".format(e,
+                            "''" if last_words=='' else last_words,
+                            usart_reconnect_retry_time))
+                self.ser.close()
+                await asyncio.sleep(usart_reconnect_retry_time)
+        self.ser.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    async def connect(self):
+        """
+        Counterpart of usart_connect() that never gives up (and never reboots)
+        """
+        usart_reconnect_counter = 0
+        while not self.ser.is_open:
+            try:
+                self.ser.open()
+            except Exception as e:
+                usart_reconnect_counter += 1
+                self.log(logging.ERROR, "{}. Reconnect after {} seconds"
+                         .format(e, usart_reconnect_retry_time))
+                await asyncio.sleep(usart_reconnect_retry_time)
+            else:
+                self.log(logging.INFO, "Host now listening to {} (established "
+                         "in {} tries)".format(self.ser.name,
+                                               usart_reconnect_counter+1))
+                startup_milestone('serial_port')
+        self.no_ping_counter = 0
+
+    async def read_loop(self):
+        loop = asyncio.get_running_loop()
+        data_ready = asyncio.Event()
+        fd = self.ser.fileno()
+        loop.add_reader(fd, data_ready.set)
+        try:
+            while not self.finished:
+                try:
+                    await asyncio.wait_for(data_ready.wait(), self.ping_timeout)
+                except asyncio.TimeoutError:
+                    metrics.uart_timeouts.inc()
+                    if not self.timeout():
+                        # The target is silent for too long: reopen the port
+                        self.ser.close()
+                        return
+                    continue
+                data_ready.clear()
+                # Raises OSError if the device has gone (the zero timeout
+                # skips spurious wakeups)
+                received = self.framer.read_from(fd, 0)
+                if received:
+                    self.no_ping_counter = 0
+                    startup_milestone('first_byte')
+                    metrics.uart_bytes.inc(received)
+                    if self.capture is not None:
+                        self.capture.write(self.framer.chunk,
+                                           self.framer.read_time[1])
+                    self.process_frames(self.framer.frames())
+        finally:
+            loop.remove_reader(fd)
+
+    def timeout(self):
+        """
+        returns:
+            False if no_ping_tries are exhausted
+        """
+        self.no_ping_counter += 1
+        self.filter.flush()
+        if self.capture is not None:
+            self.capture.flush()
+        if self.no_ping_counter > no_ping_tries:
+            self.log(logging.ERROR, "Target is not present for {} seconds, "
+                     "reconnect".format(self.ping_timeout * no_ping_tries))
+            return False
+        if not self.framer.pending:
+            self.log(logging.ERROR,
+                     "Target is not present. Wait for {} seconds, {} tries left"
+                     .format(self.ping_timeout,
+                             no_ping_tries - self.no_ping_counter))
+        else:
+            # A start marker from the noise doesn't hold the frames behind it
+            events = self.framer.expire()
+            if events is not None:
+                self.process_frames(events)
+            else:
+                self.log(logging.ERROR,
+                         "Transmission failed. His last words were (raw): {}. "
+                         "New waiting timeout: {} seconds"
+                         .format(self.framer.reset().decode('utf-8', 'replace'),
+                                 self.ping_timeout))
+        return True
+
+    def process_frames(self, events):
+        for kind,frame,arrival in events:
+            if kind == CORRUPT_FRAME:
+                metrics.uart_corrupt_frames.inc()
+                continue
+
+            # A garbage burst costs only this frame (no sleep, no reboot)
+            if kind == TOO_LONG_FRAME:
+                metrics.uart_too_long_frames.inc()
+                self.log(logging.WARNING, "Message is too long")
+                continue
+
+            if kind == EMPTY_FRAME:
+                metrics.uart_empty_frames.inc()
+                self.log(logging.WARNING, "Empty message: '{}'"
+                         .format(repr(b'\r')))
+                continue
+
+            metrics.uart_frames.inc()
+            self.process_message(frame, arrival)
+
+    def process_message(self, frame, arrival):
+        levelno = frame_level(frame)
+        if levelno is not None:
+            payload,decode_error = frame_payload(frame)
+            if decode_error is not None:
+                metrics.uart_decode_errors.inc()
+                self.log(logging.WARNING, "{}".format(decode_error))
+            self.filter.log(levelno, payload, *arrival)
+        elif frame == b'is_present':
+            reset_reboots_cnt_once()
+        elif frame == b'end':
+            self.filter.flush(final=True)
+            self.log(logging.INFO, "Port is closed by the target")
+            self.finished = True
+        else:
+            self.log(logging.WARNING, "Undefined message: {}"
+                     .format(repr(frame_text(frame))))
+
+
+
+reboots_cnt_cleared = False
+
+def reset_reboots_cnt_once():
+    """
+    Any alive target proves the system is fine: cancel a planned reboot and
+    clear the reboots counter (once per program run)
+    """
+    global reboots_cnt_cleared
+    if not reboots_cnt_cleared:
+        hardware().cancel_reboot()
+        reset_reboots_cnt()
+        reboots_cnt_cleared = True
+        print('Reboots counter was cleared')
+
+
+
+def port_log_filenames(ports, log_filename):
+    """
+    Output file of every port: 'uartlog.txt' -> 'uartlog-<name>.txt'
+    """
+    stem,dot,ext = log_filename.partition('.')
+    return ['{}-{}{}{}'.format(stem, port['name'], dot, ext) for port in ports]
+
+
+
+async def serve_ports(log_writer, ports):
+    """
+    Run readers of all ports in one event loop until every target sends 'end'
+    """
+    readers = [PortReader(source, config, log_writer)
+               for source,config in enumerate(ports)]
+    await asyncio.gather(*(reader.run() for reader in readers))
@@ -0,0 +1,285 @@
+"""
+Module with hardware backends: everything the logger does to the system it
+runs on (opens the serial ports, drives the LED, mounts and formats drives,
+reboots) goes through one of them, see hardware_backend and hardware() in
+miscs.py.
+
+ - RaspberryPiBackend is the real thing: pyserial, RPi.GPIO, 'sudo mount',
+   'sudo mkdosfs' and 'sudo reboot'
+ - SimulatedBackend runs the whole logger on any Linux machine (a development
+   box, a CI runner) to debug and profile it off the device: a serial port is
+   a pty, the LED is a no-op, drives are directories, mounts are symlinks and
+   reboots are recorded instead of executed
+
+pyserial and RPi.GPIO are imported by RaspberryPiBackend on the first use, the
+module itself depends on the standard library only.
+"""
+
+import os, pty, tty, time, shutil, termios, subprocess
+from blockdevices import BlockDevice, plugged_drives
+
+
+
+class RaspberryPiBackend:
+
+    # Drives are real block devices (so DriveMonitor can watch them)
+    block_devices = True
+
+    def __init__(self, led_gpio, sysroot='/'):
+        self.led_gpio = led_gpio
+        self.sysroot = sysroot
+        self.gpio = None
+
+    def serial_port(self, port, baudrate, timeout):
+        """
+        returns:
+            serial.Serial that is not opened yet
+        """
+        import serial
+        ser = serial.Serial()
+        ser.port = port
+        ser.baudrate = baudrate
+        ser.timeout = timeout
+        return ser
+
+    def led(self, on):
+        if self.gpio is None:
+            import RPi.GPIO as GPIO
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(self.led_gpio, GPIO.OUT)
+            self.gpio = GPIO
+        self.gpio.output(self.led_gpio, on)
+
+    def plugged_drives(self, possible_drives):
+        return plugged_drives(possible_drives, self.sysroot)
+
+    def device_path(self, name):
+        return '/dev/{}'.format(name)
+
+    def run(self, command):
+        rslt = subprocess.run(command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        # Suppress command output while there is no error
+        if rslt.returncode != 0:
+            print(rslt.stderr.decode('utf-8'))
+
+    def mount(self, device, mountpoint):
+        self.run(['sudo', 'mount', '-t', 'vfat', '-ouser,umask=0000', device,
+                  mountpoint])
+
+    def unmount(self, target):
+        """
+        target is a device or a mountpoint
+        """
+        self.run(['sudo', 'umount', target])
+
+    def format(self, device, label):
+        self.run(['sudo', 'mkdosfs', '-F', '32', '-I', device, '-n', label])
+
+    def reboot(self, delay=None):
+        """
+        delay is in minutes, None - reboot right now
+        """
+        if delay is None:
+            subprocess.run(['sudo', 'reboot'])
+        else:
+            subprocess.run(['sudo', 'shutdown', '-r', '+{}'.format(delay)])
+
+    def cancel_reboot(self):
+        subprocess.run(['sudo', 'shutdown', '-c'])
+
+
+
+class SimulatedSerial:
+    """
+    Stands for serial.Serial (the part of it the logger uses). A port that
+    exists (e.g. a pty of a test or a USB-UART converter) is opened as it is,
+    otherwise a pty is created and its other end is linked as directory/<port
+    name> (e.g. ttyAMA0): the traffic of the target is written there
+    """
+
+    def __init__(self, port, baudrate, timeout, directory):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.directory = directory
+        self.fd = None
+        # The other end of the created pty is kept open so the port doesn't
+        # fail when a writer goes away
+        self.peer = None
+        self.link = None
+
+    @property
+    def is_open(self):
+        return self.fd is not None
+
+    @property
+    def name(self):
+        return self.port if self.link is None else self.link
+
+    def open(self):
+        if self.fd is not None:
+            return
+        if os.path.exists(self.port):
+            self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY |
+                                         os.O_NONBLOCK)
+            if os.isatty(self.fd):
+                self.configure(self.fd)
+            return
+        self.fd,self.peer = pty.openpty()
+        os.set_blocking(self.fd, False)
+        # No echo and no CR/LF translations for the target
+        self.configure(self.peer)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.link = os.path.join(self.directory,
+                                     os.path.basename(self.port))
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(os.ttyname(self.peer), self.link)
+        except OSError:
+            self.close()
+            raise
+
+    def configure(self, fd):
+        """
+        Raw mode and the baud rate (if the terminal knows it, a pty doesn't
+        care anyway)
+        """
+        tty.setraw(fd)
+        speed = getattr(termios, 'B{}'.format(self.baudrate), None)
+        if speed is not None:
+            attributes = termios.tcgetattr(fd)
+            attributes[4] = attributes[5] = speed
+            termios.tcsetattr(fd, termios.TCSANOW, attributes)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        for fd in (self.fd, self.peer):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.peer = None
+        if self.link is not None:
+            try:
+                os.remove(self.link)
+            except OSError:
+                pass
+            self.link = None
+
+
+
+class SimulatedBackend:
+    """
+    Lives in directory:
+
+        drives/<name>  a drive (named as possible_drives, e.g. sda1), mkdir or
+                       rm/mv it to plug or pull the drive. Its label is kept in
+                       the .label file in it
+        <port name>    the target side of a simulated serial port
+        reboots.txt    requested reboots, one per line
+
+    A drive is mounted as a symlink at the mountpoint, mounts are forgotten
+    when the program exits (like on the reboot). If the drives directory
+    doesn't exist yet it's created with default_drive plugged
+    """
+
+    block_devices = False
+
+    def __init__(self, directory, default_drive=None):
+        self.directory = os.path.abspath(directory)
+        self.drives_dir = os.path.join(self.directory, 'drives')
+        self.reboots_filename = os.path.join(self.directory, 'reboots.txt')
+        # mountpoint -> drive name
+        self.mounts = {}
+        self.led_on = False
+        if not os.path.isdir(self.drives_dir):
+            os.makedirs(self.drives_dir)
+            if default_drive is not None:
+                os.mkdir(os.path.join(self.drives_dir, default_drive))
+        print('Simulated hardware is in {}'.format(self.directory))
+
+    def serial_port(self, port, baudrate, timeout):
+        return SimulatedSerial(port, baudrate, timeout, self.directory)
+
+    def led(self, on):
+        self.led_on = on
+
+    def plugged_drives(self, possible_drives):
+        drives = []
+        for name in possible_drives:
+            path = self.device_path(name)
+            if not os.path.isdir(path):
+                continue
+            try:
+                with open(os.path.join(path, '.label')) as label_file:
+                    label = label_file.read().strip() or None
+            except OSError:
+                label = None
+            drives.append(BlockDevice(
+                name=name,
+                disk=name.rstrip('0123456789'),
+                removable=True,
+                size=shutil.disk_usage(path).total,
+                dev=None,
+                mountpoints=[mountpoint for mountpoint,mounted in
+                             self.mounts.items() if mounted == name and
+                             os.path.islink(mountpoint)],
+                fstype=None if label is None else 'vfat',
+                label=label))
+        return drives
+
+    def device_path(self, name):
+        return os.path.join(self.drives_dir, name)
+
+    def mount(self, device, mountpoint):
+        try:
+            # The mountpoint directory itself is replaced by the symlink
+            if os.path.isdir(mountpoint) and not os.path.islink(mountpoint):
+                os.rmdir(mountpoint)
+            os.symlink(device, mountpoint)
+            self.mounts[os.path.normpath(mountpoint)] = os.path.basename(device)
+        except OSError as e:
+            print('mount: {}'.format(e))
+
+    def unmount(self, target):
+        target = os.path.normpath(target)
+        for mountpoint,name in list(self.mounts.items()):
+            if target in (mountpoint, self.device_path(name)):
+                del self.mounts[mountpoint]
+                if os.path.islink(mountpoint):
+                    os.remove(mountpoint)
+                return
+        print('umount: {}: not mounted'.format(target))
+
+    def format(self, device, label):
+        try:
+            for name in os.listdir(device):
+                path = os.path.join(device, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            with open(os.path.join(device, '.label'), 'w') as label_file:
+                label_file.write(label + '\n')
+        except OSError as e:
+            print('mkdosfs: {}'.format(e))
+
+    def record(self, event):
+        print('Simulated {}'.format(event))
+        try:
+            with open(self.reboots_filename, 'a') as reboots_file:
+                reboots_file.write('{} {}\n'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S'), event))
+        except OSError as e:
+            print(e)
+
+    def reboot(self, delay=None):
+        self.record('reboot' if delay is None else
+                    'reboot in {} minutes'.format(delay))
+
+    def cancel_reboot(self):
+        # The program exits right after a planned reboot is recorded so there
+        # is never one to cancel
+        pass
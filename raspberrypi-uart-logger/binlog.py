@@ -0,0 +1,187 @@
+"""
+Module with the compact binary log format. It is an optional replacement of the
+text log that allows to get a time range of messages without grepping through
+gigabytes of text.
+
+Log file (.bin):
+    b'UARTBIN1' magic, then records
+    <I length of payload> <d created (Unix time)> <B levelno> payload (UTF-8)
+
+Sparse index file (.bin.idx), written next to the log:
+    <d timestamp> <Q offset> entries, one per index_interval records. timestamp
+    is the running maximum of 'created' so the index is always sorted even if
+    some older frames were appended later (e.g. drained from the spool): all
+    records up to the one at the offset are not newer than the timestamp.
+
+The module depends on the standard library only so the reader (uartlogcat.py)
+can be used on any machine the drive is plugged in.
+"""
+
+import os, struct, bisect
+
+
+
+binlog_magic = b'UARTBIN1'
+binlog_suffix = '.bin'
+binlog_index_suffix = '.idx'
+
+record_header = struct.Struct('<IdB')
+index_entry = struct.Struct('<dQ')
+
+
+
+class BinaryStream:
+    """
+    Append-only writer of the binary log and its index. Like the text stream it
+    is flushed by CustomFileHandler on commits (the index is synced together
+    with the log).
+    """
+
+    def __init__(self, filename, index_interval=256):
+        self.index_interval = index_interval
+        self.index_filename = filename + binlog_index_suffix
+        self.index = read_index(self.index_filename)
+        self.max_created = self.index[-1][0] if self.index else float('-inf')
+
+        self.file = open(filename, 'ab')
+        self.offset = self.file.tell()
+        if self.offset == 0:
+            self.file.write(binlog_magic)
+            self.offset = len(binlog_magic)
+        else:
+            self.recover()
+        self.index_file = open(self.index_filename, 'ab')
+        self.records_till_index = 0
+
+    def recover(self):
+        """
+        Cut off a torn record at the end of the file (after a power cut). Only
+        the part after the last index entry needs to be scanned
+        """
+        start = self.index[-1][1] if self.index else len(binlog_magic)
+        if start > self.offset:
+            # The index is ahead of the log: forget such entries
+            self.index = [entry for entry in self.index if entry[1] <= self.offset]
+            start = self.index[-1][1] if self.index else len(binlog_magic)
+            with open(self.index_filename, 'wb') as index_file:
+                for entry in self.index:
+                    index_file.write(index_entry.pack(*entry))
+        valid_end = start
+        with open(self.file.name, 'rb') as f:
+            for levelno,created,msg,end in iter_records(f, start):
+                valid_end = end
+                self.max_created = max(self.max_created, created)
+        if valid_end != self.offset:
+            print('Binary log: cut off a torn tail of {}'.format(self.file.name))
+            self.file.truncate(valid_end)
+            self.file.seek(valid_end)
+            self.offset = valid_end
+
+    def write_record(self, levelno, created, msg):
+        """
+        returns:
+            number of written bytes
+        """
+        payload = msg.encode('utf-8') if isinstance(msg, str) else msg
+        self.max_created = max(self.max_created, created)
+        if self.records_till_index == 0:
+            self.index_file.write(index_entry.pack(self.max_created,
+                                                   self.offset))
+            self.records_till_index = self.index_interval
+        self.records_till_index -= 1
+        data = record_header.pack(len(payload), created, levelno) + payload
+        self.file.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def write(self, text):
+        raise TypeError('Binary log takes records only (use write_record())')
+
+    def flush(self):
+        self.file.flush()
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+            self.index_file.close()
+
+
+
+def read_index(index_filename):
+    """
+    returns:
+        list of (timestamp,offset) (torn last entry is ignored)
+    """
+    try:
+        with open(index_filename, 'rb') as index_file:
+            data = index_file.read()
+    except FileNotFoundError:
+        return []
+    count = len(data) // index_entry.size
+    return [index_entry.unpack_from(data, i * index_entry.size)
+            for i in range(count)]
+
+
+
+def iter_records(f, offset):
+    """
+    yields:
+        levelno,created,msg,offset_after_the_record
+    """
+    f.seek(offset)
+    while True:
+        header = f.read(record_header.size)
+        if len(header) < record_header.size:
+            return
+        length,created,levelno = record_header.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        offset += record_header.size + length
+        yield levelno,created,payload.decode('utf-8', 'replace'),offset
+
+
+
+def read_records(filename, since=None, until=None, min_level=0,
+                 exhaustive=False):
+    """
+    Read records of the time range [since, until] with levels not lower than
+    min_level. The sparse index is used to seek straight to the start of the
+    range. Records are appended in time order except frames drained from the
+    spool after an outage, so the reading stops at the first record newer than
+    until unless exhaustive is True.
+
+    yields:
+        levelno,created,msg
+    """
+    index = read_index(filename + binlog_index_suffix)
+    with open(filename, 'rb') as f:
+        if f.read(len(binlog_magic)) != binlog_magic:
+            raise ValueError('{} is not a binary log'.format(filename))
+
+        offset = len(binlog_magic)
+        if since is not None and index:
+            # Records up to the last entry with timestamp < since are all older
+            # than since
+            position = bisect.bisect_left([entry[0] for entry in index], since)
+            if position > 0:
+                offset = index[position-1][1]
+
+        for levelno,created,msg,end in iter_records(f, offset):
+            if since is not None and created < since:
+                continue
+            if until is not None and created > until:
+                if exhaustive:
+                    continue
+                return
+            if levelno >= min_level:
+                yield levelno,created,msg
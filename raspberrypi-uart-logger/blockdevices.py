@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Module that discovers block devices by reading the kernel interfaces directly
+instead of running lsblk: disks and their partitions come from /sys/block,
+mounts from /proc/self/mountinfo and filesystem labels from
+/dev/disk/by-label (or from the FAT boot sector itself). It costs a handful of
+small file reads, no forks.
+
+All paths are taken relative to sysroot so the discovery can be checked against
+a fixture directory tree that mimics these parts of a real system, e.g.:
+
+    python3 blockdevices.py /path/to/fixture/sysroot
+"""
+
+import os, sys, collections
+
+
+
+# size is in bytes, mountpoints is a list (a device can be mounted several
+# times), fstype/label are None if unknown
+BlockDevice = collections.namedtuple('BlockDevice',
+    'name disk removable size dev mountpoints fstype label')
+
+# Offsets of the FAT boot sector fields (see FAT specification)
+FAT32_FSTYPE = slice(82, 90)
+FAT32_LABEL = slice(71, 82)
+FAT16_FSTYPE = slice(54, 62)
+FAT16_LABEL = slice(43, 54)
+
+
+
+def read_sysfs(path, default=None):
+    try:
+        with open(path) as sysfs_file:
+            return sysfs_file.read().strip()
+    except OSError:
+        return default
+
+
+
+def unescape_mountinfo(field):
+    """
+    Spaces, tabs, newlines and backslashes are escaped as \\ooo (octal)
+    """
+    if '\\' not in field:
+        return field
+    return field.encode('utf-8').decode('unicode_escape').encode('latin-1')\
+                .decode('utf-8', 'replace')
+
+
+
+def read_mountinfo(sysroot='/'):
+    """
+    returns:
+        dict 'major:minor' -> list of (mountpoint,fstype,options) in order of
+        mounting
+    """
+    mounts = collections.defaultdict(list)
+    try:
+        with open(os.path.join(sysroot, 'proc/self/mountinfo')) as mountinfo:
+            for line in mountinfo:
+                fields = line.split()
+                # 'id parent major:minor root mountpoint options [optional...]
+                # - fstype source superoptions'
+                try:
+                    separator = fields.index('-', 6)
+                    mounts[fields[2]].append((unescape_mountinfo(fields[4]),
+                                              fields[separator+1], fields[5]))
+                except (ValueError, IndexError):
+                    continue
+    except OSError as e:
+        print(e)
+    return mounts
+
+
+
+def read_labels(sysroot='/'):
+    """
+    Labels published by udev in /dev/disk/by-label
+
+    returns:
+        dict device name -> label
+    """
+    labels = {}
+    by_label = os.path.join(sysroot, 'dev/disk/by-label')
+    try:
+        names = os.listdir(by_label)
+    except OSError:
+        return labels
+    for name in names:
+        try:
+            target = os.readlink(os.path.join(by_label, name))
+        except OSError:
+            continue
+        # udev escapes unsafe characters as \xNN
+        labels[os.path.basename(target)] = name.encode('utf-8')\
+            .decode('unicode_escape').encode('latin-1').decode('utf-8', 'replace')
+    return labels
+
+
+
+def read_fat_label(device_path):
+    """
+    Read the volume label straight from the FAT boot sector (when udev hasn't
+    published it yet or there is no udev at all)
+
+    returns:
+        label or None
+    """
+    try:
+        with open(device_path, 'rb') as device:
+            sector = device.read(512)
+    except OSError:
+        return None
+    if len(sector) < 512 or sector[510:512] != b'\x55\xaa':
+        return None
+    if sector[FAT32_FSTYPE].startswith(b'FAT32'):
+        label = sector[FAT32_LABEL]
+    elif sector[FAT16_FSTYPE].startswith(b'FAT'):
+        label = sector[FAT16_LABEL]
+    else:
+        return None
+    label = label.decode('ascii', 'replace').strip()
+    if label in ('', 'NO NAME'):
+        return None
+    return label
+
+
+
+def device_table(sysroot='/'):
+    """
+    Disks and partitions known to the kernel
+
+    returns:
+        dict name -> BlockDevice (e.g. 'sda' and 'sda1')
+    """
+    mounts = read_mountinfo(sysroot)
+    labels = read_labels(sysroot)
+    sys_block = os.path.join(sysroot, 'sys/block')
+    table = {}
+    try:
+        disks = os.listdir(sys_block)
+    except OSError as e:
+        print(e)
+        return table
+
+    for disk in disks:
+        disk_dir = os.path.join(sys_block, disk)
+        removable = read_sysfs(os.path.join(disk_dir, 'removable')) == '1'
+        entries = [(disk, disk_dir, None)]
+        try:
+            # Partitions are subdirectories with the 'partition' attribute
+            entries.extend((name, os.path.join(disk_dir, name), disk)
+                           for name in os.listdir(disk_dir)
+                           if os.path.exists(os.path.join(disk_dir, name,
+                                                          'partition')))
+        except OSError:
+            pass
+
+        for name,directory,parent in entries:
+            dev = read_sysfs(os.path.join(directory, 'dev'))
+            device_mounts = mounts.get(dev, [])
+            label = labels.get(name)
+            if label is None and parent is not None:
+                label = read_fat_label(os.path.join(sysroot, 'dev', name))
+            table[name] = BlockDevice(
+                name=name,
+                disk=parent or disk,
+                removable=removable,
+                size=int(read_sysfs(os.path.join(directory, 'size'), 0)) * 512,
+                dev=dev,
+                mountpoints=[mountpoint for mountpoint,fstype,options
+                             in device_mounts],
+                fstype=device_mounts[0][1] if device_mounts else None,
+                label=label)
+
+    return table
+
+
+
+def plugged_drives(possible_drives, sysroot='/'):
+    """
+    Names are compared exactly so 'sda1' doesn't match 'sda10'
+
+    returns:
+        list of BlockDevice of possible_drives that are present, in order of
+        possible_drives
+    """
+    table = device_table(sysroot)
+    return [table[name] for name in possible_drives if name in table]
+
+
+
+if __name__ == '__main__':
+    for device in sorted(device_table(sys.argv[1] if len(sys.argv) > 1
+                                      else '/').values()):
+        print('{:<12} {:<6} {:>14} {:<6} {:<8} {:<12} {}'.format(
+            device.name, device.dev or '?', device.size,
+            'rm' if device.removable else '', device.fstype or '',
+            device.label or '', ','.join(device.mountpoints)))
@@ -0,0 +1,86 @@
+"""
+Module with the adaptive durability policy of log files. A fixed batch is
+wrong at both ends of the traffic range: a lone message in an idle period
+waits for the timer, while a burst at full UART speed wants batches much bigger
+than usual. So the incoming record rate and the cost of a commit (flush +
+fsync) are measured, and the batch is chosen to be as small as possible while
+the time spent in commits stays below the given share of the wall time.
+
+Modes:
+    'immediate'  every record is committed right away (idle and low rates)
+    'batch'      records are committed every `records` records or when the
+                 batch is `max_age` seconds old
+Both are bounded by fsync_every_records and fsync_every_time (the latency
+bound).
+"""
+
+import math, time
+
+
+
+class AdaptiveCommitPolicy:
+
+    def __init__(self, max_records, max_age, duty, window):
+        """
+        max_records,max_age - bounds of a batch (records, seconds)
+        duty - maximal share of the time spent in commits
+        window - period of the rate estimation (seconds)
+        """
+        self.max_records = max_records
+        self.max_age = max_age
+        self.duty = duty
+        self.window = window
+
+        # Current choice
+        self.mode = 'immediate'
+        self.records = 1
+        self.age = max_age
+
+        # Estimates
+        self.rate = 0.0  # records per second
+        self.commit_cost = None  # seconds
+        self.window_start = time.monotonic()
+        self.window_records = 0
+
+    def record(self, now):
+        """
+        Account an incoming record
+
+        returns:
+            True if the choice has been reconsidered
+        """
+        self.window_records += 1
+        if now - self.window_start < self.window:
+            return False
+        self.update(now)
+        return True
+
+    def committed(self, duration):
+        """
+        Account the duration of a commit
+        """
+        if self.commit_cost is None:
+            self.commit_cost = duration
+        else:
+            self.commit_cost += 0.2 * (duration - self.commit_cost)
+
+    def update(self, now):
+        rate = self.window_records / (now - self.window_start)
+        self.window_start = now
+        self.window_records = 0
+        # React to bursts at once, calm down smoothly
+        self.rate = rate if rate > self.rate else 0.5 * (self.rate + rate)
+
+        # Commits per second that fit into the duty
+        affordable = self.duty / max(self.commit_cost or 0.001, 1e-6)
+        if self.rate <= affordable:
+            self.mode = 'immediate'
+            self.records = 1
+            self.age = self.max_age
+        else:
+            self.mode = 'batch'
+            self.records = min(self.max_records,
+                               math.ceil(self.rate / affordable))
+            # Twice the expected time to fill the batch (to cover the
+            # jitter), but not longer than the latency bound
+            self.age = min(self.max_age, 2 * self.records / self.rate)
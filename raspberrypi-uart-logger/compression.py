@@ -0,0 +1,78 @@
+"""
+Module with the streaming compression of log files. CompressedStream pretends
+to be a text file for logging.StreamHandler but passes everything through an
+incremental compressor. Every flush() (i.e. every commit of CustomFileHandler)
+is a sync-flush point: all data written so far can be decompressed even if the
+drive is pulled right after it. close() finalises the stream.
+
+Appending to an existing file starts a new gzip member (zstd frame) and both
+formats allow such concatenation, so segments are readable with plain
+zcat/zstdcat.
+
+Only the standard library is needed for gzip. zstd requires the 'zstandard'
+package.
+"""
+
+import zlib
+
+
+
+compression_suffixes = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+
+
+class CompressedStream:
+
+    def __init__(self, filename, method='gzip', level=6, encoding='utf-8'):
+        self.method = method
+        self.encoding = encoding or 'utf-8'
+        if method == 'gzip':
+            # wbits=31 means gzip container
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self.sync_flush_mode = zlib.Z_SYNC_FLUSH
+        elif method == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.sync_flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            raise ValueError("Unknown compression method '{}'".format(method))
+        self.file = open(filename, 'ab')
+        # Metrics
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, text):
+        data = text.encode(self.encoding) if isinstance(text, str) else text
+        self.bytes_in += len(data)
+        self.write_out(self.compressor.compress(data))
+
+    def write_out(self, data):
+        if data:
+            self.file.write(data)
+            self.bytes_out += len(data)
+
+    def flush(self):
+        """
+        Sync-flush point: everything written before is decompressible
+        """
+        self.write_out(self.compressor.flush(self.sync_flush_mode))
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        """
+        Finalise the stream (trailer with the checksum) and close the file
+        """
+        if self.file.closed:
+            return
+        try:
+            self.write_out(self.compressor.flush())
+            self.file.flush()
+        finally:
+            self.file.close()
@@ -0,0 +1,249 @@
+"""
+Module that watches the current drive in the background so CustomFileHandler
+doesn't need to stat the device on every log record. Presence of the block
+device is tracked via kernel uevents (netlink socket) or, as a fallback, via
+inotify on the /dev directory (or plain periodic checks if none of them is
+available). Besides, the mount table is watched to catch the drive that is
+still here but has been remounted read-only (or unmounted at all).
+
+Paths of /dev and the mount table are parameters so the monitor can be checked
+against a fake /dev directory and a fake mounts file.
+"""
+
+import os, socket, select, struct, threading, ctypes, ctypes.util
+from miscs import *
+
+
+
+# Netlink protocol and multicast group of kernel uevents
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+
+# inotify constants (see <sys/inotify.h>)
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+
+def open_netlink():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                         NETLINK_KOBJECT_UEVENT)
+    sock.bind((0, UEVENT_KERNEL_GROUP))
+    sock.setblocking(False)
+    return sock
+
+
+
+def parse_uevent(data):
+    """
+    Kernel uevent is a header ('action@devpath') followed by KEY=VALUE
+    strings, all separated by NUL bytes.
+
+    returns:
+        dict of uevent properties
+    """
+    uevent = {}
+    for field in data.split(b'\0')[1:]:
+        key,sep,value = field.partition(b'=')
+        if sep:
+            uevent[key.decode('utf-8', 'replace')] = value.decode('utf-8',
+                                                                  'replace')
+    return uevent
+
+
+
+class Inotify:
+    """
+    Minimal ctypes wrapper around inotify (Python standard library has none)
+    """
+
+    def __init__(self, path, mask):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed', path)
+
+    def fileno(self):
+        return self.fd
+
+    def read_names(self):
+        """
+        returns:
+            list of names of the changed directory entries
+        """
+        names = []
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + 16 <= len(data):
+            wd,mask,cookie,length = struct.unpack_from('iIII', data, offset)
+            name = data[offset+16:offset+16+length].rstrip(b'\0')
+            names.append(os.fsdecode(name))
+            offset += 16 + length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class DriveMonitor(threading.Thread):
+    """
+    Background thread that keeps two flags up to date: present (block device
+    exists) and writable (it is mounted read-write at the mountpoint). The
+    handler just reads the ok property which is free.
+
+    backend:
+        'netlink'  kernel uevents
+        'inotify'  inotify on dev_dir
+        'poll'     periodic checks every poll_time seconds
+        'auto'     first available of the above
+    """
+
+    def __init__(self, drive, mountpoint, backend=drive_monitor_backend,
+                 dev_dir='/dev', mounts_filename='/proc/self/mounts',
+                 poll_time=drive_monitor_poll_time):
+        super(DriveMonitor, self).__init__(name='DriveMonitor', daemon=True)
+        self.drive = drive
+        self.devname = os.path.basename(drive)
+        self.mountpoint = os.path.normpath(mountpoint)
+        self.dev_dir = dev_dir
+        self.mounts_filename = mounts_filename
+        self.poll_time = poll_time
+
+        self.source = None
+        self.backend = self.open_backend(backend)
+
+        # Used to wake the thread up on stop()
+        self.wakeup_r,self.wakeup_w = os.pipe()
+        self.stopped = False
+
+        self.present = False
+        self.writable = False
+        self.check()
+
+    @property
+    def ok(self):
+        return self.present and self.writable
+
+    def open_backend(self, backend):
+        candidates = ['netlink', 'inotify', 'poll'] if backend == 'auto'\
+                     else [backend]
+        for candidate in candidates:
+            try:
+                if candidate == 'netlink':
+                    self.source = open_netlink()
+                elif candidate == 'inotify':
+                    self.source = Inotify(self.dev_dir,
+                        IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+                return candidate
+            except Exception as e:
+                print("Drive monitor: {} backend is unavailable ({})"
+                      .format(candidate, e))
+        return 'poll'
+
+    def check_present(self):
+        self.present = os.path.exists(os.path.join(self.dev_dir, self.devname))
+
+    def check_writable(self):
+        """
+        Look for the drive in the mount table: it should be mounted at our
+        mountpoint with 'rw' option
+        """
+        writable = False
+        try:
+            with open(self.mounts_filename) as mounts:
+                for line in mounts:
+                    fields = line.split()
+                    if len(fields) < 4:
+                        continue
+                    # Spaces in mountpoints are escaped as \040
+                    mountpoint = fields[1].replace('\\040', ' ')
+                    if os.path.basename(fields[0]) == self.devname and\
+                       os.path.normpath(mountpoint) == self.mountpoint:
+                        writable = 'rw' in fields[3].split(',')
+        except Exception as e:
+            print(e)
+        self.writable = writable
+
+    def check(self):
+        """
+        Re-evaluate both flags right now
+        """
+        self.check_present()
+        self.check_writable()
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.wakeup_r, select.POLLIN)
+        if self.source is not None:
+            poller.register(self.source.fileno(), select.POLLIN)
+        # /proc/self/mounts signals changes of the mount table with POLLPRI
+        # (a regular file never does so it isn't a problem for fake ones)
+        try:
+            mounts = open(self.mounts_filename)
+            mounts.read()
+            poller.register(mounts.fileno(), select.POLLPRI)
+        except Exception as e:
+            print(e)
+            mounts = None
+
+        timeout = None if self.backend != 'poll' else self.poll_time * 1000
+        while not self.stopped:
+            events = poller.poll(timeout)
+            if self.stopped:
+                break
+            if not events:
+                self.check()
+                continue
+            for fd,event in events:
+                if mounts is not None and fd == mounts.fileno():
+                    mounts.seek(0)
+                    mounts.read()
+                    self.check_writable()
+                elif self.source is not None and fd == self.source.fileno():
+                    self.handle_source()
+
+        if mounts is not None:
+            mounts.close()
+
+    def handle_source(self):
+        if self.backend == 'netlink':
+            while True:
+                try:
+                    data = self.source.recv(8192)
+                except BlockingIOError:
+                    break
+                uevent = parse_uevent(data)
+                if uevent.get('SUBSYSTEM') == 'block' and\
+                   os.path.basename(uevent.get('DEVNAME', '')) == self.devname:
+                    self.present = uevent.get('ACTION') != 'remove'
+                    self.check_writable()
+        elif self.devname in self.source.read_names():
+            self.check()
+
+    def stop(self):
+        self.stopped = True
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except OSError:
+            pass
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if self.source is not None:
+            self.source.close()
@@ -0,0 +1,150 @@
+"""
+Module with the fast formatter of UART frames. It produces exactly the same
+line as logging.Formatter(log_formatter_string) does for a LogRecord but
+without the record itself: the date and time part of asctime is cached per
+second and level names are taken from a lookup table. So the hot path costs a
+couple of string concatenations per frame.
+
+The fraction of a second is printed in milliseconds (as logging.Formatter does)
+or in microseconds (resolution='us').
+
+Payloads that come from the UART as bytes are not decoded at all:
+format_bytes() adds the encoded prefix to them and LineStream writes the result
+to the file as it is.
+"""
+
+import time, logging
+
+
+
+# The format the specialized path is compiled for. Any other format string is
+# served by the generic (still cached) path
+default_log_formatter_string = '%(levelname)-8s [%(asctime)s] %(message)s'
+
+
+
+class FastFormatter:
+
+    def __init__(self, fmt=default_log_formatter_string,
+                 datefmt='%Y-%m-%d %H:%M:%S', terminator='\n', resolution='ms'):
+        self.fmt = fmt
+        self.datefmt = datefmt
+        self.terminator = terminator
+        # Fraction of a second: units per second and the format of it
+        if resolution == 'us':
+            self.fraction = 1000000
+            self.fraction_str,self.fraction_bytes = ',{:06d}',b',%06d] '
+        else:
+            self.fraction = 1000
+            self.fraction_str,self.fraction_bytes = ',{:03d}',b',%03d] '
+        self.specialized = fmt == default_log_formatter_string
+        self.uses_asctime = '%(asctime)' in fmt
+        # levelno -> level name (or '%(levelname)-8s [' prefix for the
+        # specialized path)
+        self.levels = {}
+        # Date and time of the latest second seen
+        self.second = None
+        self.second_str = ''
+        # Encoded counterparts for format_bytes()
+        self.levels_bytes = {}
+        self.second_bytes = b''
+        self.terminator_bytes = terminator.encode('utf-8')
+        # The format may refer to LogRecord fields we don't have (e.g.
+        # %(filename)s), then the caller should use logging.Formatter
+        try:
+            self.format(logging.INFO, 0.0, '')
+            self.supported = True
+        except (KeyError, ValueError, TypeError):
+            self.supported = False
+
+    def level(self, levelno):
+        level = self.levels.get(levelno)
+        if level is None:
+            level = logging.getLevelName(levelno)
+            if self.specialized:
+                level = '{:<8} ['.format(level)
+            self.levels[levelno] = level
+        return level
+
+    def format_time(self, created):
+        """
+        Same as logging.Formatter.formatTime() with the default datefmt (see
+        miscs.Formatter for microseconds)
+        """
+        second = int(created)
+        if second != self.second:
+            self.set_second(second)
+        return self.second_str + self.fraction_str.format(
+            int((created - second) * self.fraction))
+
+    def set_second(self, second):
+        self.second = second
+        self.second_str = time.strftime(self.datefmt, time.localtime(second))
+        self.second_bytes = self.second_str.encode('utf-8')
+
+    def format(self, levelno, created, msg):
+        """
+        returns:
+            formatted line with the terminator
+        """
+        if self.specialized:
+            return ''.join((self.level(levelno), self.format_time(created),
+                            '] ', msg, self.terminator))
+        values = {
+            'levelno': levelno,
+            'levelname': self.level(levelno),
+            'created': created,
+            'msecs': (created - int(created)) * 1000,
+            'message': msg,
+            'msg': msg,
+            'name': 'root'
+        }
+        if self.uses_asctime:
+            values['asctime'] = self.format_time(created)
+        return self.fmt % values + self.terminator
+
+    def format_bytes(self, levelno, created, payload):
+        """
+        Specialized path only: the same line for the payload in bytes, which is
+        taken as it is (no decoding)
+
+        returns:
+            formatted line with the terminator (bytes)
+        """
+        level = self.levels_bytes.get(levelno)
+        if level is None:
+            level = self.levels_bytes[levelno] = self.level(levelno)\
+                                                 .encode('utf-8')
+        second = int(created)
+        if second != self.second:
+            self.set_second(second)
+        return b''.join((level, self.second_bytes, self.fraction_bytes %
+                         int((created - second) * self.fraction), payload,
+                         self.terminator_bytes))
+
+
+
+class LineStream:
+    """
+    Plain log file that takes both text lines (they are encoded) and lines
+    already in bytes (see FastFormatter.format_bytes()) so byte payloads are
+    never decoded. Pretends to be a text file for logging.StreamHandler
+    """
+
+    def __init__(self, filename, mode='a', encoding='utf-8'):
+        self.encoding = encoding or 'utf-8'
+        self.file = open(filename, mode.replace('b', '') + 'b')
+
+    def write(self, line):
+        if isinstance(line, str):
+            line = line.encode(self.encoding)
+        self.file.write(line)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,148 @@
+"""
+Module with the filtering stage between the parsing of UART messages and the
+writer. It protects the drive when the target gets stuck in a loop printing the
+same messages thousands of times per second:
+
+ - a message repeating the previous one (same level and payload) within the
+   repeat window is collapsed: the first one is passed, the rest are counted
+   and summarized as "Message repeated N times: ..." when the storm is over
+   (any other message ends it) and every summary interval while it lasts. Only
+   consecutive repeats are collapsed so the order of messages in the log is
+   kept as it was sent
+ - the rest is limited by per-level token buckets, dropped messages are
+   reported as soon as the level has tokens again
+
+CRITICAL messages always pass through untouched.
+"""
+
+import time, logging
+from miscs import *
+import metrics
+
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def take(self, now):
+        """
+        returns:
+            True if there is a token for a message
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+
+class Repeats:
+    """
+    State of the last message
+    """
+
+    __slots__ = ('last_seen', 'count', 'summary_at')
+
+    def __init__(self, now, summary_interval):
+        self.last_seen = now
+        # Suppressed repeats since the last summary
+        self.count = 0
+        self.summary_at = now + summary_interval
+
+
+
+class FrameFilter:
+    """
+    Stands in front of log(levelno, msg, created=None, received=None) (e.g.
+    LogWriter.log()) for UART messages, passed messages keep their arrival
+    stamps. Call flush() when the port is idle so summaries of a finished
+    storm don't wait for the next message
+    """
+
+    def __init__(self, log, rate_limits=log_rate_limits,
+                 repeat_window=log_repeat_window,
+                 repeat_summary_interval=log_repeat_summary_interval):
+        self.output = log
+        self.buckets = {levelno: TokenBucket(rate, burst) for
+                        levelno,(rate,burst) in (rate_limits or {}).items()}
+        self.repeat_window = repeat_window
+        self.repeat_summary_interval = repeat_summary_interval
+        # (levelno,payload) of the last message and its Repeats
+        self.last_key = None
+        self.repeats = None
+
+    def log(self, levelno, msg, created=None, received=None):
+        if levelno >= logging.CRITICAL:
+            self.output(levelno, msg, created=created, received=received)
+            return
+        now = time.monotonic()
+
+        if self.repeat_window is not None:
+            key = (levelno, msg)
+            repeats = self.repeats
+            if key == self.last_key and\
+               now - repeats.last_seen < self.repeat_window:
+                repeats.last_seen = now
+                repeats.count += 1
+                metrics.uart_collapsed_frames.inc()
+                if now >= repeats.summary_at:
+                    self.summarize(key, repeats, now)
+                return
+            # Another message: the storm of the previous one is over and is
+            # summarized before it
+            self.expire(now, final=True)
+            self.last_key = key
+            self.repeats = Repeats(now, self.repeat_summary_interval)
+
+        bucket = self.buckets.get(levelno)
+        if bucket is not None:
+            if not bucket.take(now):
+                metrics.uart_rate_limited_frames.inc()
+                return
+            if bucket.dropped:
+                self.report_dropped(levelno, bucket)
+        self.output(levelno, msg, created=created, received=received)
+
+    def summarize(self, key, repeats, now):
+        if repeats.count:
+            levelno,msg = key
+            if isinstance(msg, bytes):
+                msg = msg.decode('utf-8', 'replace')
+            self.output(levelno, "Message repeated {} times: {}"
+                        .format(repeats.count, msg))
+            repeats.count = 0
+        repeats.summary_at = now + self.repeat_summary_interval
+
+    def expire(self, now, final=False):
+        if self.last_key is None:
+            return
+        if final or now - self.repeats.last_seen >= self.repeat_window:
+            self.summarize(self.last_key, self.repeats, now)
+            self.last_key = self.repeats = None
+
+    def report_dropped(self, levelno, bucket):
+        self.output(logging.WARNING, "{} {} messages have been dropped by the "
+                    "rate limit".format(bucket.dropped,
+                                        logging.getLevelName(levelno)))
+        bucket.dropped = 0
+
+    def flush(self, final=False):
+        """
+        Write out summaries of storms that are over (all of them if final, e.g.
+        when the port is closed)
+        """
+        now = time.monotonic()
+        if self.repeat_window is not None:
+            self.expire(now, final)
+        for levelno,bucket in self.buckets.items():
+            if bucket.dropped:
+                self.report_dropped(levelno, bucket)
@@ -0,0 +1,478 @@
+"""
+Module that splits the raw UART byte stream into whole messages (frames). It
+replaces the old byte-at-a-time reading: the caller lets the framer read
+everything the port currently holds straight into its buffer, and the framer
+gives back complete frames.
+
+Every frame is stamped with its arrival: the wall clock time of the read that
+brought its first byte and the monotonic time of the read that brought its EOL
+symbol (or its last byte). These stamps travel with the frame down to the
+drive, so queueing and batching never shift the time in the log.
+
+Frames are memoryview slices of the framer buffer, nothing is copied or decoded
+on the way: the level of a log message is classified by its first byte and the
+payload is copied out once, as bytes, when it is passed to the writer (see
+frame_payload()). The writer puts these bytes into the file with only the
+prefix added. UTF-8 validation of payloads can be turned off (see
+uart_validate_utf8).
+
+With uart_framing = 'crc' the framer also takes CRC-checked frames:
+
+    STX (0x02) | length (2 bytes, big-endian) | payload | CRC-16 (big-endian)
+
+The payload is the same as the one of a text frame ('I message', 'is_present',
+...) without the EOL symbol. CRC-16/CCITT-FALSE (polynomial 0x1021, initial
+value 0xFFFF) is calculated over the length and the payload. Text frames are
+still accepted in between so old targets keep working (but only the ones that
+look like valid messages, the rest is taken as the noise). A start marker is
+taken as a false one as soon as the length is too big, the first bytes of the
+payload don't look like a message or an EOL symbol shows up in the payload: it
+is counted as a corrupt frame, the framer resynchronises right after it and
+the frames behind it are not held. Only a candidate that passes these checks
+gets its CRC calculated and if the CRC is wrong the whole declared frame is
+dropped as a corrupt one, so every byte is checked at most once and the noise
+is handled in (amortized) constant time per byte. See log_usart() in
+client-usage-example/logging.c for the sender.
+"""
+
+import os, time, select, logging, binascii
+from miscs import *
+
+
+
+# Prefix letters of log messages
+message_levels = {
+    'D': logging.DEBUG,
+    'I': logging.INFO,
+    'W': logging.WARNING,
+    'E': logging.ERROR,
+    'C': logging.CRITICAL
+}
+
+# The same by the first byte of a frame (so no decoding is needed)
+frame_levels = {ord(letter): levelno for letter,levelno in message_levels.items()}
+
+# Service messages of the target
+service_frames = (b'is_present', b'end')
+
+# Kinds of events produced by Framer.frames()
+FRAME = 0
+EMPTY_FRAME = 1
+TOO_LONG_FRAME = 2
+CORRUPT_FRAME = 3
+
+# Start marker of CRC-checked frames and sizes of their fields
+FRAME_START = 0x02
+frame_header_size = 3  # start marker + length
+frame_crc_size = 2
+
+
+
+def frame_crc(data):
+    """
+    CRC-16/CCITT-FALSE
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+
+class Framer:
+    """
+    Accumulates incoming bytes in a single preallocated bytearray and cuts it
+    on the EOL symbol. The port is read straight into the free tail of the
+    buffer (os.readv() into a memoryview, see read_from()) and frames are
+    memoryview slices of it, so a frame costs no allocation until its payload
+    is taken. Only the tail that has not been scanned yet is searched for the
+    terminator so every byte is looked at once.
+
+    The buffer works as a ring: when its tail runs out, the unfinished
+    message (not longer than max_length) is moved to the head. Frames are
+    valid until the next read_from() or feed() call.
+
+    framing is 'text' (frames are cut on the EOL symbol only) or 'crc' (see
+    the module description)
+    """
+
+    def __init__(self, max_length=too_long_message, terminator=b'\r',
+                 chunk_size=read_chunk_size, framing=uart_framing):
+        self.max_length = max_length
+        self.terminator = terminator
+        self.chunk_size = chunk_size
+        self.framing = framing
+        # An unfinished message never exceeds max_length (it's dropped as a
+        # too long one) so there is always room for a whole chunk after it
+        # (plus the header and the CRC of a CRC-checked frame)
+        self.buffer = bytearray(max_length + frame_header_size +
+                                frame_crc_size + chunk_size + 1)
+        self.view = memoryview(self.buffer)
+        # Unconsumed data is buffer[start:end], buffer[start:scan] has no
+        # terminator in it
+        self.start = 0
+        self.end = 0
+        self.scan = 0
+        # The head of the current message has been dropped as a too long one,
+        # skip the rest of it up to the EOL symbol
+        self.skipping = False
+        # A false start marker has just been dropped, the bytes up to the next
+        # start marker or EOL symbol belong to the noise (unless they look like
+        # a message)
+        self.resyncing = False
+        # The first EOL symbol at or after the payload of the latest
+        # CRC-checked frame candidate (or the end of the data if there is none
+        # yet), so the payloads of overlapping candidates are searched once
+        self.eol = 0
+        # Arrival stamps (wall clock,monotonic) of the latest read and of the
+        # read that brought buffer[start], data from read_start on has come
+        # with the latest read
+        self.read_time = self.pending_time = (0.0, 0.0)
+        self.read_start = 0
+
+    @property
+    def chunk(self):
+        """
+        Data of the latest read (valid until frames() is called)
+        """
+        return self.view[self.read_start:self.end]
+
+    @property
+    def pending(self):
+        """
+        True if some part of an unfinished message is waiting for its EOL
+        """
+        return self.end > self.start
+
+    def reset(self):
+        """
+        Drop an unfinished message (e.g. after a timeout in the middle of a
+        transfer).
+
+        returns:
+            dropped bytes
+        """
+        dropped = bytes(self.view[self.start:self.end])
+        self.start = self.end = self.scan = self.eol = 0
+        self.skipping = self.resyncing = False
+        return dropped
+
+    def reserve(self, size):
+        """
+        Make room for size bytes at the tail of the buffer (if possible)
+
+        returns:
+            available room (bytes)
+        """
+        if len(self.buffer) - self.end < size and self.start:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.scan -= self.start
+            self.eol -= self.start
+            self.start,self.end = 0,pending
+        return min(size, len(self.buffer) - self.end)
+
+    def read_from(self, fd, timeout=None):
+        """
+        Wait for the data in the file descriptor (not longer than timeout
+        seconds) and read up to chunk_size bytes straight into the buffer.
+
+        returns:
+            number of read bytes (0 if there is no data)
+        """
+        if timeout is not None and not select.select([fd], [], [], timeout)[0]:
+            return 0
+        size = self.reserve(self.chunk_size)
+        try:
+            received = os.readv(fd, [self.view[self.end:self.end+size]])
+        except BlockingIOError:
+            return 0
+        if not received:
+            # Same as pyserial does
+            raise OSError('device reports readiness to read but returned no '
+                          'data (device disconnected or multiple access on '
+                          'port?)')
+        self.arrived(received)
+        return received
+
+    def arrived(self, size, stamp=None):
+        """
+        Stamp size bytes that have just been put at the tail of the buffer
+        with (wall clock,monotonic) stamp (now by default)
+        """
+        self.read_time = stamp or (time.time(), time.monotonic())
+        if self.start == self.end:
+            self.pending_time = self.read_time
+        self.read_start = self.end
+        self.end += size
+
+    def arrival(self, start):
+        """
+        returns:
+            created (wall clock time of the first byte),received (monotonic
+            time of the last one) of a frame that starts at buffer[start]
+        """
+        if start < self.read_start:
+            return self.pending_time[0],self.read_time[1]
+        return self.read_time[0],self.read_time[1]
+
+    def feed(self, data, stamp=None):
+        """
+        Append a chunk of bytes (copied into the buffer) and extract all
+        complete frames from it. stamp is the arrival of the chunk (see
+        arrived()), e.g. the one from a raw capture.
+
+        returns:
+            list of (kind,raw_bytes,arrival) tuples in order of arrival
+        """
+        events = []
+        data = memoryview(data)
+        while data:
+            size = self.reserve(min(len(data), self.chunk_size))
+            self.view[self.end:self.end+size] = data[:size]
+            self.arrived(size, stamp)
+            data = data[size:]
+            events.extend((kind, bytes(frame), arrival) for
+                          kind,frame,arrival in self.frames())
+        return events
+
+    def frames(self):
+        """
+        Extract all complete frames that have been read so far.
+
+        returns:
+            list of (kind,frame,arrival) tuples in order of arrival, frames
+            are memoryview slices of the buffer, arrival is (created,received)
+            (see arrival())
+        """
+        if self.framing == 'crc':
+            return self.checked_frames()
+        buf,view = self.buffer,self.view
+        events = []
+        start,end = self.start,self.end
+        if self.skipping:
+            stop = buf.find(self.terminator, start, end)
+            if stop == -1:
+                self.start = self.end = self.scan = 0
+                return events
+            self.skipping = False
+            start = self.scan = stop + 1
+        scan = max(self.scan, start)
+        while True:
+            stop = buf.find(self.terminator, scan, end)
+            if stop == -1:
+                break
+            if stop == start:
+                events.append((EMPTY_FRAME, view[start:start],
+                               self.arrival(start)))
+            elif stop - start > self.max_length:
+                events.append((TOO_LONG_FRAME, view[start:stop],
+                               self.arrival(start)))
+            else:
+                events.append((FRAME, view[start:stop], self.arrival(start)))
+            start = scan = stop + 1
+
+        # Case of the too long message without EOL symbol
+        if end - start > self.max_length:
+            events.append((TOO_LONG_FRAME, view[start:end],
+                           self.arrival(start)))
+            start = end
+            self.skipping = True
+
+        self.consumed(start, end)
+        return events
+
+    def consumed(self, start, scan):
+        if start == self.end:
+            # Everything is consumed: start over from the head of the buffer
+            # (the data stays in place until the next read)
+            self.start = self.end = self.scan = self.eol = 0
+        else:
+            if start >= self.read_start:
+                # The unfinished message has come with the latest read
+                self.pending_time = self.read_time
+            self.start,self.scan = start,scan
+
+    def checked_frames(self):
+        """
+        frames() for the 'crc' framing: CRC-checked frames and text frames in
+        between
+        """
+        buf,view = self.buffer,self.view
+        terminator = self.terminator[0]
+        events = []
+        start,end = self.start,self.end
+        scan = max(self.scan, start)
+        eol = self.eol
+        while start < end:
+            if buf[start] == FRAME_START:
+                if end - start < frame_header_size:
+                    scan = start
+                    break
+                length = buf[start+1] << 8 | buf[start+2]
+                payload_start = start + frame_header_size
+                crc_start = payload_start + length
+                frame_end = crc_start + frame_crc_size
+                # Candidates only move forward so the search goes on from
+                # where the previous one has stopped
+                eol = max(eol, payload_start)
+                if eol < end and buf[eol] != terminator:
+                    eol = buf.find(terminator, eol, end)
+                    if eol == -1:
+                        eol = end
+                if length > self.max_length or eol < min(end, crc_start) or\
+                   not is_message_start(
+                       view[payload_start:min(end, crc_start,
+                                              payload_start + 2)]):
+                    # A false start marker: resynchronise right after it
+                    events.append((CORRUPT_FRAME, view[start:start+1],
+                                   self.arrival(start)))
+                    start = scan = start + 1
+                    self.skipping = False
+                    self.resyncing = True
+                    continue
+                if frame_end > end:
+                    # Wait for the rest of the frame
+                    scan = start
+                    break
+                if frame_crc(view[start+1:crc_start]) !=\
+                   buf[crc_start] << 8 | buf[crc_start+1]:
+                    # The bytes of the declared frame have been checked, drop
+                    # them all
+                    events.append((CORRUPT_FRAME, view[start:frame_end],
+                                   self.arrival(start)))
+                    start = scan = frame_end
+                    self.skipping = self.resyncing = False
+                    continue
+                payload = view[payload_start:crc_start]
+                events.append((FRAME if length else EMPTY_FRAME, payload,
+                               self.arrival(start)))
+                start = scan = frame_end
+                self.skipping = self.resyncing = False
+                continue
+
+            # Text frame up to the EOL symbol or the noise up to the next start
+            # marker
+            stop = buf.find(terminator, scan, end)
+            marker = buf.find(FRAME_START, scan, end if stop == -1 else stop)
+            if marker != -1:
+                if not (self.skipping or self.resyncing):
+                    events.append((CORRUPT_FRAME, view[start:marker],
+                                   self.arrival(start)))
+                self.skipping = self.resyncing = False
+                start = scan = marker
+                continue
+            if stop == -1:
+                scan = end
+                if end - start > self.max_length:
+                    if not (self.skipping or self.resyncing):
+                        events.append((TOO_LONG_FRAME, view[start:end],
+                                       self.arrival(start)))
+                        self.skipping = True
+                    start = scan = end
+                break
+            if self.resyncing:
+                # The noise after a false start marker, a message right behind
+                # the marker is still taken
+                self.resyncing = False
+                if is_text_frame(view[start:stop]):
+                    events.append((FRAME, view[start:stop],
+                                   self.arrival(start)))
+            elif self.skipping:
+                self.skipping = False
+            elif stop - start > self.max_length:
+                events.append((TOO_LONG_FRAME, view[start:stop],
+                               self.arrival(start)))
+            elif is_text_frame(view[start:stop]):
+                events.append((FRAME, view[start:stop], self.arrival(start)))
+            else:
+                # Text frames have no check of their own, so anything that
+                # doesn't look like one is taken as the noise
+                events.append((CORRUPT_FRAME, view[start:stop],
+                               self.arrival(start)))
+            start = scan = stop + 1
+
+        self.eol = eol
+        self.consumed(start, scan)
+        return events
+
+    def expire(self):
+        """
+        Give up waiting for the rest of the pending CRC-checked frame (after a
+        read timeout). A false start marker is usually dropped as soon as the
+        next EOL symbol arrives, this is for the case when the line goes silent
+        right after it. The frame is counted as a
+        corrupt one and the framer resynchronises right after its start marker.
+
+        returns:
+            list of events like frames() or None if there is no pending
+            CRC-checked frame
+        """
+        if self.framing != 'crc' or not self.pending or\
+           self.buffer[self.start] != FRAME_START:
+            return None
+        events = [(CORRUPT_FRAME, self.view[self.start:self.end],
+                   self.arrival(self.start))]
+        self.start = self.scan = self.start + 1
+        self.skipping = False
+        self.resyncing = True
+        events.extend(self.checked_frames())
+        return events
+
+
+
+def is_text_frame(frame):
+    """
+    True if the frame looks like a valid message of the text framing ('X ...'
+    or a service one)
+    """
+    if len(frame) >= 2 and frame[0] in frame_levels and frame[1] == 0x20:
+        return True
+    return frame in service_frames
+
+
+
+def is_message_start(head):
+    """
+    True if a frame that starts with head can pass is_text_frame() (head is
+    the first two bytes of the frame or less)
+    """
+    if not head or head[0] in frame_levels and\
+       (len(head) == 1 or head[1] == 0x20):
+        return True
+    return any(frame.startswith(head) for frame in service_frames)
+
+
+
+def frame_level(frame):
+    """
+    returns:
+        level of a log message or None for other frames
+    """
+    return frame_levels.get(frame[0]) if len(frame) else None
+
+
+
+def frame_payload(frame, validate_utf8=uart_validate_utf8):
+    """
+    Take the payload of a log message out of the frame. This copy is the only
+    one on the way of the payload to the writer. Decode errors usually appear
+    due to transmit errors (bad electrical contact, for example) so with the
+    validation broken bytes are skipped and the rest of the message is kept.
+    Without it the payload is written as it is.
+
+    returns:
+        payload,error
+    """
+    payload = bytes(frame[2:])
+    if validate_utf8 and not payload.isascii():
+        try:
+            payload.decode('utf-8')
+        except UnicodeDecodeError as e:
+            return payload.decode('utf-8', 'ignore').encode('utf-8'),e
+    return payload,None
+
+
+
+def frame_text(frame):
+    """
+    Frame as text for diagnostic messages
+    """
+    return str(frame, 'utf-8', 'replace')
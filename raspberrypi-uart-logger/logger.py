@@ -1,17 +1,23 @@
 # TODO: in production: remove all print and cprint statements
 # TODO: respond on errors of subprocess.run() (use subprocess.run(..., check=True))
-# TODO: USB drive overflow/fat32 maximal file size (4 Gb) exceed
 
 """
 Main program module.
 """
 
-import sys, time, signal, serial, logging, subprocess
-import RPi.GPIO as GPIO
+import os, sys, time, signal, logging, asyncio
 from functools import partial
 
 from miscs import *
 from usbdriveroutine import *
+from framing import *
+from writer import *
+from aiocore import *
+from workers import WorkerSupervisor
+from framefilter import FrameFilter
+from rawcapture import RawCapture, capture_suffix
+from publisher import FramePublisher
+import metrics
 
 
 
@@ -49,151 +55,317 @@ def usart_connect(logger, ser):
 
 def main():
     """
-    Main function is not an actual start point of the whole program because of
-    routines in imported modules.
+    Main function of the single-port mode. Imported modules don't touch the
+    hardware, it's set up here (see hardware()).
     """
 
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(LED_GPIO, GPIO.OUT)
-    GPIO.output(LED_GPIO, True)
+    setup_console()
+    hardware().led(True)
+    ser = hardware().serial_port(uart_port, uart_baudrate, uart_timeout)
+    exit_routines.append(ser.close)
 
     # Connect handler of Ctrl-C interrupt
     signal.signal(signal.SIGINT, ctrlc_handler)
     signal.signal(signal.SIGTERM, ctrlc_handler)
 
-    # Many of such functions in the program does not actually use all these
-    # arguments and return values as part of the isolation principle. The idea
-    # is to make it easier to upgrade the code in future releases.
-    activate_drive_and_logger_status,\
-    logging_file_handler,\
-    drive = activate_drive_and_logger(
-        possible_drives,
-        drive_mountpoint,
-        drive_name,
-        logger,
-        formatter,
-        log_filename
+    # Drive I/O is performed by the dedicated thread so the drive stalls don't
+    # block the reading of the serial port. The writer activates the drive in
+    # background as well so the port is opened right away and frames are
+    # buffered in the queue in the meantime
+    frame_queue = FrameQueue(
+        spill=Spool(os.path.join(spool_dir, 'overflow'))
     )
-    if activate_drive_and_logger_status == CRITICAL_ERROR:
-        sudo_reboot()
-
-    usart_connect_status, usart_reconnect_counter = usart_connect(logger, ser)
+    log_writer = LogWriter(logger, frame_queue, None,
+                           Spool(os.path.join(spool_dir, 'outage')))
+    exit_routines.append(log_writer.stop)
+    log_writer.start()
+    start_metrics(log_writer)
+    start_publisher(log_writer)
+
+    # Diagnostic messages go through the writer as well to keep them in order
+    # with frames
+    usart_connect_status, usart_reconnect_counter = usart_connect(log_writer,
+                                                                  ser)
     if usart_connect_status == CRITICAL_ERROR:
         sudo_reboot()
-
+    startup_milestone('serial_port')
+
+    framer = Framer()
+    capture = None
+    if raw_capture:
+        capture = RawCapture(os.path.join(raw_capture_dir,
+                                          'uartraw' + capture_suffix),
+                             raw_capture_max_size)
+        exit_routines.append(capture.close)
+    # Log storms of the target are collapsed and rate limited on the way to the
+    # writer
+    frame_filter = FrameFilter(log_writer.log)
     no_ping_counter = 0
+    read_error_counter = 0
     reset_reboots_cnt_flag = False
 
     # Read messages forever in a loop
     while True:
 
-        # Read bytes from USART till we get whole message
-        msg = ''; char = b'a';
-        while True:
-            try:
-                char = ser.read(1)  # 1 byte
-            # Rear or non-present exception on Raspberry
-            except Exception as e:
-                logger.error("{}. His last words were (raw): {}"
-                             .format(e, "''" if msg=='' else msg))
-                msg = ''
+        # Take everything that is already waiting in the port at once (straight
+        # into the framer buffer) or wait for at least 1 byte (until timeout)
+        try:
+            received = framer.read_from(ser.fileno(), ser.timeout)
+        # Rear or non-present exception on Raspberry
+        except Exception as e:
+            metrics.uart_read_errors.inc()
+            last_words = framer.reset().decode('utf-8', 'replace')
+            log_writer.error("{}. His last words were (raw): {}"
+                             .format(e, "''" if last_words=='' else last_words))
+            read_error_counter += 1
+            if read_error_counter < usart_read_error_tries:
+                time.sleep(usart_read_error_retry_time)
+                continue
+            # The port is broken for good, reopen it
+            read_error_counter = 0
+            ser.close()
+            usart_connect_status,usart_reconnect_counter =\
+                usart_connect(log_writer, ser)
+            if usart_connect_status == CRITICAL_ERROR:
+                sudo_reboot()
+            continue
+        read_error_counter = 0
+
+        # read timeout expired
+        if received == 0:
+            metrics.uart_timeouts.inc()
+            no_ping_counter += 1
+            if no_ping_counter > no_ping_tries:
+                sudo_reboot()
+            frame_filter.flush()
+            if capture is not None:
+                capture.flush()
+
+            # Define whether disconnection has happened in "idle" mode
+            # (between two messages) or while transfer
+            if not framer.pending:
+                log_writer.error(
+                    "Target is not present. Wait for {} seconds, {} tries left"
+                    .format(
+                        ser.timeout,
+                        no_ping_tries - no_ping_counter
+                    ))
             else:
-                # Send symbol back to see what we typing (for debugging)
-                # ser.write(char)
-
-                # read byte timeout expired
-                if char == b'':
-                    no_ping_counter += 1
-                    if no_ping_counter > no_ping_tries:
-                        sudo_reboot()
-
-                    # Define whether disconnection has happened in "idle" mode
-                    # (between two messages) or while transfer
-                    if msg == '':
-                        logger.error(
-                            "Target is not present. Wait for {} seconds, {} tries left"
-                            .format(
-                                ser.timeout,
-                                no_ping_tries - no_ping_counter
-                            ))
-                    else:
-                        logger.error(
-                            "Transmission failed. His last words were (raw): {}. "
-                            "New waiting timeout: {} seconds"
-                            .format(
-                                "''" if msg=='' else msg,
-                                ser.timeout
-                            ))
-                        msg = ''
-
-                    # Go and wait again
-                    continue
-
-                # EOL symbol at the end of message or just alone?
-                elif char == b'\r':
-                    if msg == '':
-                        logger.warning("Empty message: '{}'".format(repr(char)))
-                        continue
-                    break
-
-                # Reset no_ping_counter if we get any symbol
-                if no_ping_counter > 0:
-                    msg = ''
-                    no_ping_counter = 0
-
-                # Append a symbol to the message and catch decode exceptions.
-                # They usually appears due to transmit errors (bad electrical
-                # contact, for example).
-                try:
-                    msg = msg + char.decode('utf-8')
-                except Exception as e:
-                    logger.warning("{}".format(e))
-
-                # Case of the too long message without EOL symbol
-                if len(msg) > too_long_message:
-                    logger.warning("Message is too long")
-                    msg = ''
-                    time.sleep(too_long_message_sleep)
-                    sudo_reboot()
-
-
-        # Parse type of a log message and store it
-        type = msg[0]; msg_for_log = msg[2:]
-        if type == 'D':
-            logger.debug(msg_for_log)
-        elif type == 'I':
-            logger.info(msg_for_log)
-        elif type == 'W':
-            logger.warning(msg_for_log)
-        elif type == 'E':
-            logger.error(msg_for_log)
-        elif type == 'C':
-            logger.critical(msg_for_log)
-
-        # Ping-like message transmitted for us by the target to be sure that
-        # it is alive
-        elif msg == 'is_present':
-            # We have dedicated resets counter in file. But we need to reset it
-            # sometimes, right? We do it only once per program run, at condition
-            # of a successful transmission.
-            if not reset_reboots_cnt_flag:
-                # Cancel reboot, if there was planned one
-                subprocess.run(['sudo', 'shutdown', '-c'])
-                reset_reboots_cnt()
-                reset_reboots_cnt_flag = True
-                print('Reboots counter was cleared')
-
-        elif msg == 'end':
-            logger.info("Program terminated by the target")
-            program_exit()
-            sys.exit()
-
-        # If a message isn't of any recognizable type
-        else:
-            logger.warning("Undefined message: {}".format(repr(msg)))
+                # A start marker from the noise doesn't hold the frames behind
+                # it
+                events = framer.expire()
+                if events is not None:
+                    reset_reboots_cnt_flag = process_frames(log_writer,
+                        frame_filter, events, reset_reboots_cnt_flag)
+                else:
+                    log_writer.error(
+                        "Transmission failed. His last words were (raw): {}. "
+                        "New waiting timeout: {} seconds"
+                        .format(
+                            framer.reset().decode('utf-8', 'replace'),
+                            ser.timeout
+                        ))
+
+            # Go and wait again
+            continue
+
+        # Reset no_ping_counter if we get any symbol
+        no_ping_counter = 0
+        startup_milestone('first_byte')
+        metrics.uart_bytes.inc(received)
+        if capture is not None:
+            capture.write(framer.chunk, framer.read_time[1])
+
+        # Frames are views of the framer buffer, they are processed before the
+        # next read
+        reset_reboots_cnt_flag = process_frames(log_writer, frame_filter,
+                                                framer.frames(),
+                                                reset_reboots_cnt_flag)
+
+
+
+def process_frames(log_writer, frame_filter, events, reset_reboots_cnt_flag):
+    """
+    Handle events of the framer. Log messages go to the writer through
+    frame_filter
+
+    returns:
+        reset_reboots_cnt_flag
+    """
+    for kind,frame,arrival in events:
+
+        # Noise or a broken CRC-checked frame. It's just counted, the framer
+        # has already resynchronised
+        if kind == CORRUPT_FRAME:
+            metrics.uart_corrupt_frames.inc()
+            continue
+
+        # Case of the too long message without EOL symbol
+        if kind == TOO_LONG_FRAME:
+            metrics.uart_too_long_frames.inc()
+            log_writer.warning("Message is too long")
+            if uart_framing == 'crc':
+                continue
+            time.sleep(too_long_message_sleep)
+            sudo_reboot()
+
+        # EOL symbol just alone?
+        if kind == EMPTY_FRAME:
+            metrics.uart_empty_frames.inc()
+            log_writer.warning("Empty message: '{}'".format(repr(b'\r')))
+            continue
+
+        # Records are committed to the drive by the handler itself according
+        # to its durability policy
+        metrics.uart_frames.inc()
+        reset_reboots_cnt_flag = process_message(log_writer, frame_filter,
+                                                 frame, arrival,
+                                                 reset_reboots_cnt_flag)
+
+    return reset_reboots_cnt_flag
+
+
+
+def process_message(log_writer, frame_filter, frame, arrival,
+                    reset_reboots_cnt_flag):
+    """
+    Parse type of a log message and pass it to the writer thread. Service
+    messages are executed right here. The level is classified by the first
+    byte and the payload is passed on as bytes, without decoding, together
+    with the arrival stamps of the frame (see Framer.arrival()).
+
+    returns:
+        reset_reboots_cnt_flag
+    """
+    levelno = frame_level(frame)
+    if levelno is not None:
+        payload,decode_error = frame_payload(frame)
+        if decode_error is not None:
+            metrics.uart_decode_errors.inc()
+            log_writer.warning("{}".format(decode_error))
+        frame_filter.log(levelno, payload, *arrival)
+
+    # Ping-like message transmitted for us by the target to be sure that
+    # it is alive
+    elif frame == b'is_present':
+        # We have dedicated resets counter in file. But we need to reset it
+        # sometimes, right? We do it only once per program run, at condition
+        # of a successful transmission.
+        if not reset_reboots_cnt_flag:
+            # Cancel reboot, if there was planned one
+            hardware().cancel_reboot()
+            reset_reboots_cnt()
+            reset_reboots_cnt_flag = True
+            print('Reboots counter was cleared')
+
+    elif frame == b'end':
+        frame_filter.flush(final=True)
+        log_writer.log(logging.INFO, "Program terminated by the target")
+        program_exit()
+        sys.exit()
+
+    # If a message isn't of any recognizable type
+    else:
+        log_writer.log(logging.WARNING,
+                       "Undefined message: {}".format(repr(frame_text(frame))))
+
+    return reset_reboots_cnt_flag
+
+
+
+def start_metrics(log_writer):
+    """
+    Expose metrics (see metrics_address) and write the stats line into the log
+    every metrics_log_interval seconds
+    """
+    queue = log_writer.queue
+    metrics.startup.function = lambda: {name: elapsed for name,(elapsed,wall)
+                                        in startup_milestones.items()}
+    metrics.Gauge('frame_queue_length', 'Frames waiting for the writer',
+                  lambda: len(queue))
+    metrics.Gauge('frame_queue_high_water_mark',
+                  'Maximal observed length of the frame queue',
+                  lambda: queue.high_water_mark)
+    metrics.Gauge('frame_queue_overflows',
+                  'Frames blocked, dropped or spilled by the full queue',
+                  lambda: {event: queue.stats()[event] for event in
+                           ('blocked', 'dropped', 'spilled')},
+                  label='event')
+    metrics.Gauge('spool_bytes', 'Undrained data in the outage spool',
+                  lambda: len(log_writer.spool))
+    metrics.stats_line_extras.append(
+        lambda: 'queue {}/{} (max {})'.format(len(queue), queue.maxsize,
+                                              queue.high_water_mark))
+
+    if metrics_address is not None:
+        try:
+            server = metrics.MetricsServer(metrics_address)
+            server.start()
+            exit_routines.append(server.stop)
+        except Exception as e:
+            print("Can't start the metrics server: {}".format(e))
+
+    if metrics_log_interval:
+        stats_logger = metrics.StatsLogger(log_writer.info,
+                                           metrics_log_interval)
+        stats_logger.start()
+        exit_routines.append(stats_logger.stop)
+
+
+
+def start_publisher(log_writer, names=None):
+    """
+    Stream frames to live tail subscribers (see publisher_address)
+    """
+    if publisher_address is None:
+        return
+    try:
+        publisher = FramePublisher(publisher_address, names=names)
+        publisher.start()
+        exit_routines.append(publisher.stop)
+        log_writer.publisher = publisher
+    except Exception as e:
+        print("Can't start the live tail publisher: {}".format(e))
+
+
+
+def main_multi():
+    """
+    Alternative main function serving all serial_ports concurrently by the
+    asyncio core (or by worker processes with multi_process). Every port has its
+    own output file on the drive, a failure of one port doesn't touch the
+    others.
+    """
+
+    setup_console()
+    hardware().led(True)
+
+    signal.signal(signal.SIGINT, ctrlc_handler)
+    signal.signal(signal.SIGTERM, ctrlc_handler)
+
+    # The writer activates the drive (and opens all channels) while ports are
+    # already being read
+    frame_queue = FrameQueue(
+        spill=Spool(os.path.join(spool_dir, 'overflow'))
+    )
+    log_writer = LogWriter(logger, frame_queue, None,
+                           Spool(os.path.join(spool_dir, 'outage')),
+                           port_log_filenames(serial_ports, log_filename))
+    exit_routines.append(log_writer.stop)
+    log_writer.start()
+    start_metrics(log_writer)
+    start_publisher(log_writer, [port['name'] for port in serial_ports])
+
+    if multi_process:
+        supervisor = WorkerSupervisor(log_writer, serial_ports)
+        # Workers go first so the writer gets their last frames
+        exit_routines.insert(0, supervisor.stop)
+        supervisor.run()
+    else:
+        asyncio.run(serve_ports(log_writer, serial_ports))
 
-        # Force flush after every message for certainty
-        logging_file_handler.flush()
+    logger.info("All ports are terminated by their targets")
+    program_exit()
 
 
 
@@ -203,4 +375,7 @@ independentely. For example, we can write test() which deliver similar but
 different functionality compared to main(), and run it instead of main().
 """
 if __name__ == '__main__':
-    main()
+    if multi_port:
+        main_multi()
+    else:
+        main()
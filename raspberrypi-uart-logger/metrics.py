@@ -0,0 +1,380 @@
+"""
+Module with the instrumentation of the logger: counters, gauges and latency
+histograms that are updated along the whole path of a frame (UART reading,
+queueing, writing and committing to the drive). They are exposed in the
+Prometheus text format by MetricsServer (HTTP on the localhost or on a Unix
+socket, e.g. 'curl --unix-socket metrics.sock http://localhost/metrics') and
+summarized periodically into the log as a compact stats line (see StatsLogger).
+
+Updates are plain attribute increments without locks: every metric is updated
+by one thread (or rarely by a couple of them) and an occasionally lost
+increment is not worth the cost of a lock on the hot path.
+"""
+
+import os, time, bisect, threading, socketserver, collections
+from http.server import BaseHTTPRequestHandler
+
+
+
+# Registered metrics in order of registration
+registry = collections.OrderedDict()
+
+# Upper bounds of latency buckets in seconds
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return '{:d}'.format(int(value))
+    return '{}'.format(value)
+
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        registry[name] = self
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name,self.value
+
+
+
+class Gauge:
+    """
+    Gauge with either a set value or a function that is called at the moment
+    of exposition. The function may return a dict {label value: value} to
+    expose a set of labeled samples (label is the name of the label). With a
+    tuple of label names keys of the dict are tuples of values
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, function=None, label=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.label = label
+        self.value = 0
+        registry[name] = self
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        if isinstance(value, dict):
+            labels = self.label if isinstance(self.label, tuple) else\
+                     (self.label,)
+            for label_values,sample in value.items():
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                yield '{}{{{}}}'.format(self.name, ','.join(
+                    '{}="{}"'.format(label, label_value) for label,label_value
+                    in zip(labels, label_values))),sample
+        elif value is not None:
+            yield self.name,value
+
+
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # The last one is for values above the largest bound (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        registry[name] = self
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """
+        Context manager that observes the duration of its block
+        """
+        return Timer(self)
+
+    def quantile(self, q, counts=None):
+        """
+        Estimate of the quantile (the upper bound of its bucket)
+        """
+        counts = counts or self.counts
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for bound,count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        cumulative = 0
+        for bound,count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '{}_bucket{{le="{}"}}'.format(self.name, bound),cumulative
+        yield '{}_bucket{{le="+Inf"}}'.format(self.name),self.count
+        yield '{}_sum'.format(self.name),self.sum
+        yield '{}_count'.format(self.name),self.count
+
+
+
+class Timer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+
+def render():
+    """
+    returns:
+        all metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in list(registry.values()):
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print(e)
+            continue
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        lines.extend('{} {}'.format(name, format_value(value))
+                     for name,value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+
+# UART ingest (reader)
+uart_bytes = Counter('uart_bytes_total', 'Bytes read from UART')
+uart_frames = Counter('uart_frames_total', 'Frames parsed from UART')
+uart_decode_errors = Counter('uart_decode_errors_total',
+                             'Frames with UTF-8 decode errors')
+uart_too_long_frames = Counter('uart_too_long_frames_total',
+                               'Frames dropped as too long')
+uart_empty_frames = Counter('uart_empty_frames_total', 'Empty frames')
+uart_corrupt_frames = Counter('uart_corrupt_frames_total',
+                              'CRC-checked frames with a wrong length or CRC '
+                              'and dropped noise')
+uart_collapsed_frames = Counter('uart_collapsed_frames_total',
+                                'Repeated messages collapsed into summaries')
+uart_rate_limited_frames = Counter('uart_rate_limited_frames_total',
+                                   'Messages dropped by the rate limits')
+uart_read_errors = Counter('uart_read_errors_total',
+                           'Errors of the serial port')
+uart_timeouts = Counter('uart_timeouts_total',
+                        'Read timeouts (the target is silent)')
+
+# Writer and drive
+frames_written = Counter('log_frames_written_total',
+                         'Frames written to log files')
+bytes_written = Counter('log_bytes_written_total',
+                        'Bytes (characters) written to log files')
+flush_seconds = Histogram('log_flush_seconds',
+                          'Time spent in CustomFileHandler.flush()')
+commit_seconds = Histogram('log_commit_seconds',
+                           'Latency of commits (write out + fsync)')
+ingest_to_disk = Histogram('log_ingest_to_disk_seconds',
+                           'Time from the arrival of a frame (its EOL symbol) '
+                           'to its commit')
+rollovers = Counter('log_rollovers_total', 'New log segments started')
+publisher_dropped_subscribers = Counter('publisher_dropped_subscribers_total',
+    'Live tail subscribers disconnected for being slow')
+publisher_errors = Counter('publisher_errors_total',
+    'Frames the live tail publisher has failed to take')
+drive_losses = Counter('drive_losses_total', 'Drive losses detected')
+drive_swaps = Counter('drive_swaps_total',
+                      'Drives activated by the hot swap')
+
+# Adaptive commit policies of log files (file name -> AdaptiveCommitPolicy)
+commit_policies = {}
+commit_mode = Gauge('log_commit_mode',
+                    'Commit mode of log files (1 for the current one)',
+                    lambda: {(name, mode): int(policy.mode == mode)
+                             for name,policy in commit_policies.items()
+                             for mode in ('immediate', 'batch')},
+                    label=('file', 'mode'))
+commit_batch_records = Gauge('log_commit_batch_records',
+                             'Records per commit chosen by the policy',
+                             lambda: {name: policy.records for name,policy
+                                      in commit_policies.items()},
+                             label='file')
+commit_batch_age = Gauge('log_commit_batch_age_seconds',
+                         'Maximal age of a batch chosen by the policy',
+                         lambda: {name: policy.age for name,policy
+                                  in commit_policies.items()},
+                         label='file')
+record_rate = Gauge('log_record_rate',
+                    'Estimated rate of incoming records (per second)',
+                    lambda: {name: policy.rate for name,policy
+                             in commit_policies.items()},
+                    label='file')
+
+startup = Gauge('startup_seconds',
+                'Startup milestones (seconds since the process start)',
+                label='milestone')
+
+
+
+# Functions returning additional parts of the stats line (e.g. the queue state)
+stats_line_extras = [
+    lambda: ', '.join('{} {} x{}'.format(name, policy.mode, policy.records)
+                      for name,policy in commit_policies.items())
+]
+
+
+
+def stats_line(state):
+    """
+    Compact summary of the metrics since the previous call. state is a dict
+    kept by the caller between calls
+    """
+    now = time.monotonic()
+    elapsed = now - state.get('time', now) or 1
+    frames = uart_frames.value
+    received = uart_bytes.value
+    written = frames_written.value
+    commit_counts = list(commit_seconds.counts)
+    recent_commits = [count - previous for count,previous in
+                      zip(commit_counts, state.get('commit_counts',
+                                                   [0] * len(commit_counts)))]
+    p50 = commit_seconds.quantile(0.5, recent_commits)
+    p99 = commit_seconds.quantile(0.99, recent_commits)
+    ingest_counts = list(ingest_to_disk.counts)
+    recent_ingests = [count - previous for count,previous in
+                      zip(ingest_counts, state.get('ingest_counts',
+                                                   [0] * len(ingest_counts)))]
+    ingest_p99 = ingest_to_disk.quantile(0.99, recent_ingests)
+    line = ("Stats: {:.1f} frames/s, {:.0f} B/s in, {:.1f} frames/s written, "
+            "decode errors {}, too long {}, corrupt {}, collapsed {}, "
+            "rate limited {}, commit p50 {} p99 {}, ingest to disk p99 {}"
+            .format(
+                (frames - state.get('frames', 0)) / elapsed,
+                (received - state.get('bytes', 0)) / elapsed,
+                (written - state.get('written', 0)) / elapsed,
+                uart_decode_errors.value, uart_too_long_frames.value,
+                uart_corrupt_frames.value, uart_collapsed_frames.value,
+                uart_rate_limited_frames.value,
+                '-' if p50 is None else '{:g} ms'.format(p50 * 1000),
+                '-' if p99 is None else '{:g} ms'.format(p99 * 1000),
+                '-' if ingest_p99 is None else
+                '{:g} ms'.format(ingest_p99 * 1000)))
+    extra = [function() for function in stats_line_extras]
+    if extra:
+        line += ', ' + ', '.join(item for item in extra if item)
+    state.update({'time': now, 'frames': frames, 'bytes': received,
+                  'written': written, 'commit_counts': commit_counts,
+                  'ingest_counts': ingest_counts})
+    return line
+
+
+class StatsLogger(threading.Thread):
+    """
+    Passes the stats line to log(msg) every interval seconds
+    """
+
+    def __init__(self, log, interval):
+        super(StatsLogger, self).__init__(name='StatsLogger', daemon=True)
+        self.log = log
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.state = {}
+        stats_line(self.state)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.log(stats_line(self.state))
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # No access log (and Unix socket clients have no address)
+        pass
+
+
+
+class TCPMetricsServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves render() over HTTP. address is a path of a Unix socket or a
+    (host,port) tuple (keep the host at 127.0.0.1)
+    """
+
+    def __init__(self, address):
+        super(MetricsServer, self).__init__(name='MetricsServer', daemon=True)
+        self.address = address
+        if isinstance(address, str):
+            # A stale socket of the previous run
+            if os.path.exists(address):
+                os.remove(address)
+            os.makedirs(os.path.dirname(address) or '.', exist_ok=True)
+            self.server = UnixMetricsServer(address, MetricsRequestHandler)
+        else:
+            self.server = TCPMetricsServer(address, MetricsRequestHandler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
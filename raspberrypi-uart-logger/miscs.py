@@ -3,22 +3,52 @@ Module with general global objects and support functions. It needs to be
 imported by all other modules but not vice versa.
 """
 
-import os, sys, serial, logging, subprocess
-import RPi.GPIO as GPIO
-
-
-
-# Serial object is global
-ser = serial.Serial()
-ser.port = '/dev/ttyAMA0'
-ser.baudrate = 115200
+import os, sys, time, logging, threading
+from backends import RaspberryPiBackend, SimulatedBackend
+
+
+
+# Hardware backend (see backends.py): 'raspberrypi' or 'simulated' to run (and
+# profile) the whole logger on any Linux machine. The simulation lives in
+# simulation_dir: serial ports that don't exist are ptys (write the traffic of
+# the target to simulation_dir/<port name>, e.g. ttyAMA0), drives are
+# directories in simulation_dir/drives (mkdir/rm them to plug/pull drives) and
+# reboots are recorded into simulation_dir/reboots.txt instead
+hardware_backend = 'raspberrypi'
+
+# Serial port of the single-port mode
+uart_port = '/dev/ttyAMA0'
+uart_baudrate = 115200
+
+# Multi-port mode: serve all serial_ports concurrently (asyncio core) instead of
+# the single uart_port. Every port writes to its own file (log_filename with the
+# port name, e.g. uartlog-board1.txt). Missing baudrate/timeout are taken from
+# uart_baudrate/uart_timeout
+multi_port = False
+serial_ports = [
+    {'name': 'board1', 'port': '/dev/ttyUSB0', 'baudrate': 115200},
+    {'name': 'board2', 'port': '/dev/ttyUSB1', 'baudrate': 115200},
+]
+# Serve every port of the multi-port mode by its own worker process (reading,
+# framing and formatting on all CPU cores) instead of the single event loop.
+# Only the main process writes to the drive. A crashed worker is restarted
+# after worker_restart_time
+multi_process = False
+worker_restart_time = 5  # seconds
 
 # To get a full period multiply (usart_reconnect_retry_time * usart_reconnect_tries)
 usart_reconnect_retry_time = 60  # seconds
 usart_reconnect_tries = 1
 
-# To get a full period multiply (ser.timeout * no_ping_tries)
-ser.timeout = 60  # seconds
+# Read errors of the open port: the read is retried after
+# usart_read_error_retry_time, after usart_read_error_tries errors in a row
+# (e.g. an unplugged USB-UART converter) the port is reopened (see
+# usart_connect(), the reboot if it fails)
+usart_read_error_retry_time = 1  # seconds
+usart_read_error_tries = 10
+
+# To get a full period multiply (uart_timeout * no_ping_tries)
+uart_timeout = 60  # seconds
 no_ping_tries = 10
 
 # Number of bytes that we consider as a too long message without an EOL symbol
@@ -26,6 +56,20 @@ no_ping_tries = 10
 too_long_message = 1000
 too_long_message_sleep = 1800  # seconds
 
+# Maximal number of bytes taken from the serial port at once. The main loop
+# reads everything that is already waiting in the port (but not more than this)
+read_chunk_size = 4096  # bytes
+
+# Check that payloads of log messages are valid UTF-8 (broken bytes are dropped
+# with a warning). Turned off, payloads are written to the log as they came
+uart_validate_utf8 = True
+
+# 'text' - messages are cut on the EOL symbol only. 'crc' - CRC-checked frames
+# with a start marker and a length are taken as well (see framing.py and
+# client-usage-example): a noise burst costs only the frames it has hit, it's
+# counted and never leads to too_long_message_sleep and the reboot
+uart_framing = 'text'
+
 
 # Drive descrption
 possible_drives = ['sd{}1'.format(letter) for letter in
@@ -33,8 +77,82 @@ possible_drives = ['sd{}1'.format(letter) for letter in
 drive = '?'  # initial name
 drive_mountpoint = '/mnt'
 drive_name = 'LOGS'  # we detect (and format) drives with such name
+# Root of /sys, /proc and /dev used to discover block devices (see
+# blockdevices.py), can be pointed to a fixture directory tree
+sysroot = '/'
 log_filename = 'uartlog.txt'
 
+# Log rotation: None (default, single log_filename file), 'size' or 'time'.
+# Segments are named like uartlog-YYYYMMDD-NNNN.txt. The size of a segment must
+# stay below the FAT32 maximal file size (4 GB). When the free space on the
+# drive falls below log_min_free_space the oldest segments are deleted
+log_rotation = None
+log_rotation_size = 1024 * 1024 * 1024  # bytes
+log_rotation_time = 24 * 60 * 60  # seconds
+log_min_free_space = 64 * 1024 * 1024  # bytes
+log_free_space_check_time = 60  # seconds
+
+# Compression of log files: None, 'gzip' or 'zstd' (needs 'zstandard' package).
+# Files get .gz/.zst suffix and are readable with zcat/zstdcat up to the last
+# commit even if the drive is pulled
+log_compression = None
+log_compression_level = 6
+
+# Preallocation of plain text logs (see prealloc.py): files grow by
+# log_preallocate_size extents so commits don't update the FAT and the
+# directory entry, the data is written in pieces aligned to the erase block of
+# the flash (log_erase_block_size) and a commit rewrites only the last partial
+# log_write_page_size page. A drive pulled without the unmount keeps the NUL
+# tail of the last extent in the file (it's cut off by the logger when the file
+# is opened again, or with prealloc.py). On vfat drives the extents are
+# allocated without changing the file size (posix_fallocate() would zero-fill
+# them), so there is no tail there. Compressed and binary logs are not
+# preallocated
+log_preallocate = False
+log_preallocate_size = 4 * 1024 * 1024  # bytes
+log_erase_block_size = 128 * 1024  # bytes
+log_write_page_size = 4096  # bytes
+
+# Format of log files: 'text' (see log_formatter_string) or 'binary' (compact
+# records with a sparse time index next to them, read them with uartlogcat.py).
+# Compression is not applied to binary logs
+log_format = 'text'
+binlog_index_interval = 256  # records
+
+# Resolution of timestamps in text logs: 'ms' or 'us' (microseconds). Frames
+# are stamped with the time their first byte has been read from the port, not
+# the time they are written out
+log_time_resolution = 'ms'
+
+# Durability policy of the log file (see CustomFileHandler). Records are batched
+# between commits (flush + fsync). A commit happens after every
+# fsync_every_records records, at most fsync_every_time milliseconds after the
+# previous one and right away for records of fsync_immediately_level and higher.
+# So a sudden power cut loses at most the uncommitted batch of messages below
+# fsync_immediately_level (up to fsync_every_records records not older than
+# fsync_every_time milliseconds) plus the frames still waiting in the writer
+# queue (up to frame_queue_size, whatever their level). Set
+# fsync_every_records = 1 to get the strict per-line durability of the handler
+# back
+fsync_every_records = 50
+fsync_every_time = 1000  # milliseconds
+fsync_immediately_level = logging.ERROR
+# Adaptive durability: the batch follows the incoming rate within the bounds
+# above. Idle periods get every record committed right away, bursts get batches
+# just big enough to keep the time spent in commits below fsync_adaptive_duty
+# (share of the wall time). The rate is estimated every fsync_adaptive_window
+# milliseconds. The chosen mode is exposed in metrics (log_commit_mode)
+fsync_adaptive = True
+fsync_adaptive_duty = 0.1
+fsync_adaptive_window = 250  # milliseconds
+
+# Presence of the drive is watched in background instead of checking it on
+# every flush. Backend: 'netlink' (kernel uevents), 'inotify' (on /dev), 'poll'
+# (check every drive_monitor_poll_time seconds), 'auto' (first available of
+# them) or None (old per-flush os.path.exists() check)
+drive_monitor_backend = 'auto'
+drive_monitor_poll_time = 1  # seconds
+
 # Used in check_drive() function to provide several tries to initialize the drive
 mount_tries = 3
 check_drive_retry_time = 5  # seconds
@@ -43,6 +161,10 @@ check_drive_retry_time = 5  # seconds
 wait_for_drive_tries = 60
 wait_for_drive_time = 5  # seconds
 
+# Replace the pulled drive on the fly instead of the reboot. Frames go to the
+# spool while there is no drive and are drained onto the new one
+hot_swap = True
+
 # Wrap around check_drive() function adds additional tries
 activation_tries = 3
 activation_tries_time = 10  # seconds
@@ -54,6 +176,63 @@ delay_after_continuous_reboots = 60  # minutes
 
 workdir = '/opt/raspberrypi-uart-logger'
 reboots_cnt_filename = '{}/reboots_cnt.txt'.format(workdir)
+simulation_dir = '{}/simulation'.format(workdir)
+
+# Bounded queue between the UART reader and the drive writer thread. When it is
+# full the overflow policy is applied: 'block' the reader, 'drop_debug' (drop
+# the least important frames, DEBUG first) or 'spill' frames to the SD card
+frame_queue_size = 10000  # frames
+frame_queue_overflow_policy = 'spill'
+# At the exit the writer is given that long to write out the rest of the queue
+# (it can be stuck activating a drive), then the rest goes to the spool
+writer_stop_timeout = 30  # seconds
+
+# Persistent spool on the SD card for frames that can't reach the drive right
+# now. There are two spools: 'outage' (no drive) and 'overflow' (the queue is
+# full). Each one is capped with spool_max_size, when it's exceeded
+# spool_eviction_policy is applied: 'drop_oldest' segment or 'drop_newest'
+# (refuse new frames)
+spool_dir = '{}/spool'.format(workdir)
+spool_segment_size = 1024 * 1024  # bytes
+spool_max_size = 64 * 1024 * 1024  # bytes
+spool_eviction_policy = 'drop_oldest'
+spool_drain_batch_size = 1000  # frames
+
+# Raw capture: every chunk read from the port is stored as it is, with its
+# arrival time, into raw_capture_dir on the SD card (uartraw.raw or
+# uartraw-<name>.raw in the multi-port mode, next to the parsed log) to replay
+# it later (see rawcapture.py and benchmarks/replay_capture.py). The file is
+# moved to '.1' at raw_capture_max_size and at the program start
+raw_capture = False
+raw_capture_dir = '{}/capture'.format(workdir)
+raw_capture_max_size = 64 * 1024 * 1024  # bytes
+
+# Protection of the drive against log storms of the target (see
+# framefilter.py). log_rate_limits are per-level token buckets: level ->
+# (messages per second, burst), e.g. {logging.DEBUG: (100, 500)}. None
+# disables them. With log_repeat_window (e.g. 1 second) a message repeating the
+# previous one (same level and payload) within the window is collapsed into
+# "repeated N times" summaries (one per log_repeat_summary_interval while the
+# storm lasts), only consecutive repeats are collapsed. None (default) disables
+# the collapsing. CRITICAL messages always pass through
+log_rate_limits = None
+log_repeat_window = None  # seconds
+log_repeat_summary_interval = 10  # seconds
+
+
+# Metrics in the Prometheus text format are served over HTTP on this Unix
+# socket path (curl --unix-socket ... http://localhost/metrics) or on a
+# ('127.0.0.1', port) address. None disables the server. A compact stats line
+# is written into the log every metrics_log_interval seconds (None disables it)
+metrics_address = '{}/metrics.sock'.format(workdir)
+metrics_log_interval = 600  # seconds
+
+# Live tail: parsed frames are streamed to local subscribers on this Unix socket
+# (see publisher.py and uarttail.py), None disables it. Every subscriber has its
+# own send buffer of publisher_buffer_size, a client that doesn't keep up is
+# disconnected so subscribers never slow down the logging
+publisher_address = '{}/frames.sock'.format(workdir)
+publisher_buffer_size = 256 * 1024  # bytes
 
 
 # Return codes of functions
@@ -67,10 +246,121 @@ LED_GPIO = 18
 
 # Logger instance goes through the whole program
 log_formatter_string = '%(levelname)-8s [%(asctime)s] %(message)s'
-formatter = logging.Formatter(log_formatter_string)
-logging.basicConfig(format=log_formatter_string, level=logging.DEBUG)
+
+
+
+class Formatter(logging.Formatter):
+    """
+    logging.Formatter that prints the time with log_time_resolution (so service
+    messages look the same as UART frames, see FastFormatter)
+    """
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt is not None or log_time_resolution != 'us':
+            return super(Formatter, self).formatTime(record, datefmt)
+        second = int(record.created)
+        return '{},{:06d}'.format(time.strftime(self.default_time_format,
+                                                self.converter(second)),
+                                  int((record.created - second) * 1000000))
+
+formatter = Formatter(log_formatter_string)
 logger = logging.getLogger('')
 
+# UART frames bypass the logger and go straight to the file (see
+# CustomFileHandler.write_frame()). Set to True to print them to stdout as well
+# (for debugging, costs a LogRecord per frame)
+echo_frames = False
+
+# Startup milestones (name -> time since the process start in seconds and the
+# wall clock time, in order of occurrence) that are reported into the log once
+# the first UART frame reaches the drive. The process start is taken from the
+# kernel so the interpreter start and imports are counted as well
+startup_milestones = {}
+# See process_start_time(), taken with the first milestone
+program_start_time = None
+program_start_after_boot = None
+
+# Created on the first use, see hardware()
+hardware_instance = None
+
+
+
+def setup_console():
+    """
+    Print the service and diagnostic messages to the console (stderr). It's
+    done by main functions, not on the import
+    """
+    logging.basicConfig(format=log_formatter_string, level=logging.DEBUG)
+
+
+
+def hardware():
+    """
+    returns:
+        the hardware backend (see hardware_backend), the same for the whole
+        program run
+    """
+    global hardware_instance
+    if hardware_instance is None:
+        if hardware_backend == 'simulated':
+            hardware_instance = SimulatedBackend(simulation_dir,
+                                                 possible_drives[0])
+        else:
+            hardware_instance = RaspberryPiBackend(LED_GPIO, sysroot)
+    return hardware_instance
+
+
+
+def process_start_time():
+    """
+    returns:
+        time.monotonic() value at the moment the process was started,
+        seconds since the boot at that moment
+    """
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # The command name can contain spaces so count fields after ')'
+            stat = stat_file.read().rsplit(')', 1)[1].split()
+        started = int(stat[19]) / os.sysconf('SC_CLK_TCK')
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - started
+        return time.monotonic() - age,started
+    except Exception as e:
+        print(e)
+        return time.monotonic(),None
+
+
+
+def startup_milestone(name, reached=None):
+    """
+    Remember the first time the milestone is reached. reached is
+    time.monotonic() of it if it's not right now
+    """
+    global program_start_time,program_start_after_boot
+    if program_start_time is None:
+        program_start_time,program_start_after_boot = process_start_time()
+    if name not in startup_milestones:
+        now = time.monotonic()
+        if reached is None:
+            reached = now
+        startup_milestones[name] = (reached - program_start_time,
+                                    time.time() - (now - reached))
+
+
+
+def startup_report():
+    return "Startup timings (seconds since the program start{}): {}".format(
+        '' if program_start_after_boot is None else
+        ', it was started {:.3f} seconds after the boot'.format(
+            program_start_after_boot),
+        ', '.join('{} {:.3f}'.format(name, elapsed)
+                  for name,(elapsed,wall) in startup_milestones.items()))
+
+
+
+# Routines that are run at the program exit before the logging is shut down
+# (e.g. to write out frames that are still in the queue)
+exit_routines = []
+
 
 
 def program_exit():
@@ -78,9 +368,14 @@ def program_exit():
     Correct close of the program
     """
     print('Program exit')
+    for routine in exit_routines:
+        try:
+            routine()
+        except Exception as e:
+            print(e)
     logging.shutdown()
-    ser.close()
-    GPIO.output(LED_GPIO, False)
+    if hardware_instance is not None:
+        hardware_instance.led(False)
 
 
 
@@ -115,10 +410,9 @@ def sudo_reboot():
 
             if reboots_cnt > num_of_continuous_reboots:
                 program_exit()
-                subprocess.run(['sudo', 'shutdown', '-r', '+{}'
-                    .format(delay_after_continuous_reboots)])  # 60 - 1h
+                hardware().reboot(delay_after_continuous_reboots)  # 60 - 1h
                 print('Reboot has been sheduled')
-                sys.exit()
+                exit_after_reboot()
 
         # Else create the file and write '1' to it:
         else:
@@ -131,8 +425,23 @@ def sudo_reboot():
 
     program_exit()
     print('Reboot now')
-    subprocess.run(['sudo', 'reboot'])
-    sys.exit()
+    hardware().reboot()
+    exit_after_reboot()
+
+
+
+def exit_after_reboot():
+    """
+    sys.exit() ends only the thread it's called in. A reboot can also be
+    requested by the writer thread (drive activation) or the drive swap one and
+    program_exit() has already closed everything, so the whole process is ended
+    then (startup_script.sh takes over)
+    """
+    if threading.current_thread() is threading.main_thread():
+        sys.exit()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
 
 
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+Module with the preallocated plain log file. Appending small batches of lines
+to a file on vfat updates the FAT and the directory entry (the new size) on
+almost every fsync, and cheap flash drives wear out under that pattern. So:
+
+ - the file is extended by large extents at once (posix_fallocate), the size
+   changes once per extent and commits only write the data itself
+ - the data goes out in pieces that end on erase block boundaries of the flash
+   and start on a page boundary: a commit rewrites the last partial page only,
+   a full erase block is written at once
+
+posix_fallocate() on vfat grows the file through fat_cont_expand() that writes
+the whole extent with zeros, so every byte would go to the flash twice. On vfat
+and msdos (what the logger formats drives to) the extents are allocated by
+fallocate() with FALLOC_FL_KEEP_SIZE instead: the cluster chain is allocated
+(one FAT update per extent) without zero-filling and the file size stays equal
+to the data length, so a commit updates the directory entry only. The unused
+clusters are released when the file is closed, a drive pulled without the
+unmount leaves them to fsck. benchmarks/bench_prealloc.py measures both on the
+drive.
+
+On other file systems the file size covers the preallocated tail (NUL bytes),
+the true data length is recorded as the file size when the file is closed (the
+tail is truncated). If the drive is pulled or the power is cut the tail stays,
+it's cut off when the file is opened by the logger again. Text logs never have
+NUL bytes at their end (every line ends with the terminator) so the length is
+always recoverable, e.g. on another machine:
+
+    python3 prealloc.py /media/LOGS/uartlog-*.txt
+
+The module depends on the standard library only.
+"""
+
+import os, re, sys, errno, ctypes, ctypes.util
+
+
+
+# File systems where posix_fallocate() zero-fills the extent
+zero_filling_filesystems = ('vfat', 'msdos')
+
+# fallocate() mode that allocates the blocks without changing the file size
+# (see fallocate(2))
+FALLOC_FL_KEEP_SIZE = 0x01
+
+
+
+class PreallocatedStream:
+    """
+    Drop-in replacement of LineStream (takes text and bytes lines, flush() is
+    called by the handler on commits). keep_size tells whether the extents
+    are allocated without changing the file size (FALLOC_FL_KEEP_SIZE), None -
+    if the file is on zero_filling_filesystems
+    """
+
+    def __init__(self, filename, extent_size=4*1024*1024,
+                 erase_block_size=128*1024, page_size=4096, encoding='utf-8',
+                 keep_size=None):
+        if keep_size is None:
+            keep_size = filesystem_type(filename) in zero_filling_filesystems
+        self.keep_size = keep_size
+        # False if the file system can't allocate the extents, the file grows
+        # with the data then
+        self.allocate = True
+        self.extent_size = extent_size
+        self.erase_block_size = erase_block_size
+        self.page_size = page_size
+        self.encoding = encoding or 'utf-8'
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            self.allocated = os.fstat(self.fd).st_size
+            self.length = data_length(self.fd, self.allocated)
+            # Data that is not written out yet, from the start of the page
+            # (the partial page is written again with the next data)
+            self.buffer_start = self.length - self.length % page_size
+            self.buffer = bytearray(os.pread(self.fd,
+                                             self.length - self.buffer_start,
+                                             self.buffer_start))
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.dirty = False
+
+    def write(self, line):
+        if isinstance(line, str):
+            line = line.encode(self.encoding)
+        self.buffer += line
+        self.length += len(line)
+        self.dirty = True
+        boundary = self.length - self.length % self.erase_block_size
+        if boundary > self.buffer_start:
+            self.write_out(boundary)
+
+    def write_out(self, end):
+        """
+        Write the buffer up to the file offset end
+        """
+        if self.allocate and end > self.allocated:
+            size = end - self.allocated
+            size += -size % self.extent_size
+            if self.keep_size:
+                self.allocate = fallocate_keep_size(self.fd, self.allocated,
+                                                    size)
+            else:
+                os.posix_fallocate(self.fd, self.allocated, size)
+            self.allocated += size
+        data = memoryview(self.buffer)[:end-self.buffer_start]
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fd, data[written:],
+                                 self.buffer_start + written)
+        data.release()
+        keep = end - end % self.page_size
+        del self.buffer[:keep-self.buffer_start]
+        self.buffer_start = keep
+        self.dirty = self.length > end
+
+    def flush(self):
+        if self.dirty:
+            self.write_out(self.length)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        """
+        Write out the rest and record the true length
+        """
+        if self.fd is None:
+            return
+        try:
+            self.flush()
+            os.ftruncate(self.fd, self.length)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+def fallocate_keep_size(fd, offset, length):
+    """
+    Allocate the blocks of the file range without changing the file size (os
+    has no wrapper of fallocate())
+
+    returns:
+        False if the file system doesn't support it
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # 64-bit offsets on 32-bit systems as well
+    fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                          ctypes.c_int64]
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) < 0:
+        error = ctypes.get_errno()
+        if error == errno.EOPNOTSUPP:
+            return False
+        raise OSError(error, os.strerror(error))
+    return True
+
+
+
+def data_length(fd, size, chunk_size=64*1024):
+    """
+    returns:
+        size of the file without the preallocated (NUL) tail
+    """
+    end = size
+    while end > 0:
+        start = max(0, end - chunk_size)
+        data = os.pread(fd, end - start, start).rstrip(b'\0')
+        if data:
+            return start + len(data)
+        end = start
+    return 0
+
+
+
+def filesystem_type(path):
+    """
+    returns:
+        type of the file system the path is on (e.g. 'vfat'), None if unknown
+    """
+    path = os.path.realpath(path)
+    mountpoint,fstype = '',None
+    try:
+        with open('/proc/self/mountinfo') as mountinfo:
+            for line in mountinfo:
+                fields = line.split()
+                # Spaces and such are escaped as octal codes
+                mounted = re.sub(r'\\([0-7]{3})',
+                                 lambda code: chr(int(code.group(1), 8)),
+                                 fields[4])
+                # The deepest mountpoint wins, the last one if mounted over
+                if (path == mounted or
+                    path.startswith(mounted.rstrip('/') + '/')) and\
+                   len(mounted) >= len(mountpoint):
+                    mountpoint = mounted
+                    fstype = fields[fields.index('-', 6) + 1]
+    except (OSError, ValueError, IndexError):
+        return None
+    return fstype
+
+
+
+def file_length(filename):
+    """
+    returns:
+        size of the file without the preallocated tail
+    """
+    with open(filename, 'rb') as log_file:
+        return data_length(log_file.fileno(),
+                           os.fstat(log_file.fileno()).st_size)
+
+
+
+def trim(filename):
+    """
+    Cut the preallocated tail off the file
+
+    returns:
+        number of removed bytes
+    """
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        length = data_length(fd, size)
+        if length < size:
+            os.ftruncate(fd, length)
+        return size - length
+    finally:
+        os.close(fd)
+
+
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        try:
+            print('{}: {} bytes of the tail removed'.format(filename,
+                                                            trim(filename)))
+        except OSError as e:
+            print(e)
@@ -0,0 +1,271 @@
+"""
+Module with the live tail of the log. Parsed frames are streamed to any number
+of local subscribers over a Unix socket, so engineers on site don't need to
+'tail -f' the log on the slow drive (and compete with the logger for it):
+
+    python3 uarttail.py --level W
+
+Lines are the same as in the log file (with the port name in front of them in
+the multi-port mode). A subscriber can send a minimal level at any time as a
+line with a prefix letter (D, I, W, E, C) or a level name, DEBUG by default.
+
+Frames are published by the writer thread, the sockets are served by the
+FramePublisher thread. Every subscriber has its own bounded send buffer: a
+client that doesn't keep up is disconnected when its buffer is full, so
+subscribers never slow down the logging.
+"""
+
+import os, socket, select, logging, threading
+from miscs import *
+from fastformat import FastFormatter
+import metrics
+
+
+
+# Prefix letters of the UART protocol
+level_letters = {
+    'D': logging.DEBUG,
+    'I': logging.INFO,
+    'W': logging.WARNING,
+    'E': logging.ERROR,
+    'C': logging.CRITICAL
+}
+
+
+
+def parse_level(value):
+    """
+    returns:
+        level of a prefix letter or a level name, None if it's unknown
+    """
+    value = value.strip().upper()
+    if value in level_letters:
+        return level_letters[value]
+    levelno = logging.getLevelName(value)
+    return levelno if isinstance(levelno, int) else None
+
+
+
+class Subscriber:
+
+    __slots__ = ('sock', 'level', 'buffer', 'overflowed', 'request',
+                 'reading')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.level = logging.DEBUG
+        # Lines waiting to be sent
+        self.buffer = bytearray()
+        self.overflowed = False
+        # Unfinished line of the level request
+        self.request = b''
+        # False after the client has shut down its sending side
+        self.reading = True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+
+class FramePublisher(threading.Thread):
+    """
+    Call publish() for every frame (in the writer thread). names are names of
+    sources (ports) to put in front of lines, None for the single port
+    """
+
+    def __init__(self, address, buffer_size=publisher_buffer_size, names=None):
+        super(FramePublisher, self).__init__(name='FramePublisher',
+                                             daemon=True)
+        self.address = address
+        self.buffer_size = buffer_size
+        self.prefixes = None if names is None else\
+                        ['[{}] '.format(name).encode('utf-8') for name in names]
+        self.formatter = FastFormatter(log_formatter_string,
+                                       resolution=log_time_resolution)
+        # Stale socket of the previous run
+        if os.path.exists(address):
+            os.remove(address)
+        os.makedirs(os.path.dirname(address) or '.', exist_ok=True)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen()
+        self.server.setblocking(False)
+        # Wakes up the thread when there is something new to send
+        self.wakeup_read,self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # Minimal level any subscriber wants (nothing is formatted below it)
+        self.min_level = logging.CRITICAL + 1
+        self.stopped = False
+
+        # Metrics
+        self.dropped = 0
+
+    def format(self, levelno, created, msg, line):
+        """
+        returns:
+            the log line of the frame in bytes
+        """
+        if line is None:
+            if isinstance(msg, bytes) and self.formatter.specialized:
+                return self.formatter.format_bytes(levelno, created, msg)
+            if isinstance(msg, bytes):
+                msg = msg.decode('utf-8', 'replace')
+            if self.formatter.supported:
+                line = self.formatter.format(levelno, created, msg)
+            else:
+                record = logging.makeLogRecord({'levelno': levelno,
+                    'levelname': logging.getLevelName(levelno), 'msg': msg,
+                    'created': created,
+                    'msecs': (created - int(created)) * 1000})
+                line = formatter.format(record) + '\n'
+        return line.encode('utf-8')
+
+    def publish(self, levelno, created, msg, source=0, line=None):
+        if levelno < self.min_level:
+            return
+        data = self.format(levelno, created, msg, line)
+        if self.prefixes is not None:
+            data = self.prefixes[min(source, len(self.prefixes)-1)] + data
+        wakeup = False
+        with self.lock:
+            for subscriber in self.subscribers:
+                if levelno < subscriber.level or subscriber.overflowed:
+                    continue
+                if len(subscriber.buffer) + len(data) > self.buffer_size:
+                    # Too slow: let the thread disconnect it
+                    subscriber.overflowed = True
+                    wakeup = True
+                    continue
+                wakeup = wakeup or not subscriber.buffer
+                subscriber.buffer += data
+        if wakeup:
+            self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def update_min_level(self):
+        self.min_level = min((subscriber.level for subscriber in
+                              self.subscribers), default=logging.CRITICAL + 1)
+
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                subscribers = list(self.subscribers)
+            readable = [self.server, self.wakeup_read] +\
+                       [subscriber for subscriber in subscribers
+                        if subscriber.reading]
+            writable = [subscriber for subscriber in subscribers
+                        if subscriber.buffer and not subscriber.overflowed]
+            try:
+                readable,writable,exceptional = select.select(readable,
+                                                              writable, [])
+            except (OSError, ValueError):
+                if self.stopped:
+                    return
+                raise
+            for ready in readable:
+                if ready is self.server:
+                    self.accept()
+                elif ready is self.wakeup_read:
+                    try:
+                        os.read(self.wakeup_read, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.receive(ready)
+            for subscriber in writable:
+                if not self.send(subscriber):
+                    self.disconnect(subscriber)
+            for subscriber in subscribers:
+                if subscriber.overflowed and self.disconnect(subscriber):
+                    self.dropped += 1
+                    metrics.publisher_dropped_subscribers.inc()
+
+    def accept(self):
+        try:
+            sock,address = self.server.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        with self.lock:
+            self.subscribers.append(Subscriber(sock))
+            self.update_min_level()
+
+    def receive(self, subscriber):
+        try:
+            data = subscriber.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.disconnect(subscriber)
+            return
+        if not data:
+            # The client has nothing more to say but may still be listening
+            subscriber.reading = False
+            return
+        *requests,subscriber.request = (subscriber.request + data).split(b'\n')
+        for request in requests:
+            levelno = parse_level(request.decode('utf-8', 'replace'))
+            if levelno is not None:
+                with self.lock:
+                    subscriber.level = levelno
+                    self.update_min_level()
+        # A client that never finishes its line isn't worth the memory
+        if len(subscriber.request) > 256:
+            subscriber.request = b''
+
+    def send(self, subscriber):
+        """
+        returns:
+            False if the client has gone
+        """
+        with self.lock:
+            if subscriber not in self.subscribers:
+                return True
+            try:
+                sent = subscriber.sock.send(subscriber.buffer)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            del subscriber.buffer[:sent]
+        return True
+
+    def disconnect(self, subscriber):
+        """
+        returns:
+            False if the subscriber has been already disconnected
+        """
+        with self.lock:
+            if subscriber not in self.subscribers:
+                return False
+            self.subscribers.remove(subscriber)
+            self.update_min_level()
+        try:
+            subscriber.sock.close()
+        except OSError:
+            pass
+        return True
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup()
+        self.join(1)
+        for subscriber in list(self.subscribers):
+            self.disconnect(subscriber)
+        self.server.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        try:
+            os.remove(self.address)
+        except OSError:
+            pass
+        print('Live tail subscribers dropped for being slow: {}'
+              .format(self.dropped))
@@ -0,0 +1,121 @@
+"""
+Module with the raw capture of the UART stream. Every chunk read from the port
+is stored as it is, before any framing, together with its arrival time. So the
+exact byte stream behind garbage lines in the log can be replayed later through
+the framing and parsing code (see benchmarks/replay_capture.py).
+
+Capture file (.raw):
+    b'UARTRAW1' magic, <d wall clock time of the start (Unix time)>, then chunks
+    <Q microseconds since the start> <H length> data
+
+Offsets are taken from the monotonic clock so the replay keeps the original
+pauses even if the wall clock has been adjusted meanwhile. When the file grows
+beyond max_size it is moved to the '.1' file (the previous one is deleted) and a
+new one is started, the same happens to the file of the previous run.
+
+The module depends on the standard library only so captures can be read on any
+machine.
+"""
+
+import os, time, struct
+
+
+
+capture_magic = b'UARTRAW1'
+capture_suffix = '.raw'
+
+capture_header = struct.Struct('<d')
+chunk_header = struct.Struct('<QH')
+max_chunk_size = 0xFFFF
+
+
+
+class RawCapture:
+    """
+    Append-only writer of the capture. Writes are buffered, flush() is called
+    by the reader when the port is idle and close() at the exit. A failed
+    write stops the capture (the log itself goes on)
+    """
+
+    def __init__(self, filename, max_size):
+        self.filename = filename
+        self.max_size = max_size
+        self.file = None
+        try:
+            self.start()
+        except OSError as e:
+            print('Raw capture is off: {}'.format(e))
+
+    def start(self):
+        if self.file is not None:
+            self.file.close()
+        if os.path.exists(self.filename):
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)),
+                        exist_ok=True)
+        self.file = open(self.filename, 'wb')
+        self.started = time.monotonic()
+        self.file.write(capture_magic + capture_header.pack(time.time()))
+        self.size = len(capture_magic) + capture_header.size
+
+    def write(self, data, received):
+        """
+        Store a chunk that has arrived at time.monotonic() received
+        """
+        if self.file is None:
+            return
+        try:
+            if self.size > self.max_size:
+                self.start()
+            offset = max(0, int((received - self.started) * 1000000))
+            for position in range(0, len(data), max_chunk_size):
+                chunk = data[position:position+max_chunk_size]
+                self.file.write(chunk_header.pack(offset, len(chunk)))
+                self.file.write(chunk)
+                self.size += chunk_header.size + len(chunk)
+        except OSError as e:
+            print('Raw capture is off: {}'.format(e))
+            self.close()
+
+    def flush(self):
+        if self.file is not None:
+            try:
+                self.file.flush()
+            except OSError as e:
+                print(e)
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError as e:
+                print(e)
+            self.file = None
+
+
+
+def read_capture(filename):
+    """
+    Read chunks of the capture (a truncated tail, e.g. after a power cut, is
+    skipped)
+
+    yields:
+        wall clock time of the arrival,data
+    """
+    with open(filename, 'rb') as capture_file:
+        if capture_file.read(len(capture_magic)) != capture_magic:
+            raise ValueError('{} is not a raw capture'.format(filename))
+        header = capture_file.read(capture_header.size)
+        if len(header) < capture_header.size:
+            return
+        started, = capture_header.unpack(header)
+        while True:
+            header = capture_file.read(chunk_header.size)
+            if len(header) < chunk_header.size:
+                return
+            offset,length = chunk_header.unpack(header)
+            data = capture_file.read(length)
+            if len(data) < length:
+                return
+            yield started + offset / 1000000,data
@@ -0,0 +1,289 @@
+"""
+Module with the persistent spool on the root filesystem (SD card). Frames go
+there whenever they can't reach the USB drive and are drained onto the drive in
+bulk once it is activated again. The spool survives crashes and reboots so no
+UART data is lost during drive outages.
+
+On-disk layout (inside the spool directory):
+    NNNNNNNN.seg  append-only segments of records
+    index.json    position of the first record that hasn't been drained yet
+                  (segment number and offset), replaced atomically
+
+Every record is
+    <I length of payload> <d created> <B levelno> <B source> <d received>
+    <I length of line> payload line <I crc32>
+so a torn tail after a power cut is detected and cut off on the next start.
+received is NaN for frames without the arrival stamp, the line is empty for
+frames that haven't been formatted yet.
+"""
+
+import os, json, glob, math, struct, zlib, threading
+from miscs import *
+
+
+
+record_header = struct.Struct('<IdBBdI')
+record_crc = struct.Struct('<I')
+
+
+
+class Spool:
+    """
+    Crash-safe append-only FIFO of (levelno,created,msg,source,line,received)
+    frames stored in segment files. Preformatted lines come back as bytes.
+    received is time.monotonic() that doesn't survive a reboot, so frames left
+    by the previous run come back without it. The total size is capped with
+    max_size; eviction_policy decides what to do when it is exceeded:
+        'drop_oldest'  the oldest segment is deleted
+        'drop_newest'  new frames are refused
+    """
+
+    def __init__(self, directory, segment_size=spool_segment_size,
+                 max_size=spool_max_size, eviction_policy=spool_eviction_policy):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.eviction_policy = eviction_policy
+        self.index_filename = os.path.join(directory, 'index.json')
+        self.lock = threading.RLock()
+
+        # Metrics
+        self.evicted_segments = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.read_segment,self.read_offset = self.load_index()
+        segments = self.segments()
+        # Segments before the committed position are already drained
+        for number in segments:
+            if number < self.read_segment:
+                os.remove(self.segment_filename(number))
+        segments = [number for number in segments if number >= self.read_segment]
+        if not segments:
+            segments = [self.read_segment]
+            self.read_offset = 0
+
+        self.write_segment = segments[-1]
+        self.recover(self.write_segment)
+        self.size = sum(os.path.getsize(self.segment_filename(number))
+                        for number in segments
+                        if os.path.exists(self.segment_filename(number)))
+        self.file = open(self.segment_filename(self.write_segment), 'ab')
+        # Records before this position are left by the previous run
+        self.previous_run_end = (self.write_segment, self.file.tell())
+
+    def segment_filename(self, number):
+        return os.path.join(self.directory, '{:08d}.seg'.format(number))
+
+    def segments(self):
+        numbers = []
+        for filename in glob.glob(os.path.join(self.directory, '*.seg')):
+            try:
+                numbers.append(int(os.path.basename(filename)[:-4]))
+            except ValueError:
+                pass
+        return sorted(numbers)
+
+    def load_index(self):
+        try:
+            with open(self.index_filename) as index_file:
+                index = json.load(index_file)
+            return int(index['segment']),int(index['offset'])
+        except FileNotFoundError:
+            return 0,0
+        except Exception as e:
+            print('Spool index is broken ({}), start from the beginning'
+                  .format(e))
+            return 0,0
+
+    def save_index(self):
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'w') as index_file:
+            json.dump({'segment': self.read_segment,
+                       'offset': self.read_offset}, index_file)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(tmp_filename, self.index_filename)
+
+    def recover(self, number):
+        """
+        Cut off a torn record at the end of the segment (if any)
+        """
+        filename = self.segment_filename(number)
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'rb') as segment:
+            valid_end = 0
+            for item,end in self.iter_records(segment, 0):
+                valid_end = end
+        if valid_end != os.path.getsize(filename):
+            print('Spool: cut off a torn tail of {}'.format(filename))
+            os.truncate(filename, valid_end)
+
+    @staticmethod
+    def iter_records(segment, offset):
+        """
+        Read valid records from the open segment starting at offset
+
+        yields:
+            (levelno,created,msg,source,line,received),offset_after_the_record
+        """
+        segment.seek(offset)
+        while True:
+            header = segment.read(record_header.size)
+            if len(header) < record_header.size:
+                return
+            length,created,levelno,source,received,line_length =\
+                record_header.unpack(header)
+            payload = segment.read(length)
+            line = segment.read(line_length)
+            crc = segment.read(record_crc.size)
+            if len(payload) < length or len(line) < line_length or\
+               len(crc) < record_crc.size or record_crc.unpack(crc)[0] !=\
+               zlib.crc32(header + payload + line):
+                return
+            offset += record_header.size + length + line_length +\
+                      record_crc.size
+            yield (levelno, created, payload.decode('utf-8', 'replace'),
+                   source, line or None,
+                   None if math.isnan(received) else received),offset
+
+    def __len__(self):
+        """
+        Size of undrained data in bytes (0 means the spool is empty)
+        """
+        with self.lock:
+            return self.size - self.read_offset
+
+    def append(self, item):
+        """
+        Append (levelno,created,msg,source,line,received) frame. Call sync() to
+        make it durable.
+
+        returns:
+            False if the frame has been refused because of the size cap
+        """
+        levelno,created,msg,source,line,received = item
+        payload = msg.encode('utf-8') if isinstance(msg, str) else msg
+        line = line.encode('utf-8') if isinstance(line, str) else line or b''
+        header = record_header.pack(len(payload), created, levelno, source,
+                                    math.nan if received is None else received,
+                                    len(line))
+        data = header + payload + line +\
+               record_crc.pack(zlib.crc32(header + payload + line))
+        with self.lock:
+            if self.size + len(data) > self.max_size and not self.evict():
+                self.dropped += 1
+                return False
+            if self.file.tell() >= self.segment_size:
+                self.file.close()
+                self.write_segment += 1
+                self.file = open(self.segment_filename(self.write_segment), 'ab')
+            self.file.write(data)
+            self.size += len(data)
+            return True
+
+    def evict(self):
+        """
+        returns:
+            True if some space has been freed
+        """
+        if self.eviction_policy != 'drop_oldest' or\
+           self.read_segment == self.write_segment:
+            return False
+        filename = self.segment_filename(self.read_segment)
+        self.size -= os.path.getsize(filename)
+        os.remove(filename)
+        self.evicted_segments += 1
+        self.read_segment += 1
+        self.read_offset = 0
+        self.save_index()
+        print('Spool is full, the oldest segment has been evicted')
+        return True
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def read_batch(self, batch_size):
+        """
+        returns:
+            items,(segment,offset) position after them
+        """
+        with self.lock:
+            self.file.flush()
+            items = []
+            segment,offset = self.read_segment,self.read_offset
+            while len(items) < batch_size:
+                try:
+                    with open(self.segment_filename(segment), 'rb') as f:
+                        for item,end in self.iter_records(f, offset):
+                            if (segment, offset) < self.previous_run_end:
+                                item = item[:5] + (None,)
+                            items.append(item)
+                            offset = end
+                            if len(items) == batch_size:
+                                break
+                except FileNotFoundError:
+                    pass
+                if len(items) == batch_size or segment >= self.write_segment:
+                    break
+                segment += 1
+                offset = 0
+            return items,(segment, offset)
+
+    def commit(self, position):
+        """
+        Mark everything before position as drained and delete drained segments
+        """
+        with self.lock:
+            segment,offset = position
+            # Eviction could have already moved the read position further
+            if (segment, offset) < (self.read_segment, self.read_offset):
+                return
+            for number in range(self.read_segment, segment):
+                filename = self.segment_filename(number)
+                if os.path.exists(filename):
+                    self.size -= os.path.getsize(filename)
+                    os.remove(filename)
+            self.read_segment,self.read_offset = segment,offset
+            # Everything is drained: start from a fresh segment
+            if self.read_segment == self.write_segment and\
+               self.read_offset == self.file.tell():
+                self.file.close()
+                os.remove(self.segment_filename(self.write_segment))
+                self.write_segment += 1
+                self.read_segment,self.read_offset = self.write_segment,0
+                self.size = 0
+                self.file = open(self.segment_filename(self.write_segment), 'ab')
+            self.save_index()
+
+    def drain(self, write, batch_size=spool_drain_batch_size):
+        """
+        Pass all spooled frames to write(items) by batches. The position is
+        committed after every batch so if write() raises (e.g. the drive has
+        gone again) the rest stays in the spool.
+
+        returns:
+            number of drained frames
+        """
+        drained = 0
+        while True:
+            items,position = self.read_batch(batch_size)
+            if not items:
+                return drained
+            write(items)
+            self.commit(position)
+            drained += len(items)
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'evicted_segments': self.evicted_segments,
+            'dropped': self.dropped
+        }
+
+    def close(self):
+        with self.lock:
+            self.file.close()
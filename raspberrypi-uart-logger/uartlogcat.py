@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Reader of binary logs (log_format = 'binary'). Seeks straight to the requested
+time range using the sparse index and prints records as text lines of the usual
+format. Works on any machine with Python 3, e.g.:
+
+    python3 uartlogcat.py /media/LOGS --since 03:40 --until 03:55 --level W
+"""
+
+import os, sys, glob, logging, argparse, datetime
+from binlog import read_records, binlog_suffix
+from miscs import log_formatter_string
+
+
+
+# Prefix letters of the UART protocol and full level names
+level_names = {
+    'D': logging.DEBUG,
+    'I': logging.INFO,
+    'W': logging.WARNING,
+    'E': logging.ERROR,
+    'C': logging.CRITICAL
+}
+
+
+
+def parse_level(value):
+    value = value.upper()
+    if value in level_names:
+        return level_names[value]
+    level = logging.getLevelName(value)
+    if isinstance(level, int):
+        return level
+    raise argparse.ArgumentTypeError("unknown level '{}'".format(value))
+
+
+
+def parse_time(value, day):
+    """
+    Accepts 'YYYY-MM-DD HH:MM[:SS]' or 'HH:MM[:SS]' (of the given day)
+
+    returns:
+        Unix time
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            clock = datetime.datetime.strptime(value, fmt).time()
+            return datetime.datetime.combine(day, clock).timestamp()
+        except ValueError:
+            pass
+    raise ValueError("can't parse time '{}'".format(value))
+
+
+
+def log_files(paths):
+    """
+    Expand directories into sorted lists of binary log segments
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*' + binlog_suffix))))
+        else:
+            files.append(path)
+    return files
+
+
+
+def first_record_day(filename):
+    for levelno,created,msg in read_records(filename):
+        return datetime.date.fromtimestamp(created)
+    return datetime.date.today()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print records of binary UART logs as text")
+    parser.add_argument('paths', nargs='+',
+                        help="binary log files or directories with them")
+    parser.add_argument('--since', help="'HH:MM[:SS]' (of the day of the first "
+                        "record) or 'YYYY-MM-DD HH:MM[:SS]'")
+    parser.add_argument('--until', help="same format as --since")
+    parser.add_argument('--level', type=parse_level, default=logging.DEBUG,
+                        help="minimal level: D, I, W, E, C or a full name")
+    parser.add_argument('--format', default=log_formatter_string,
+                        help="output format (logging.Formatter string)")
+    parser.add_argument('--exhaustive', action='store_true',
+                        help="scan to the end of files instead of stopping at "
+                             "the first record after --until (catches frames "
+                             "that were drained from the spool later)")
+    parser.add_argument('--us', action='store_true',
+                        help="print the time with microseconds")
+    args = parser.parse_args()
+
+    formatter = logging.Formatter(args.format)
+    # Fraction of a second in asctime (and %(msecs)d)
+    fraction = 1000
+    if args.us:
+        formatter.default_msec_format = '%s,%06d'
+        fraction = 1000000
+    files = log_files(args.paths)
+    if not files:
+        sys.exit('No binary logs found')
+
+    day = first_record_day(files[0])
+    try:
+        since = parse_time(args.since, day) if args.since else None
+        until = parse_time(args.until, day) if args.until else None
+    except ValueError as e:
+        sys.exit(e)
+
+    try:
+        for filename in files:
+            for levelno,created,msg in read_records(filename, since, until,
+                                                    args.level, args.exhaustive):
+                record = logging.makeLogRecord({
+                    'levelno': levelno,
+                    'levelname': logging.getLevelName(levelno),
+                    'msg': msg,
+                    'created': created,
+                    'msecs': (created - int(created)) * fraction
+                })
+                sys.stdout.write(formatter.format(record) + '\n')
+    except BrokenPipeError:
+        pass
+
+
+
+if __name__ == '__main__':
+    main()
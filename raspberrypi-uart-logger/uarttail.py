@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""
+Live tail of the logger (see publisher.py). Prints lines of parsed frames as
+they come, straight from the logger process, without touching the drive:
+
+    python3 uarttail.py --level W
+
+A client that doesn't keep up (e.g. a slow SSH session) is disconnected by the
+logger, run it again then. The same stream is available to any tool that talks
+to Unix sockets, e.g.:
+
+    socat - UNIX-CONNECT:/opt/raspberrypi-uart-logger/frames.sock
+"""
+
+import sys, socket, argparse
+from miscs import publisher_address
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--level', help="minimal level: D, I, W, E, C or a "
+                                        "full name")
+    parser.add_argument('--socket', default=publisher_address,
+                        help="publisher_address of the logger")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+        if args.level:
+            sock.sendall(args.level.encode('utf-8') + b'\n')
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                sys.exit('Disconnected by the logger')
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+    except OSError as e:
+        sys.exit(e)
+    except KeyboardInterrupt:
+        pass
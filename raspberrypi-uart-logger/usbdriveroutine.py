@@ -6,9 +6,16 @@ the logging platform if you sure that the drive is in a presence at the moment
 of a logging event).
 """
 
-import os, shutil, subprocess, time, logging
+import os, re, shutil, time, logging, threading
 from termcolor import cprint
 from miscs import *
+from drivemonitor import DriveMonitor
+from compression import CompressedStream, compression_suffixes
+from binlog import BinaryStream, binlog_suffix, binlog_index_suffix
+from fastformat import FastFormatter, LineStream
+from prealloc import PreallocatedStream, file_length
+from commitpolicy import AdaptiveCommitPolicy
+import metrics
 
 
 
@@ -17,45 +24,555 @@ class CustomFileHandler(logging.FileHandler):
     Subclass of logging.FileHandler with the overridden flush() method and a
     couple new properties. The main idea is to have and control a single "exit"
     of logging data into the output file.
+
+    Records are not synced to the drive one by one. They are batched and
+    committed (flush + fsync) according to the durability policy: every
+    fsync_every_records records, not later than fsync_every_time milliseconds
+    after the previous commit and immediately for records of
+    fsync_immediately_level and higher. So at most the uncommitted batch
+    (fsync_every_records records not older than fsync_every_time) of less
+    important records can be lost by the handler on a sudden power cut or drive
+    eject, frames waiting in the writer queue are not counted here. With fsync_adaptive the batch follows the incoming
+    rate within these bounds (see AdaptiveCommitPolicy): records are committed
+    one by one in idle periods and in bigger batches during bursts.
+
+    The drive is watched by DriveMonitor thread (unless drive_monitor_backend
+    is None) so the check on every flush costs nothing. It also catches a drive
+    that is still present but has been remounted read-only. The monitor is
+    started once the file is opened. Handlers of other files on the same drive
+    share it (monitor argument), it's stopped by the handler that started it.
+
+    If on_drive_lost callback is set, a lost drive doesn't lead to a reboot.
+    The callback is invoked as on_drive_lost(handler, frames) where frames are
+    (levelno,created,msg) tuples that might have not reached the drive since
+    the last commit so the caller can replay them on a new drive (hot swap).
+    It's invoked after the handler lock is released (see report_drive_lost()).
+
+    With compression ('gzip' or 'zstd') the file is written through
+    CompressedStream and every commit is a sync-flush point of the compressor.
+    With log_format = 'binary' records are written as binary ones through
+    BinaryStream (no formatter is involved, compression is not applied).
+    Plain logs are written through PreallocatedStream with log_preallocate.
+
+    UART frames take the fast path write_frame() that bypasses LogRecord and
+    logging.Formatter (see FastFormatter), the usual emit() is left for service
+    and diagnostic messages. Payloads in bytes are written without decoding
+    (plain files are LineStream for that). Arrival stamps of frames in the
+    batch are kept till the commit to measure the ingest-to-disk latency.
     """
 
-    def __init__(self, drive_arg, filename):
+    def __init__(self, drive_arg, filename,
+                 fsync_every_records=fsync_every_records,
+                 fsync_every_time=fsync_every_time,
+                 fsync_immediately_level=fsync_immediately_level,
+                 drive_monitor_backend=drive_monitor_backend,
+                 fsync_adaptive=fsync_adaptive,
+                 on_drive_lost=None, compression=log_compression,
+                 log_format=log_format, monitor=None):
         # We need to know the current drive (/dev/sdXN) to check its presence
         self.drive = drive_arg
+        self.monitor = monitor
+        self.owns_monitor = False
         # This flag is used to stop flushes when the drive is no more plugged
         # and shutdown routines are performed
         self.active = True
-        # Initialize a superclass in a usual way
-        super(CustomFileHandler, self).__init__(filename)
+        # Durability policy
+        self.fsync_every_records = fsync_every_records
+        self.fsync_every_time = fsync_every_time / 1000  # seconds
+        self.fsync_immediately_level = fsync_immediately_level
+        self.policy = None
+        if fsync_adaptive:
+            self.policy = AdaptiveCommitPolicy(fsync_every_records,
+                                               self.fsync_every_time,
+                                               fsync_adaptive_duty,
+                                               fsync_adaptive_window / 1000)
+            self.apply_policy()
+            # Segments of a rotating log share the name of the log
+            metrics.commit_policies[getattr(self, 'basename',
+                                    os.path.basename(filename))] = self.policy
+        self.on_drive_lost = on_drive_lost
+        # Frames of the lost drive waiting for on_drive_lost
+        self.lost_records = None
+        # Batch state: records written since the last commit, level of the
+        # latest one and the timer that bounds the age of the batch
+        self.uncommitted = []
+        # time.monotonic() of the arrival of UART frames in the batch
+        self.uncommitted_received = []
+        self.last_levelno = logging.NOTSET
+        self.last_commit_time = time.monotonic()
+        self.commit_timer = None
+        self.compression = compression
+        self.log_format = log_format
+        self.fast_formatter = FastFormatter(log_formatter_string,
+                                            resolution=log_time_resolution)
+        # Initialize a superclass in a usual way. Payloads are written as UTF-8
+        # bytes so the rest of the file is UTF-8 as well, whatever the locale
+        # is (it would be 'locale' then which only open() understands)
+        super(CustomFileHandler, self).__init__(filename, encoding='utf-8')
+        # Only now, a failed open doesn't leave a running thread behind. A
+        # simulated drive is just a directory (see backends.py)
+        if self.monitor is None and drive_monitor_backend is not None and\
+           hardware().block_devices:
+            self.monitor = DriveMonitor(drive_arg,
+                os.path.dirname(os.path.abspath(filename)),
+                backend=drive_monitor_backend)
+            self.monitor.start()
+            self.owns_monitor = True
+
+    def _open(self):
+        """
+        Overridden method. Open the binary or compressed stream if needed
+        """
+        if self.log_format == 'binary':
+            return BinaryStream(self.baseFilename, binlog_index_interval)
+        if self.compression is not None:
+            return CompressedStream(self.baseFilename, self.compression,
+                                    log_compression_level, self.encoding)
+        if log_preallocate:
+            return PreallocatedStream(self.baseFilename, log_preallocate_size,
+                                      log_erase_block_size, log_write_page_size,
+                                      self.encoding)
+        return LineStream(self.baseFilename, self.mode, self.encoding)
+
+    def emit(self, record):
+        """
+        Overridden method. Remember the record in the current batch before the
+        superclass writes it and invokes flush().
+        """
+        self.uncommitted.append((record.levelno, record.created,
+                                 record.getMessage()))
+        self.last_levelno = record.levelno
+        if self.log_format == 'binary':
+            try:
+                if self.stream is None:
+                    self.stream = self._open()
+                self.account(self.stream.write_record(record.levelno,
+                    record.created, record.getMessage()))
+                self.flush()
+            except Exception:
+                self.handleError(record)
+        else:
+            super(CustomFileHandler, self).emit(record)
+
+    def write_frame(self, levelno, created, msg, line=None, received=None):
+        """
+        Fast path for UART frames. Produces the same output as emit() of the
+        corresponding LogRecord straight into the buffered stream. The line
+        can be already formatted by the caller (e.g. by a worker process).
+        msg in bytes is added to the prefix as it is, unless the format needs
+        the text. received is time.monotonic() of the arrival of the frame
+        """
+        if isinstance(msg, bytes) and line is None and\
+           self.log_format != 'binary' and not self.fast_formatter.specialized:
+            msg = msg.decode('utf-8', 'replace')
+        if not self.fast_formatter.supported and self.log_format != 'binary':
+            # The format needs real LogRecord fields
+            record = logging.makeLogRecord({'levelno': levelno,
+                'levelname': logging.getLevelName(levelno), 'msg': msg,
+                'created': created, 'msecs': (created - int(created)) * 1000})
+            if received is not None:
+                self.acquire()
+                try:
+                    self.uncommitted_received.append(received)
+                finally:
+                    self.release()
+            self.handle(record)
+            return
+        self.acquire()
+        try:
+            self.uncommitted.append((levelno, created, msg))
+            if received is not None:
+                self.uncommitted_received.append(received)
+            self.last_levelno = levelno
+            metrics.frames_written.inc()
+            if self.stream is None:
+                self.stream = self._open()
+            if self.log_format == 'binary':
+                self.account(self.stream.write_record(levelno, created, msg))
+            else:
+                if line is None and isinstance(msg, bytes):
+                    line = self.fast_formatter.format_bytes(levelno, created,
+                                                            msg)
+                elif line is None:
+                    line = self.fast_formatter.format(levelno, created, msg)
+                self.stream.write(line)
+                self.account(len(line))
+            self.flush()
+        except Exception as e:
+            print(e)
+        finally:
+            self.release()
+        self.report_drive_lost()
+
+    def handle(self, record):
+        """
+        Overridden method. Report a lost drive once the record is handled
+        """
+        handled = super(CustomFileHandler, self).handle(record)
+        self.report_drive_lost()
+        return handled
+
+    def report_drive_lost(self):
+        """
+        Invoke on_drive_lost for the loss found by flush(). It's done outside of
+        the handler lock: the callback takes the lock of the writer that in its
+        turn writes frames holding its own lock and then the handler one, so
+        holding both in the opposite order could deadlock (e.g. a service
+        message logged by the main thread)
+        """
+        self.acquire()
+        try:
+            records,self.lost_records = self.lost_records,None
+        finally:
+            self.release()
+        if records is not None:
+            self.on_drive_lost(self, records)
+
+    def account(self, size):
+        """
+        Called with the size of every written record (see subclasses)
+        """
+        metrics.bytes_written.inc(size)
 
     def flush(self):
         """
         Overridden method. It's automatically invoked on every logging event
-        when FileHadler is connected to the current Logger.
+        when FileHadler is connected to the current Logger. It only commits the
+        batch when the durability policy says so.
         """
+        started = time.perf_counter()
         if self.active:
             # Linux with its buffering mechanism doesn't immediately detect
             # drive ejects so we need to perform manual checks
-            if not os.path.exists(self.drive):
+            if not self.drive_is_ok():
                 print('Drive has been lost')
+                metrics.drive_losses.inc()
                 self.active = False
-                # Wait for a new drive and reboot to start logging again
-                replace_drive(possible_drives)
-                sudo_reboot()
+                if self.on_drive_lost is not None:
+                    # Let the caller wait for a new drive and replay the
+                    # records that might have been lost (once the handler lock
+                    # is released, see report_drive_lost())
+                    self.lost_records = self.uncommitted
+                    self.uncommitted = []
+                    self.uncommitted_received = []
+                else:
+                    # Wait for a new drive and reboot to start logging again
+                    # (it ends the whole process even if the flush happens in
+                    # the writer thread)
+                    replace_drive(possible_drives)
+                    sudo_reboot()
             else:
+                if self.policy is not None and\
+                   self.policy.record(time.monotonic()):
+                    self.apply_policy()
+                if self.commit_is_due():
+                    self.commit()
+                elif self.uncommitted and self.commit_timer is None:
+                    # Guarantee that the batch doesn't stay in memory for
+                    # longer than fsync_every_time even if no more records
+                    # will come
+                    self.commit_timer = threading.Timer(
+                        self.fsync_every_time -
+                        (time.monotonic() - self.last_commit_time),
+                        self.timed_commit
+                    )
+                    self.commit_timer.daemon = True
+                    self.commit_timer.start()
+        metrics.flush_seconds.observe(time.perf_counter() - started)
+
+    def apply_policy(self):
+        """
+        Take the batch size and age chosen by the adaptive policy
+        """
+        self.fsync_every_records = self.policy.records
+        self.fsync_every_time = self.policy.age
+
+    def drive_is_ok(self):
+        if self.monitor is not None:
+            return self.monitor.ok
+        return os.path.exists(self.drive)
+
+    def commit_is_due(self):
+        return (len(self.uncommitted) >= self.fsync_every_records or
+                self.last_levelno >= self.fsync_immediately_level or
+                time.monotonic() - self.last_commit_time >= self.fsync_every_time)
+
+    def commit(self):
+        """
+        Write out the current batch and force it to the drive
+        """
+        self.acquire()
+        try:
+            if self.commit_timer is not None:
+                self.commit_timer.cancel()
+                self.commit_timer = None
+            if self.stream:
+                started = time.perf_counter()
                 super(CustomFileHandler, self).flush()
-                if self.stream:
-                    os.fsync(self.stream)
+                os.fsync(self.stream)
+                duration = time.perf_counter() - started
+                metrics.commit_seconds.observe(duration)
+                if self.policy is not None:
+                    self.policy.committed(duration)
+                committed = time.monotonic()
+                for received in self.uncommitted_received:
+                    metrics.ingest_to_disk.observe(committed - received)
+            self.uncommitted = []
+            self.uncommitted_received = []
+            self.last_levelno = logging.NOTSET
+            self.last_commit_time = time.monotonic()
+        finally:
+            self.release()
+
+    def timed_commit(self):
+        """
+        Timer callback. Runs in its own thread so takes the handler lock. A lost
+        drive is left to be handled by the next logging event (in the thread
+        that performs the logging)
+        """
+        self.acquire()
+        try:
+            self.commit_timer = None
+            if self.active and self.uncommitted and self.drive_is_ok():
+                self.commit()
+        except Exception as e:
+            print(e)
+        finally:
+            self.release()
+
+    def close(self):
+        """
+        Overridden method. Commit the rest of the batch before the file is
+        closed
+        """
+        if self.active and self.stream:
+            try:
+                self.commit()
+            except Exception as e:
+                print(e)
+        super(CustomFileHandler, self).close()
+        if self.monitor is not None:
+            if self.owns_monitor:
+                self.monitor.stop()
+            self.monitor = None
+
+
+
+class RotatingCustomFileHandler(CustomFileHandler):
+    """
+    CustomFileHandler that writes the log as a set of segments named like
+    uartlog-YYYYMMDD-NNNN.txt (for basename = 'uartlog.txt') instead of the
+    one ever-growing file. It keeps every file far below the FAT32 4 GB limit
+    and makes checks of the current file cheap. A new segment is started when
+    the current one exceeds max_size (approximately, in characters) or is older
+    than max_age. When the free space on the drive falls below min_free_space
+    the oldest segments are deleted so the logging never stops.
+    """
+
+    def __init__(self, drive_arg, directory, basename=log_filename,
+                 rotation=log_rotation, max_size=log_rotation_size,
+                 max_age=log_rotation_time, min_free_space=log_min_free_space,
+                 **kwargs):
+        self.directory = directory
+        self.basename = basename
+        self.rotation = rotation
+        self.max_size = max_size
+        self.max_age = max_age
+        self.min_free_space = min_free_space
+        self.last_free_space_check = 0
+
+        # Continue the latest segment if there is one
+        segments = log_segments(directory, basename)
+        filename = os.path.join(directory, segments[-1]) if segments else\
+                   self.new_segment_filename()
+        self.segment_size = 0
+        if os.path.exists(filename):
+            self.segment_size = file_length(filename) if log_preallocate\
+                                else os.path.getsize(filename)
+        self.segment_started = time.monotonic()
+        super(RotatingCustomFileHandler, self).__init__(drive_arg, filename,
+                                                        **kwargs)
+
+    def new_segment_filename(self):
+        date = time.strftime('%Y%m%d')
+        numbers = [number for segment_date,number,segment in
+                   map(parse_log_segment_name, log_segments(self.directory,
+                                                            self.basename))
+                   if segment_date == date]
+        stem,ext = split_log_filename(self.basename)
+        return os.path.join(self.directory, '{}-{}-{:04d}{}'.format(
+            stem, date, max(numbers, default=0) + 1, ext))
+
+    def format(self, record):
+        """
+        Overridden method. Count the size of the segment on the way so no
+        stat/tell() calls are needed
+        """
+        msg = super(RotatingCustomFileHandler, self).format(record)
+        self.account(len(msg) + len(self.terminator))
+        return msg
+
+    def account(self, size):
+        super(RotatingCustomFileHandler, self).account(size)
+        self.segment_size += size
+
+    def should_rollover(self):
+        if self.rotation == 'size':
+            return self.segment_size >= self.max_size
+        elif self.rotation == 'time':
+            return time.monotonic() - self.segment_started >= self.max_age
+        return False
+
+    def emit(self, record):
+        if self.active and self.should_rollover():
+            try:
+                self.do_rollover()
+            except Exception:
+                self.handleError(record)
+        super(RotatingCustomFileHandler, self).emit(record)
+
+    def write_frame(self, levelno, created, msg, line=None, received=None):
+        if self.active and self.should_rollover():
+            self.acquire()
+            try:
+                self.do_rollover()
+            except Exception as e:
+                print(e)
+            finally:
+                self.release()
+        super(RotatingCustomFileHandler, self).write_frame(levelno, created,
+                                                           msg, line, received)
+
+    def do_rollover(self):
+        self.commit()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.baseFilename = self.new_segment_filename()
+        self.stream = self._open()
+        self.segment_size = 0
+        self.segment_started = time.monotonic()
+        metrics.rollovers.inc()
+        print('New log segment {}'.format(self.baseFilename))
+        self.free_space()
+
+    def commit(self):
+        super(RotatingCustomFileHandler, self).commit()
+        if time.monotonic() - self.last_free_space_check >= log_free_space_check_time:
+            self.free_space()
+
+    def free_space(self):
+        """
+        Delete the oldest segments while there is not enough free space
+        """
+        self.last_free_space_check = time.monotonic()
+        try:
+            while True:
+                stat = os.statvfs(self.directory)
+                if stat.f_bavail * stat.f_frsize >= self.min_free_space:
+                    return
+                segments = [os.path.join(self.directory, segment) for segment in
+                            log_segments(self.directory, self.basename)]
+                segments = [segment for segment in segments
+                            if segment != self.baseFilename]
+                if not segments:
+                    print('Drive is almost full but there is nothing to delete')
+                    return
+                print('Drive is almost full, delete {}'.format(segments[0]))
+                os.remove(segments[0])
+                # Sidecar index of the binary log
+                if os.path.exists(segments[0] + binlog_index_suffix):
+                    os.remove(segments[0] + binlog_index_suffix)
+        except Exception as e:
+            print(e)
+
+
+
+def split_log_filename(filename):
+    """
+    Split on the first dot so double extensions ('.txt.gz') stay together
+
+    returns:
+        stem,ext
+    """
+    stem,dot,ext = filename.partition('.')
+    return stem,dot+ext
+
+
+
+def parse_log_segment_name(segment):
+    """
+    returns:
+        date,number,segment (for 'uartlog-20180824-0001.txt')
+    """
+    stem,ext = split_log_filename(segment)
+    parts = stem.rsplit('-', 2)
+    return parts[1],int(parts[2]),segment
+
+
+
+def log_segments(directory, basename):
+    """
+    returns:
+        sorted (from the oldest) list of names of log segments in the directory
+    """
+    stem,ext = split_log_filename(basename)
+    pattern = re.compile(r'^{}-\d{{8}}-\d{{4,}}{}$'.format(re.escape(stem),
+                                                        re.escape(ext)))
+    try:
+        names = [name for name in os.listdir(directory) if pattern.match(name)]
+    except OSError:
+        return []
+    return [segment for date,number,segment in
+            sorted(map(parse_log_segment_name, names))]
+
+
+
+def is_log_file(name, basename=log_filename):
+    """
+    Whether the file is a log of this program written in any mode: plain,
+    compressed or binary, a rotated segment or a file of a port in the
+    multi-port mode ('uartlog.txt', 'uartlog.txt.gz', 'uartlog.bin',
+    'uartlog-20180824-0001.txt', 'uartlog-ttyUSB0.txt' and so on for
+    basename = 'uartlog.txt')
+    """
+    stem,ext = split_log_filename(basename)
+    extensions = [ext + suffix for suffix in compression_suffixes.values()]
+    extensions.append(binlog_suffix)
+    # Segments and files of ports are 'uartlog-<something>'
+    return re.match(r'^{}(-.+)?({})$'.format(re.escape(stem),
+        '|'.join(map(re.escape, extensions))), name) is not None
+
+
+
+def actual_log_filename(log_filename):
+    """
+    Name of the log file according to the format and compression settings
+    ('uartlog.txt' -> 'uartlog.bin', 'uartlog.txt.gz', ...)
+    """
+    if log_format == 'binary':
+        return split_log_filename(log_filename)[0] + binlog_suffix
+    return log_filename + compression_suffixes[log_compression]
+
+
+
+def make_file_handler(drive, directory, log_filename, monitor=None):
+    """
+    Create the file handler according to the settings. monitor is DriveMonitor
+    of another handler on the same drive to share
+    """
+    log_filename = actual_log_filename(log_filename)
+    if log_rotation is not None:
+        return RotatingCustomFileHandler(drive, directory, log_filename,
+                                         monitor=monitor)
+    return CustomFileHandler(drive, os.path.join(directory, log_filename),
+                             monitor=monitor)
 
 
 
 def unmount_drive(drive):
     cprint('UNMOUNT THE DRIVE', 'red')
-    rslt = subprocess.run(['sudo', 'umount', drive], stdout=subprocess.PIPE,
-                                                     stderr=subprocess.PIPE)
-    # Suppress command output while there is no error
-    if rslt.returncode != 0:
-        print(rslt.stderr.decode('utf-8'))
+    hardware().unmount(drive)
 
 
 
@@ -66,15 +583,7 @@ def mount_drive(drive, drive_mountpoint, drive_name):
         os.mkdir(os.path.join(drive_mountpoint, drive_name))
     except:
         pass
-    rslt = subprocess.run([
-            'sudo', 'mount', '-t', 'vfat', '-ouser,umask=0000',
-            drive, '{}/{}'.format(drive_mountpoint, drive_name)
-        ],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    # Suppress command output while there is no error
-    if rslt.returncode != 0:
-        print(rslt.stderr.decode('utf-8'))
+    hardware().mount(drive, '{}/{}'.format(drive_mountpoint, drive_name))
 
 
 
@@ -91,63 +600,75 @@ def check_drive(possible_drives, drive_mountpoint, drive_name, log_filename):
     while True:
         if mount_tries_cnt == 0:
             return NEED_FORMAT,drive
-        time.sleep(check_drive_retry_time)
-
-        lsblk = subprocess.run(['lsblk', '-o', 'name,mountpoint', '-n', '-l'],
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if lsblk.returncode == 0:
-            lsblk_output = lsblk.stdout.decode('utf-8')
-        else:
-            print(lsblk.stderr.decode('utf-8'))
-            return CRITICAL_ERROR,''
+        # Give the previous (re)mount some time, the first check goes right away
+        if mount_tries_cnt < mount_tries:
+            time.sleep(check_drive_retry_time)
 
-        # Search for one of sdX1
-        drives_cnt = 0
-        for drv in possible_drives:
-            if drv in lsblk_output:
-                drives_cnt += 1
-                drive = '/dev/{}'.format(drv)
-                print('{} is plugged'.format(drive))
-        if drives_cnt == 0:
+        # Search for one of sdX1 (names are compared exactly)
+        drives = hardware().plugged_drives(possible_drives)
+        if not drives:
             print('No plugged drives')
             return CRITICAL_ERROR,''
-        elif drives_cnt > 1:
-            print("Multiple drives were found! Using the last one")
+        for device in drives:
+            print('{} is plugged (label: {})'.format(
+                hardware().device_path(device.name), device.label))
+        if len(drives) > 1:
+            # Prefer our own drive, otherwise take the last one
+            labeled = [device for device in drives if device.label == drive_name]
+            device = labeled[-1] if labeled else drives[-1]
+            print("Multiple drives were found! Using {}".format(device.name))
+        else:
+            device = drives[0]
+        drive = hardware().device_path(device.name)
 
         # Define whether sdX1 is mounted or not
-        if drive_mountpoint in lsblk_output:
-            print('{} is mounted'.format(drive))
-        else:
+        if not device.mountpoints:
             print('drive {} is not mounted'.format(drive))
             mount_drive(drive, drive_mountpoint, drive_name)
             mount_tries_cnt -= 1
             continue
+        print('{} is mounted at {}'.format(drive, ', '.join(device.mountpoints)))
 
-        # Whether mounted drive is 'nameN' drive or not
-        if drive_name in lsblk_output:
-            # If 'nameN' then remount drive
-            if lsblk_output[lsblk_output.find(drive_name)+len(drive_name)].isdigit():
-                print('The drive is {}n, remount...'.format(drive_name))
-                unmount_drive(drive)
-                mount_drive(drive, drive_mountpoint, drive_name)
-                mount_tries_cnt -= 1
-                continue
-            else:
-                print('{} drive is mounted'.format(drive_name))
-                break
+        # Whether the drive is mounted at our mountpoint or somewhere else
+        # (e.g. at 'nameN' or by the desktop automounter)
+        if os.path.join(drive_mountpoint, drive_name) in device.mountpoints:
+            print('{} drive is mounted'.format(drive_name))
+            break
         else:
-            print('The drive is not {}, format...'.format(drive_name))
-            return NEED_FORMAT,drive
+            print('The drive is not at {}/{}, remount...'.format(drive_mountpoint,
+                                                                drive_name))
+            unmount_drive(drive)
+            mount_drive(drive, drive_mountpoint, drive_name)
+            mount_tries_cnt -= 1
+            continue
 
 
-    # Look for an already existed logfile on the drive
-    if os.path.exists('{}/{}/{}'
-                      .format(drive_mountpoint, drive_name, log_filename)):
-        print('{} is here'.format(log_filename))
+    # Look for already existed logs on the drive. Any of them proves the drive
+    # is ours: the name of the current log depends on the settings (format,
+    # compression, rotation, ports) and changing them mustn't wipe the logs
+    log_dir = '{}/{}'.format(drive_mountpoint, drive_name)
+    try:
+        logs = [name for name in os.listdir(log_dir) if is_log_file(name)]
+    except OSError as e:
+        print(e)
+        logs = []
+    if logs:
+        print('{} log files are here'.format(len(logs)))
     else:
         print('No log file, format...')
         return NEED_FORMAT,drive
 
+    # The checks below go to the latest non-empty log (a just started segment
+    # can be empty), so the drive is formatted as empty only if all logs are
+    order = {}
+    for name in logs:
+        try:
+            stat_info = os.stat(os.path.join(log_dir, name))
+            order[name] = (stat_info.st_size > 0, stat_info.st_mtime)
+        except OSError:
+            order[name] = (False, 0)
+    log_filename = max(logs, key=order.get)
+
     # First check for a logfile corruption (trying to get file properties)
     stat_info = 0
     try:
@@ -192,42 +713,42 @@ def replace_drive(possible_drives):
     cprint('WAIT FOR A NEW DRIVE', 'red')
     wait_for_drive_cnt = 0
     while True:
-        time.sleep(wait_for_drive_time)
-        for drv in possible_drives:
-            if os.path.exists('/dev/{}'.format(drv)):
-                drive = '/dev/{}'.format(drv)
-                print(
-                    "We've waited for a new drive {} for approximately {} seconds"
-                    .format(
-                        drive,
-                        wait_for_drive_time + wait_for_drive_cnt * wait_for_drive_time
-                    ))
-                time.sleep(wait_for_drive_time)
-                return STATUS_OK
+        drives = hardware().plugged_drives(possible_drives)
+        if drives:
+            drive = hardware().device_path(drives[-1].name)
+            print(
+                "We've waited for a new drive {} for approximately {} seconds"
+                .format(
+                    drive,
+                    wait_for_drive_cnt * wait_for_drive_time
+                ))
+            # A just plugged drive may be not ready for mounting yet,
+            # check_drive() retries then
+            return STATUS_OK
         print('Drive was not found yet')
         wait_for_drive_cnt += 1
         if wait_for_drive_cnt == wait_for_drive_tries:
             print("Wait for a drive timeout has expired")
             return CRITICAL_ERROR
+        time.sleep(wait_for_drive_time)
 
 
 
 def format_drive(drive, drive_name):
     cprint('FORMAT IN FAT32', 'red')
-    rslt = subprocess.run(['sudo', 'mkdosfs', '-F', '32', '-I', drive, '-n', drive_name],
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if rslt.returncode != 0:
-        print(rslt.stderr.decode('utf-8'))
+    hardware().format(drive, drive_name)
 
 
 
 def activate_drive_and_logger(possible_drives, drive_mountpoint, drive_name,
-                              logger, formatter, log_filename):
+                              logger, formatter, log_filename, attach=True):
     """
     Wrapper for check_driver() function with an extended functionality. Important
     thing is that this function also creates and returns a new CustomFileHandler
     instance. The current guide is to let the caller decide what to do in
-    different cases instead of performing reboots "on the spot".
+    different cases instead of performing reboots "on the spot". With
+    attach=False the handler isn't added to the logger (the caller does it when
+    it's ready, e.g. after replaying of buffered records).
 
     returns:
         result,logging_file_handler,drive
@@ -250,16 +771,29 @@ def activate_drive_and_logger(possible_drives, drive_mountpoint, drive_name,
             print("All checks are passed")
 
         # Try to perform a test log writing
+        logging_file_handler = None
         try:
-            logging_file_handler = CustomFileHandler(drive,
-                '{}/{}/{}'.format(drive_mountpoint, drive_name, log_filename))
+            logging_file_handler = make_file_handler(drive,
+                '{}/{}'.format(drive_mountpoint, drive_name), log_filename)
             logging_file_handler.setLevel(logging.DEBUG)
             logging_file_handler.setFormatter(formatter)
-            logger.addHandler(logging_file_handler)
-            logger.info("SUCCESSFUL USB DRIVE {} ACTIVATION".format(drive))
-            logging_file_handler.flush()
+            activation_msg = "SUCCESSFUL USB DRIVE {} ACTIVATION".format(drive)
+            if attach:
+                logger.addHandler(logging_file_handler)
+                logger.info(activation_msg)
+            else:
+                logging_file_handler.handle(logger.makeRecord(logger.name,
+                    logging.INFO, __file__, 0, activation_msg, None, None))
+            logging_file_handler.commit()
         except Exception as e:
             print(e)
+            # Don't leave the file and the drive monitor of a failed try open
+            if logging_file_handler is not None:
+                logger.removeHandler(logging_file_handler)
+                try:
+                    logging_file_handler.close()
+                except Exception as e:
+                    print(e)
             activation_tries_cnt -= 1
             if activation_tries_cnt == 0:
                 print('¯\_(ツ)_/¯ sudo reboot')
@@ -0,0 +1,212 @@
+"""
+Module with the multi-process mode of the multi-port logger. Every serial port
+is served by its own worker process that reads, frames, parses and formats the
+UART data (so the CPU-heavy part is spread over all cores) and sends ready
+frames in batches to the main process through a pipe. The main process is the
+only one that touches the drive: it runs the LogWriter thread and supervises
+the workers. A crashed worker is restarted after worker_restart_time while the
+others keep working, no reboot is involved.
+"""
+
+import time, signal, asyncio, logging, multiprocessing
+from multiprocessing.connection import wait
+from miscs import *
+from fastformat import FastFormatter
+from aiocore import PortReader
+import metrics
+
+
+
+# Counters of the reader that are kept by workers and summed up by the
+# supervisor
+worker_counters = ['uart_bytes', 'uart_frames', 'uart_decode_errors',
+                   'uart_too_long_frames', 'uart_empty_frames',
+                   'uart_corrupt_frames', 'uart_collapsed_frames',
+                   'uart_rate_limited_frames', 'uart_read_errors',
+                   'uart_timeouts']
+
+
+
+class FrameSender:
+    """
+    Stands for the LogWriter in a worker process. Frames are formatted right
+    here (with their arrival stamps, the monotonic clock is the same in all
+    processes) and collected into a batch that is sent once per iteration of
+    the event loop (i.e. once per chunk read from the port)
+    """
+
+    def __init__(self, conn, preformat):
+        self.conn = conn
+        self.formatter = FastFormatter(log_formatter_string,
+                                       resolution=log_time_resolution)\
+                         if preformat else None
+        self.batch = []
+
+    def log(self, levelno, msg, source=0, created=None, received=None):
+        if created is None:
+            created = time.time()
+        line = None
+        if self.formatter is not None:
+            if isinstance(msg, bytes) and self.formatter.specialized:
+                line = self.formatter.format_bytes(levelno, created, msg)
+            else:
+                if isinstance(msg, bytes):
+                    msg = msg.decode('utf-8', 'replace')
+                line = self.formatter.format(levelno, created, msg)
+        if not self.batch:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.batch.append((levelno, created, msg, source, line, received))
+
+    def flush(self):
+        if self.batch:
+            batch,self.batch = self.batch,[]
+            counters = [getattr(metrics, name).value for name in worker_counters]
+            # Blocks while the pipe is full so the back pressure of the writer
+            # reaches the port (the kernel tty buffer)
+            self.conn.send((batch, counters))
+
+
+
+def run_worker(source, config, conn, preformat):
+    """
+    Entry point of a worker process. Exits with 0 when the target has sent
+    'end', any other exit is treated as a crash
+    """
+    # Interrupts and the program exit are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    sender = FrameSender(conn, preformat)
+    asyncio.run(PortReader(source, config, sender).run())
+    sender.flush()
+    conn.close()
+
+
+
+class WorkerSupervisor:
+    """
+    Starts a worker process per port, passes their frames to the LogWriter and
+    restarts crashed workers. Runs in the main process (see run())
+    """
+
+    def __init__(self, log_writer, ports, restart_time=worker_restart_time):
+        self.log_writer = log_writer
+        self.ports = ports
+        self.restart_time = restart_time
+        # Workers are started from a clean single-threaded server process, not
+        # forked from this one which already runs the writer and monitor
+        # threads
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(['workers'])
+        # Lines can be formatted by workers only if the handler would format
+        # them the same way
+        self.preformat = log_format == 'text' and\
+                         FastFormatter(log_formatter_string).supported
+        # source -> (process,connection)
+        self.workers = {}
+        # source -> monotonic time of the planned restart
+        self.restarts = {}
+        # source -> the latest counters of the worker
+        self.counters = {}
+        self.stopping = False
+
+        # Metrics
+        self.crashes = 0
+
+    def start_worker(self, source):
+        receiver,sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=run_worker,
+            args=(source, self.ports[source], sender, self.preformat),
+            name='UARTWorker-{}'.format(self.ports[source]['name']),
+            daemon=True)
+        process.start()
+        # The write end lives in the worker only, so the read end gets EOF when
+        # the worker dies
+        sender.close()
+        self.workers[source] = (process, receiver)
+
+    def receive(self, source, receiver):
+        """
+        returns:
+            False if the worker has closed its end of the pipe
+        """
+        try:
+            batch,counters = receiver.recv()
+            previous = self.counters.get(source, [0] * len(counters))
+            for name,value,previous_value in zip(worker_counters, counters,
+                                                 previous):
+                getattr(metrics, name).inc(value - previous_value)
+            self.counters[source] = counters
+            # Workers are separate processes, so the first byte is noticed here.
+            # Only UART frames carry the arrival stamp, a diagnostic message of
+            # the worker (e.g. the port is opened) isn't the first byte
+            if 'first_byte' not in startup_milestones:
+                arrivals = [item[5] for item in batch if item[5] is not None]
+                if arrivals:
+                    startup_milestone('first_byte', min(arrivals))
+            self.log_writer.put_batch(batch)
+        except (EOFError, OSError):
+            return False
+        return True
+
+    def worker_exited(self, source):
+        process,receiver = self.workers.pop(source)
+        # Take frames that have been sent right before the exit
+        while receiver.poll() and self.receive(source, receiver):
+            pass
+        receiver.close()
+        # Counters of a restarted worker start from zero
+        self.counters.pop(source, None)
+        process.join()
+        if process.exitcode == 0 or self.stopping:
+            return
+        self.crashes += 1
+        self.log_writer.log(logging.ERROR, "Worker of {} has crashed (exit code "
+                            "{}), restart after {} seconds".format(
+                                self.ports[source]['port'], process.exitcode,
+                                self.restart_time), source)
+        self.restarts[source] = time.monotonic() + self.restart_time
+
+    def run(self):
+        """
+        Serve until every target sends 'end' (or stop() is called)
+        """
+        for source in range(len(self.ports)):
+            self.start_worker(source)
+
+        while (self.workers or self.restarts) and not self.stopping:
+            now = time.monotonic()
+            for source,restart_at in list(self.restarts.items()):
+                if restart_at <= now:
+                    del self.restarts[source]
+                    self.start_worker(source)
+            timeout = None
+            if self.restarts:
+                timeout = max(0, min(self.restarts.values()) - now)
+
+            objects = {}
+            for source,(process,receiver) in self.workers.items():
+                objects[receiver] = (source, False)
+                objects[process.sentinel] = (source, True)
+            for ready in wait(list(objects), timeout):
+                source,exited = objects[ready]
+                if source not in self.workers:
+                    continue
+                if exited:
+                    self.worker_exited(source)
+                elif not self.receive(source, self.workers[source][1]):
+                    # EOF: the worker is exiting, its sentinel comes next
+                    self.workers[source][0].join()
+                    self.worker_exited(source)
+
+    def stop(self):
+        """
+        Terminate all workers (program exit)
+        """
+        self.stopping = True
+        self.restarts.clear()
+        for source,(process,receiver) in list(self.workers.items()):
+            process.terminate()
+        for source,(process,receiver) in list(self.workers.items()):
+            process.join()
+        print('Worker crashes: {}'.format(self.crashes))
@@ -0,0 +1,576 @@
+"""
+Module that decouples UART ingest from the drive I/O. The reader (main loop)
+only parses frames and puts them into the bounded FrameQueue while the LogWriter
+thread drains the queue to the logger (and so to CustomFileHandler). Any stall
+of the drive now blocks the writer thread only, not ser.read().
+
+The writer also performs the hot swap of the drive: when the drive is pulled
+frames go to the persistent spool on the SD card while a new drive is being
+waited for and activated, then they are drained onto it. The serial port stays
+open the whole time.
+"""
+
+import time, logging, threading, collections
+from miscs import *
+from usbdriveroutine import *
+from spool import Spool
+import metrics
+
+
+
+# Levels of frames from the most to the least expendable one (used by the
+# 'drop_debug' overflow policy)
+frame_levels = [logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR,
+                logging.CRITICAL]
+
+# Special item that asks the writer to finish
+STOP = None
+
+
+
+def make_record(logger, levelno, created, msg):
+    """
+    Build a LogRecord for a frame. The record keeps the arrival time of the
+    frame rather than the time it was written out by the writer thread.
+    """
+    if isinstance(msg, bytes):
+        msg = msg.decode('utf-8', 'replace')
+    record = logger.makeRecord(logger.name, levelno, '(uart)', 0, msg, None,
+                               None)
+    record.created = created
+    record.msecs = (created - int(created)) * 1000
+    return record
+
+
+
+class FrameQueue:
+    """
+    Bounded FIFO of parsed frames, i.e.
+    (levelno,created,msg,source,line,received) tuples (see LogWriter.log()).
+    Frames of every level are kept in their own deque and ordered by a global
+    sequence number so the 'drop_debug' policy can throw away the oldest frame
+    of the lowest level in O(1).
+
+    Overflow policies:
+        'block'       the reader waits for a free place
+        'drop_debug'  the oldest frame of the lowest present level is dropped
+                      (DEBUG first, then INFO and so on)
+        'spill'       frames go to the spill spool on the SD card and are
+                      read back when the writer catches up
+
+    Metrics: high_water_mark (maximal observed length), blocked, dropped and
+    spilled counters.
+    """
+
+    def __init__(self, maxsize=frame_queue_size,
+                 overflow_policy=frame_queue_overflow_policy,
+                 spill=None):
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        # Spool instance for the 'spill' policy
+        self.spill_spool = spill
+
+        self.levels = collections.OrderedDict(
+            (level, collections.deque()) for level in frame_levels)
+        self.length = 0
+        self.seq = 0
+        # Frames spilled during the previous run are taken first
+        self.spilling = spill is not None and len(spill) > 0
+        self.stopping = False
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        # Metrics
+        self.high_water_mark = 0
+        self.blocked = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return self.length
+
+    def level_deque(self, levelno):
+        # Unknown levels are treated like the nearest lower known one
+        for level in reversed(frame_levels):
+            if levelno >= level:
+                return self.levels[level]
+        return self.levels[logging.DEBUG]
+
+    def append(self, item):
+        self.level_deque(item[0]).append((self.seq, item))
+        self.seq += 1
+        self.length += 1
+        if self.length > self.high_water_mark:
+            self.high_water_mark = self.length
+        self.not_empty.notify()
+
+    def popleft(self):
+        oldest = None
+        for frames in self.levels.values():
+            if frames and (oldest is None or frames[0][0] < oldest[0][0]):
+                oldest = frames
+        self.length -= 1
+        return oldest.popleft()[1]
+
+    def put(self, item):
+        """
+        Put a frame. Applies the overflow policy if the queue is full.
+
+        returns:
+            True if the frame has been queued or spilled, False if it has been
+            dropped
+        """
+        with self.lock:
+            # Keep the order: while there are spilled frames new ones also go to
+            # the spill file
+            if self.spilling:
+                return self.spill(item)
+
+            if self.length >= self.maxsize:
+                if self.overflow_policy == 'spill':
+                    return self.spill(item)
+
+                elif self.overflow_policy == 'drop_debug':
+                    self.dropped += 1
+                    for level,frames in self.levels.items():
+                        if frames:
+                            frames.popleft()
+                            self.length -= 1
+                            break
+                        if level >= item[0]:
+                            # The new frame itself is the most expendable one
+                            return False
+
+                else:  # 'block'
+                    self.blocked += 1
+                    while self.length >= self.maxsize and not self.stopping:
+                        self.not_full.wait()
+
+            self.append(item)
+            return True
+
+    def spill(self, item):
+        try:
+            if not self.spill_spool.append(item):
+                self.dropped += 1
+                return False
+        except Exception as e:
+            print(e)
+            self.dropped += 1
+            return False
+        self.spilling = True
+        self.spilled += 1
+        return True
+
+    def take_spilled(self):
+        """
+        Read back the next batch of spilled frames. Must be called without the
+        lock: the spool I/O (reading, fsync of the index on commit) doesn't
+        stall put() then. The spilling flag is cleared only when the spool is
+        found empty under the lock, until then new frames keep going to the
+        spool behind the read ones.
+        """
+        items = []
+        try:
+            items,position = self.spill_spool.read_batch(
+                spool_drain_batch_size)
+            self.spill_spool.commit(position)
+        except Exception as e:
+            print(e)
+            # Don't spin on a broken spool, let new frames go to the queue
+            with self.lock:
+                self.spilling = False
+            return items
+        with self.lock:
+            if not items or not len(self.spill_spool):
+                self.spilling = False
+        return items
+
+    def get_batch(self):
+        """
+        Wait for frames and take all of them at once. Spilled frames are
+        returned after the queued ones as they are newer, at most
+        spool_drain_batch_size of them per call.
+
+        returns:
+            list of items (STOP item means the end)
+        """
+        with self.lock:
+            while not self.length and not self.spilling and not self.stopping:
+                self.not_empty.wait()
+            batch = [self.popleft() for _ in range(self.length)]
+            self.not_full.notify_all()
+            if not self.spilling:
+                if self.stopping:
+                    batch.append(STOP)
+                return batch
+        batch.extend(self.take_spilled())
+        with self.lock:
+            if self.stopping and not self.spilling:
+                batch.append(STOP)
+        return batch
+
+    def stop(self):
+        """
+        Wake everybody up and let the writer finish after the rest of frames
+        """
+        with self.lock:
+            self.stopping = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def stats(self):
+        return {
+            'length': self.length,
+            'high_water_mark': self.high_water_mark,
+            'blocked': self.blocked,
+            'dropped': self.dropped,
+            'spilled': self.spilled
+        }
+
+
+
+class LogWriter(threading.Thread):
+    """
+    Thread that drains FrameQueue to the file handlers. The drive I/O
+    (including commits of CustomFileHandler) happens here.
+
+    Frames are (levelno,created,msg,source,line) tuples where source is the
+    index of the output channel (file handler) the frame goes to: there is only
+    one channel in the single-port mode and one per serial port in the
+    multi-port one. All channels live on the same drive. msg of UART frames
+    is the payload in bytes as it came from the port (see frame_payload()).
+    line is the already formatted line (made by a worker process) or None.
+
+    Frames that couldn't reach the drive (left from the previous run or
+    collected during the hot swap) are kept in the persistent spool and
+    drained onto the drive once it's active. With handlers=None the writer
+    activates the drive itself first while the reader is already running (and
+    frames are waiting in the queue). With hot_swap the writer takes
+    care of the drive: a lost drive is replaced on the fly (see drive_lost())
+    instead of the reboot.
+
+    Every frame is also passed to the live tail publisher (if it's set, see
+    FramePublisher) right after the drive (or the spool during the hot swap),
+    a failure of the publisher is only counted.
+    """
+
+    def __init__(self, logger, queue, handlers, spool, filenames=None,
+                 hot_swap=hot_swap):
+        super(LogWriter, self).__init__(name='LogWriter', daemon=True)
+        self.logger = logger
+        self.queue = queue
+        # Log file names of channels (used to open them on a new drive)
+        self.filenames = filenames or [log_filename]
+        self.hot_swap = hot_swap
+        # Protects the handlers swap
+        self.lock = threading.RLock()
+        self.handlers = handlers
+        self.watch(handlers)
+        # Frames that are waiting for a drive
+        self.spool = spool
+        self.swapping = False
+        # The startup report is written after the first frame that has been
+        # parsed from UART data
+        self.startup_pending = True
+        self.publisher = None
+
+    def watch(self, handlers):
+        if handlers is not None and self.hot_swap:
+            for handler in handlers:
+                handler.on_drive_lost = self.drive_lost
+
+    def log(self, levelno, msg, source=0, created=None, received=None):
+        """
+        Called by the reader for every parsed frame. created is the wall clock
+        time of the arrival of the frame and received is time.monotonic() of
+        it (see Framer.arrival()), messages of the program itself are stamped
+        right here
+        """
+        if created is None:
+            created = time.time()
+        return self.queue.put((levelno, created, msg, source, None, received))
+
+    # Shortcuts for the diagnostic messages of the reader (so the writer can be
+    # passed where the logger is expected, e.g. to usart_connect())
+
+    def info(self, msg):
+        return self.log(logging.INFO, msg)
+
+    def warning(self, msg):
+        return self.log(logging.WARNING, msg)
+
+    def error(self, msg):
+        return self.log(logging.ERROR, msg)
+
+    def put_batch(self, items):
+        """
+        Queue frames that are already stamped (and maybe formatted) by a worker
+        process
+        """
+        for item in items:
+            self.queue.put(item)
+
+    def run(self):
+        if self.handlers is None:
+            self.activate()
+
+        # Frames left from the previous run (e.g. the reboot happened while
+        # there was no drive)
+        if len(self.spool):
+            try:
+                with self.lock:
+                    print('{} spooled records were drained onto the drive'
+                          .format(self.drain_spool(self.handlers)))
+            except Exception as e:
+                print(e)
+
+        while True:
+            for item in self.queue.get_batch():
+                if item is STOP:
+                    self.spool.sync()
+                    return
+                try:
+                    self.write(item)
+                except Exception as e:
+                    print(e)
+            # Make frames spooled during the hot swap durable once per batch
+            if self.swapping:
+                try:
+                    self.spool.sync()
+                except Exception as e:
+                    print(e)
+
+    def write(self, item):
+        """
+        Frames go straight to the file handler bypassing the logger (see
+        CustomFileHandler.write_frame())
+        """
+        levelno,created,msg,source,line,received = item
+        if echo_frames:
+            self.logger.handle(make_record(self.logger, levelno, created, msg))
+        try:
+            with self.lock:
+                if self.swapping:
+                    self.keep(item)
+                else:
+                    self.handlers[source].write_frame(levelno, created, msg,
+                                                      line, received)
+                    if self.startup_pending:
+                        self.check_startup(received)
+        finally:
+            # The live tail goes after the log and never costs log data
+            if self.publisher is not None:
+                try:
+                    self.publisher.publish(levelno, created, msg, source, line)
+                except Exception as e:
+                    print(e)
+                    metrics.publisher_errors.inc()
+
+    def check_startup(self, received):
+        """
+        Only frames parsed from UART data carry the arrival stamp, so the first
+        such frame is the first UART data. Commit it right away and report the
+        startup timings
+        """
+        if 'first_byte' not in startup_milestones or received is None:
+            return
+        self.startup_pending = False
+        try:
+            for handler in self.handlers:
+                handler.commit()
+        except Exception as e:
+            print(e)
+        startup_milestone('first_frame_on_drive')
+        print(startup_report())
+        self.log(logging.INFO, startup_report())
+
+    def keep(self, item):
+        try:
+            self.spool.append(item)
+        except Exception as e:
+            print(e)
+
+    def drain_spool(self, handlers):
+        """
+        Write all spooled frames to their handlers in bulk
+
+        returns:
+            number of drained frames
+        """
+        def write_batch(items):
+            for levelno,created,msg,source,line,received in items:
+                handlers[min(source, len(handlers)-1)].write_frame(levelno,
+                    created, msg, line, received)
+            for handler in handlers:
+                if not handler.active:
+                    raise OSError('Drive has been lost while draining the spool')
+                handler.commit()
+        return self.spool.drain(write_batch)
+
+    def drive_lost(self, handler, frames):
+        """
+        on_drive_lost callback of CustomFileHandler. Invoked in the writer
+        thread (or in the swap thread while a new drive is being filled).
+        """
+        with self.lock:
+            # A handler of the new drive during the spool draining: its frames
+            # are still in the spool, the swap thread will start over
+            if self.swapping or handler not in self.handlers:
+                return
+
+            self.swapping = True
+            lost_handlers = self.handlers
+            self.handlers = None
+            # All channels are on the same drive so take uncommitted frames of
+            # the others as well
+            for source,lost_handler in enumerate(lost_handlers):
+                self.logger.removeHandler(lost_handler)
+                if lost_handler is handler:
+                    lost_frames = frames
+                else:
+                    lost_handler.active = False
+                    lost_frames = lost_handler.uncommitted
+                    lost_handler.uncommitted = []
+                    lost_handler.uncommitted_received = []
+                for levelno,created,msg in lost_frames:
+                    self.keep((levelno, created, msg, source, None, None))
+        threading.Thread(target=self.swap_drive, args=(lost_handlers,),
+                         name='DriveSwap', daemon=True).start()
+
+    def activate(self):
+        """
+        Activate the drive at the program start. It runs in the writer thread,
+        a failure reboots and ends the whole process (see exit_after_reboot())
+        """
+        handlers,drive = self.open_drive(replace=False)
+        with self.lock:
+            self.logger.addHandler(handlers[0])
+            self.handlers = handlers
+            self.watch(handlers)
+        startup_milestone('drive')
+
+    def open_drive(self, replace=True):
+        """
+        Wait for a new drive (if replace) and open all channels on it
+
+        returns:
+            handlers,drive
+        """
+        if replace and replace_drive(possible_drives) == CRITICAL_ERROR:
+            sudo_reboot()
+
+        activate_drive_and_logger_status,\
+        logging_file_handler,\
+        drive = activate_drive_and_logger(
+            possible_drives,
+            drive_mountpoint,
+            drive_name,
+            self.logger,
+            formatter,
+            self.filenames[0],
+            attach=False
+        )
+        if activate_drive_and_logger_status == CRITICAL_ERROR:
+            sudo_reboot()
+
+        return open_channels(logging_file_handler, drive, self.filenames),drive
+
+    def swap_drive(self, lost_handlers):
+        """
+        Wait for a new drive, activate it and drain the spool onto it
+        """
+        cprint('HOT SWAP OF THE DRIVE', 'red')
+        for lost_handler in lost_handlers:
+            try:
+                lost_handler.close()
+            except Exception as e:
+                print(e)
+
+        while True:
+            # Get rid of the stale mount of the pulled drive
+            unmount_drive('{}/{}'.format(drive_mountpoint, drive_name))
+            # If no drive comes the whole process is ended from this thread
+            # (see exit_after_reboot()), the writer spools frames till then
+            handlers,drive = self.open_drive()
+            self.watch(handlers)
+            try:
+                # Bulk of the spool is drained while the writer keeps spooling
+                # new frames, the rest is drained with the writer paused
+                drained = self.drain_spool(handlers)
+                with self.lock:
+                    drained += self.drain_spool(handlers)
+                    self.logger.addHandler(handlers[0])
+                    self.handlers = handlers
+                    self.swapping = False
+            except Exception as e:
+                # The new drive has gone too, wait for another one
+                print(e)
+                for handler in handlers:
+                    try:
+                        handler.close()
+                    except Exception as e:
+                        print(e)
+                continue
+            metrics.drive_swaps.inc()
+            print('{} spooled records were drained onto {}'.format(drained,
+                                                                   drive))
+            return
+
+    def stop(self, timeout=writer_stop_timeout):
+        """
+        Write out the rest of frames and finish the thread
+        """
+        self.queue.stop()
+        stuck = False
+        if threading.current_thread() is not self and self.is_alive():
+            self.join(timeout)
+            # E.g. a reboot from the main thread while the writer waits for a
+            # drive to activate
+            stuck = self.is_alive()
+            if stuck:
+                print("Writer hasn't finished in {} seconds".format(timeout))
+        if threading.current_thread() is self or stuck:
+            # The writer is going down (a reboot has been requested by the drive
+            # activation or a lost drive without hot_swap) or is stuck: frames
+            # it won't write wait for the next run in the spool
+            while True:
+                batch = self.queue.get_batch()
+                for item in batch:
+                    if item is not STOP:
+                        self.keep(item)
+                if batch and batch[-1] is STOP:
+                    break
+            self.spool.sync()
+        print('Frame queue: {}'.format(self.queue.stats()))
+        print('Outage spool: {}'.format(self.spool.stats()))
+
+
+
+def open_channels(first_handler, drive, filenames):
+    """
+    The first channel is opened by activate_drive_and_logger(), open the rest
+    ones on the same drive (they share the drive monitor of the first one)
+
+    returns:
+        list of handlers
+    """
+    handlers = [first_handler]
+    try:
+        for filename in filenames[1:]:
+            handler = make_file_handler(drive,
+                '{}/{}'.format(drive_mountpoint, drive_name), filename,
+                monitor=first_handler.monitor)
+            handler.setLevel(logging.DEBUG)
+            handler.setFormatter(formatter)
+            handlers.append(handler)
+    except Exception:
+        for handler in handlers:
+            try:
+                handler.close()
+            except Exception as e:
+                print(e)
+        raise
+    return handlers